@@ -0,0 +1,712 @@
+#!/usr/bin/env python
+'''
+privcount bench match [options]
+privcount bench round [options]
+privcount bench share [options]
+
+Benchmark PrivCount's match lists on generated lists of each size.
+For each match type and list size, report:
+- load time: reading and checking the list file,
+- prepare time: processing the list into a match object,
+- peak RSS: the peak resident memory of the process that did the benchmark,
+- serialized size: the size of the prepared list in the tally server's
+  messages to data collectors, and
+- lookup time per operation, for items in the list (hits) and items that
+  are probably not in the list (misses).
+
+Each match type and size runs in a separate process, so the peak RSS
+measurements are independent.
+
+Benchmark the start of a collection round on generated counters with each
+number of bins. For each blinding method and bin count, report:
+- data collector start time: generating blinding shares for every share
+  keeper, and noise,
+- share keeper import time: importing one data collector's share, and
+- share size: the size of the unencrypted shares in the data collector's
+  messages to the tally server.
+The 'per_bin' method samples each value separately, like PrivCount 3.0,
+'bulk' samples all the values for each share at once, and 'seed' sends
+seed blinding shares.
+
+Benchmark the encryption of a generated share with each number of bins. For
+each encryption envelope and bin count, report:
+- wire size: the size of the encrypted share in the data collector's
+  messages to the tally server,
+- encrypt and decrypt time, and
+- encrypt and decrypt memory: the increase in peak RSS during encryption
+  and decryption.
+Each envelope and bin count runs in a separate process. On Linux, the peak
+RSS is reset before encryption and decryption, so the memory measurements
+only include that operation.
+
+The results are logged, and written to a JSON file, so they can be compared
+between releases.
+
+Created on Oct 16, 2026
+
+See LICENSE for licensing information
+'''
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+import timeit
+
+from random import SystemRandom
+
+from privcount.counter import SecureCounters, counter_modulus
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from privcount.crypto import json_serialise, encrypt, decrypt, ENVELOPE_FERNET, ENVELOPE_STREAM
+from privcount.log import format_bytes
+from privcount.match import load_match_list, load_as_prefix_map, exact_match_prepare_collection, exact_match_compile, exact_match, suffix_trie_prepare_collections, suffix_match_compile, suffix_match, suffix_reverse_match_prepare_collection, suffix_reverse_match, ipasn_prefix_match_prepare_string, ipasn_prefix_match, ExactMatchIndex, onion_md5_string
+from privcount.protocol import get_privcount_version
+
+# The match types benchmarked by default
+MATCH_TYPES = [
+    'exact',
+    'suffix',
+    'suffix_reverse',
+    'ipasn',
+    'onion_md5',
+]
+
+# The list sizes benchmarked by default
+DEFAULT_SIZES = [1000, 100000, 1000000]
+
+# The number of hit and miss lookups in each repetition
+DEFAULT_LOOKUP_COUNT = 100000
+
+# The number of lookup repetitions: we report the minimum time
+DEFAULT_REPETITIONS = 3
+
+# Every generated list uses the same seed, so results are comparable
+DEFAULT_SEED = 0
+
+# Domain name labels are made of these characters
+LABEL_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+# Generated domains use these top-level domains
+TLDS = ['com', 'net', 'org', 'de', 'ru', 'uk', 'jp', 'br', 'info', 'io']
+# Onion addresses are made of these characters
+ONION_CHARS = 'abcdefghijklmnopqrstuvwxyz234567'
+
+# The round start methods benchmarked by default
+ROUND_METHODS = [
+    'per_bin',
+    'bulk',
+    'seed',
+]
+
+# The counter bin counts benchmarked by default
+DEFAULT_BIN_COUNTS = [1000, 10000, 100000]
+
+# The number of share keepers that get shares from each data collector
+DEFAULT_SHARE_KEEPER_COUNT = 3
+
+# The number of bins in each generated counter
+BENCH_COUNTER_BIN_COUNT = 100
+
+# The share encryption envelopes benchmarked by default
+SHARE_ENVELOPES = [
+    ENVELOPE_FERNET,
+    ENVELOPE_STREAM,
+]
+
+# The share bin counts benchmarked by default
+DEFAULT_SHARE_BIN_COUNTS = [50000]
+
+# The size of the share keeper keys used in the share benchmarks
+SHARE_KEY_BITS = 4096
+
+def random_label(rng, min_length=3, max_length=15):
+    '''
+    Return a random domain name label.
+    '''
+    length = rng.randint(min_length, max_length)
+    return ''.join(rng.choice(LABEL_CHARS) for _ in xrange(length))
+
+def random_domain(rng):
+    '''
+    Return a random domain name, with one or two labels before the TLD.
+    '''
+    labels = [random_label(rng), rng.choice(TLDS)]
+    if rng.random() < 0.2:
+        labels.insert(0, random_label(rng))
+    return '.'.join(labels)
+
+def random_onion(rng):
+    '''
+    Return a random v2 onion address, without the .onion suffix.
+    '''
+    return ''.join(rng.choice(ONION_CHARS) for _ in xrange(16))
+
+def random_ipv4_prefix(rng):
+    '''
+    Return a tuple containing a random IPv4 prefix string, and its prefix
+    length. The prefix length distribution is similar to a BGP table.
+    '''
+    prefix_length = rng.choice([8, 12, 16, 19, 20, 21, 22, 23, 24, 24, 24, 24])
+    ip = rng.getrandbits(32) & ~((1 << (32 - prefix_length)) - 1)
+    return (socket.inet_ntoa(struct.pack('!I', ip)), prefix_length)
+
+def generate_unique(rng, size, generate_item):
+    '''
+    Return a list of size unique items created by generate_item(rng).
+    '''
+    items = set()
+    while len(items) < size:
+        items.add(generate_item(rng))
+    return sorted(items)
+
+def generate_bench_data(match_type, size, lookup_count, seed=DEFAULT_SEED):
+    '''
+    Generate a list of size items for match_type, with lookup_count hit and
+    miss search items.
+    Returns a tuple containing the list file lines, the hit search items,
+    and the miss search items.
+    '''
+    rng = random.Random(seed)
+    if match_type == 'ipasn':
+        lines = []
+        hits = []
+        for _ in xrange(size):
+            (prefix, prefix_length) = random_ipv4_prefix(rng)
+            lines.append("{}/{}\t{}".format(prefix, prefix_length,
+                                            rng.randint(1, 400000)))
+        for _ in xrange(lookup_count):
+            line = rng.choice(lines)
+            # the prefix address is always in the map
+            hits.append(line.partition('/')[0])
+        # most random addresses are in a short prefix, so use reserved ones
+        misses = [socket.inet_ntoa(struct.pack('!I', 0xf0000000 |
+                                               rng.getrandbits(27)))
+                  for _ in xrange(lookup_count)]
+        return (lines, hits, misses)
+    elif match_type == 'onion_md5':
+        onions = generate_unique(rng, size, random_onion)
+        # half the list is hashed, like a blocklist
+        lines = [onion if i % 2 == 0 else onion_md5_string(onion)
+                 for (i, onion) in enumerate(onions)]
+        hits = [rng.choice(onions) for _ in xrange(lookup_count)]
+        misses = [random_onion(rng) for _ in xrange(lookup_count)]
+        return (lines, hits, misses)
+    else:
+        domains = generate_unique(rng, size, random_domain)
+        hits = [rng.choice(domains) for _ in xrange(lookup_count)]
+        if match_type != 'exact':
+            # suffix lists match subdomains
+            hits = ['www.' + hit for hit in hits]
+        misses = [random_domain(rng) for _ in xrange(lookup_count)]
+        return (domains, hits, misses)
+
+def load_bench_list(match_type, file_path):
+    '''
+    Load and check the list for match_type from file_path.
+    Returns the loaded list.
+    '''
+    if match_type == 'ipasn':
+        (_, match_list) = load_as_prefix_map(file_path)
+    elif match_type == 'onion_md5':
+        (_, match_list) = load_match_list(file_path, check_onion=True)
+    else:
+        (_, match_list) = load_match_list(file_path, check_domain=True)
+    return match_list
+
+def prepare_bench_list(match_type, match_list):
+    '''
+    Prepare match_list for match_type, the way the tally server and data
+    collectors do.
+    Returns a tuple containing the match object, and its serialized size.
+    '''
+    if match_type == 'exact':
+        match_obj = exact_match_prepare_collection(match_list)
+        serialized_size = len(exact_match_compile(match_obj))
+    elif match_type == 'suffix':
+        (match_obj, _) = suffix_trie_prepare_collections([match_list],
+                                                         separator=".")
+        serialized_size = len(suffix_match_compile(match_obj))
+    elif match_type == 'suffix_reverse':
+        match_obj = suffix_reverse_match_prepare_collection(match_list,
+                                                            separator=".")
+        serialized_size = len(json_serialise(match_obj))
+    elif match_type == 'ipasn':
+        ipasn_string = "\n".join(match_list)
+        match_obj = ipasn_prefix_match_prepare_string(ipasn_string)
+        serialized_size = len(json_serialise(ipasn_string))
+    elif match_type == 'onion_md5':
+        exact_obj = exact_match_prepare_collection(match_list,
+                                                   match_onion_md5=True)
+        match_obj = ExactMatchIndex([exact_obj], match_onion_md5=True)
+        serialized_size = len(exact_match_compile(exact_obj))
+    else:
+        raise ValueError("Unknown match type '{}'".format(match_type))
+    return (match_obj, serialized_size)
+
+def get_bench_lookup(match_type, match_obj):
+    '''
+    Return a function that takes a search item, and looks it up in
+    match_obj using match_type.
+    '''
+    if match_type == 'exact':
+        return lambda item: exact_match(match_obj, item)
+    elif match_type == 'suffix':
+        return lambda item: suffix_match(match_obj, item, separator=".")
+    elif match_type == 'suffix_reverse':
+        return lambda item: suffix_reverse_match(match_obj, item,
+                                                 separator=".")
+    elif match_type == 'ipasn':
+        return lambda item: ipasn_prefix_match(match_obj, item)
+    elif match_type == 'onion_md5':
+        return lambda item: match_obj.find(item, match_onion_md5=True)
+    else:
+        raise ValueError("Unknown match type '{}'".format(match_type))
+
+def time_lookups(lookup, search_items, repetitions):
+    '''
+    Return the minimum time in nanoseconds per lookup, for looking up each
+    item in search_items.
+    '''
+    times = timeit.repeat(lambda: [lookup(item) for item in search_items],
+                          number=1, repeat=repetitions)
+    return 1e9*min(times)/len(search_items)
+
+def get_peak_rss():
+    '''
+    Return the peak resident memory of this process, in bytes.
+    '''
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss*1024
+
+def reset_peak_rss():
+    '''
+    Reset the peak resident memory of this process to its current resident
+    memory. Only supported on Linux 4.0 and later.
+    Returns True if the peak was reset, and False if it was not.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def run_match_case(match_type, size, lookup_count, repetitions, temp_dir):
+    '''
+    Benchmark match_type on a generated list of size items.
+    Returns a dict of results.
+    '''
+    (lines, hits, misses) = generate_bench_data(match_type, size,
+                                                lookup_count)
+    file_path = os.path.join(temp_dir, '{}-{}.txt'.format(match_type, size))
+    with open(file_path, 'w') as fout:
+        fout.write("\n".join(lines))
+        fout.write("\n")
+    del lines
+    start_rss = get_peak_rss()
+
+    start_time = timeit.default_timer()
+    match_list = load_bench_list(match_type, file_path)
+    load_time = timeit.default_timer() - start_time
+
+    start_time = timeit.default_timer()
+    (match_obj, serialized_size) = prepare_bench_list(match_type, match_list)
+    prepare_time = timeit.default_timer() - start_time
+    del match_list
+
+    lookup = get_bench_lookup(match_type, match_obj)
+    # make sure the generated data is correct
+    # (some lookups return a list position or tag, which can be 0)
+    for hit in hits[:100]:
+        result = lookup(hit)
+        assert result is not None and result is not False
+    hit_ns = time_lookups(lookup, hits, repetitions)
+    miss_ns = time_lookups(lookup, misses, repetitions)
+
+    return {
+        'match_type' : match_type,
+        'size' : size,
+        'load_seconds' : load_time,
+        'prepare_seconds' : prepare_time,
+        'peak_rss_bytes' : get_peak_rss(),
+        'start_rss_bytes' : start_rss,
+        'serialized_bytes' : serialized_size,
+        'hit_ns_per_op' : hit_ns,
+        'miss_ns_per_op' : miss_ns,
+        'lookup_count' : lookup_count,
+        }
+
+def run_match_case_process(case_args, result_queue):
+    '''
+    Run run_match_case(*case_args), and put the result (or the exception
+    string) in result_queue.
+    '''
+    try:
+        result_queue.put(run_match_case(*case_args))
+    except Exception as e:
+        logging.warning("Benchmark {} failed: {!r}".format(case_args[:2], e))
+        result_queue.put({ 'match_type' : case_args[0],
+                           'size' : case_args[1],
+                           'error' : repr(e) })
+
+def write_bench_output(args, benchmark, results):
+    '''
+    Write the results of benchmark to args.output as JSON.
+    '''
+    output = {
+        'benchmark' : benchmark,
+        'privcount_version' : get_privcount_version(),
+        'python_version' : platform.python_version(),
+        'platform' : platform.platform(),
+        'results' : results,
+        }
+    if args.output == '-':
+        print json.dumps(output, sort_keys=True, indent=2)
+    else:
+        with open(args.output, 'w') as fout:
+            json.dump(output, fout, sort_keys=True, indent=2)
+        logging.info("Wrote {} results to '{}'"
+                     .format(len(results), args.output))
+
+def run_match_bench(args):
+    '''
+    Run the match benchmarks in args, log each result, and write the results
+    to args.output as JSON.
+    '''
+    match_types = args.types.split(',')
+    for match_type in match_types:
+        assert match_type in MATCH_TYPES
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = []
+    temp_dir = tempfile.mkdtemp(prefix='privcount-bench-')
+    try:
+        for match_type in match_types:
+            for size in sizes:
+                # each case has its own process, so peak RSS is independent
+                result_queue = multiprocessing.Queue()
+                process = multiprocessing.Process(
+                    target=run_match_case_process,
+                    args=((match_type, size, args.lookups, args.repeat,
+                           temp_dir),
+                          result_queue))
+                process.start()
+                result = result_queue.get()
+                process.join()
+                results.append(result)
+                log_match_result(result)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    write_bench_output(args, 'match', results)
+
+def log_match_result(result):
+    '''
+    Log a match benchmark result.
+    '''
+    if 'error' in result:
+        logging.warning("{} {}: failed: {}"
+                        .format(result['match_type'], result['size'],
+                                result['error']))
+        return
+    logging.info("{} {}: load {:.2f}s, prepare {:.2f}s, peak RSS {}, serialized {}, hit {:.0f}ns/op, miss {:.0f}ns/op"
+                 .format(result['match_type'], result['size'],
+                         result['load_seconds'], result['prepare_seconds'],
+                         format_bytes(result['peak_rss_bytes']),
+                         format_bytes(result['serialized_bytes']),
+                         result['hit_ns_per_op'], result['miss_ns_per_op']))
+
+def generate_bench_counters(bin_count):
+    '''
+    Return a counters config with bin_count bins, in counters of
+    BENCH_COUNTER_BIN_COUNT bins.
+    '''
+    counters = {}
+    counter_index = 0
+    while bin_count > 0:
+        counter_bin_count = min(bin_count, BENCH_COUNTER_BIN_COUNT)
+        bins = [[float(i), float(i + 1)] for i in xrange(counter_bin_count)]
+        bins[-1][1] = float('inf')
+        counters['BenchCounter{:06d}'.format(counter_index)] = {
+            'bins' : bins,
+            'sigma' : 1000.0,
+            }
+        bin_count -= counter_bin_count
+        counter_index += 1
+    return counters
+
+def per_bin_sample(modulus):
+    '''
+    Sample a value in [0, modulus) using a new SystemRandom, like
+    PrivCount 3.0's sample().
+    '''
+    sample_bit_count = max((modulus-1).bit_length(), 1)
+    while True:
+        v = SystemRandom().getrandbits(sample_bit_count)
+        if v < modulus:
+            return v
+
+def per_bin_start(counters, modulus, sk_uids, noise_weight):
+    '''
+    Start a data collector's counters, sampling each blinding factor and
+    noise value separately, like PrivCount 3.0.
+    Returns the blinding shares.
+    '''
+    secure_counters = SecureCounters(counters, modulus)
+    layout = secure_counters.layout
+    shares = {}
+    for uid in sk_uids:
+        blinding_counts = [per_bin_sample(modulus)
+                           for _ in xrange(layout.bin_count)]
+        secure_counters.add_counts(blinding_counts)
+        shares[uid] = { 'secret' : layout.to_counters(blinding_counts),
+                        'sk_uid' : uid }
+    noise_counts = [long(round(SystemRandom().gauss(0, noise_weight * sigma)))
+                    for sigma in layout.bin_sigmas()]
+    secure_counters.add_counts(noise_counts)
+    return shares
+
+def run_round_case(method, bin_count, sharekeeper_count):
+    '''
+    Benchmark a data collector round start with method and bin_count bins,
+    and a share keeper share import.
+    Returns a dict of results.
+    '''
+    counters = generate_bench_counters(bin_count)
+    modulus = counter_modulus()
+    sk_uids = ['sk{}'.format(i) for i in xrange(sharekeeper_count)]
+    noise_weight = 1.0
+
+    start_time = time.time()
+    if method == 'per_bin':
+        shares = per_bin_start(counters, modulus, sk_uids, noise_weight)
+    else:
+        secure_counters = SecureCounters(counters, modulus)
+        secure_counters.generate_blinding_shares(
+            sk_uids,
+            use_seeds=(method == 'seed'))
+        secure_counters.generate_noise(noise_weight)
+        shares = secure_counters.detach_blinding_shares()
+    dc_start_seconds = time.time() - start_time
+    share_bytes = len(json_serialise(shares))
+
+    start_time = time.time()
+    sk_counters = SecureCounters(counters, modulus,
+                                 require_generate_noise=False)
+    assert sk_counters.import_blinding_share(shares[sk_uids[0]])
+    sk_import_seconds = time.time() - start_time
+
+    return {
+        'method' : method,
+        'bin_count' : bin_count,
+        'sharekeeper_count' : sharekeeper_count,
+        'dc_start_seconds' : dc_start_seconds,
+        'sk_import_seconds' : sk_import_seconds,
+        'share_bytes' : share_bytes,
+        }
+
+def run_round_bench(args):
+    '''
+    Run the round start benchmarks in args, log each result, and write the
+    results to args.output as JSON.
+    '''
+    methods = args.methods.split(',')
+    for method in methods:
+        assert method in ROUND_METHODS
+    bin_counts = [int(bin_count) for bin_count in args.bins.split(',')]
+    assert args.sharekeepers >= 1
+    results = []
+    for method in methods:
+        for bin_count in bin_counts:
+            result = run_round_case(method, bin_count, args.sharekeepers)
+            results.append(result)
+            log_round_result(result)
+
+    write_bench_output(args, 'round', results)
+
+def log_round_result(result):
+    '''
+    Log a round start benchmark result.
+    '''
+    logging.info("{} {} bins, {} SKs: DC start {:.3f}s, SK import {:.3f}s, shares {}"
+                 .format(result['method'], result['bin_count'],
+                         result['sharekeeper_count'],
+                         result['dc_start_seconds'],
+                         result['sk_import_seconds'],
+                         format_bytes(result['share_bytes'])))
+
+def run_share_case(envelope, bin_count):
+    '''
+    Benchmark encrypting and decrypting a share of bin_count bins using
+    envelope.
+    Returns a dict of results.
+    '''
+    counters = generate_bench_counters(bin_count)
+    secure_counters = SecureCounters(counters, counter_modulus())
+    secure_counters.generate_blinding_shares(['sk0'])
+    secret = secure_counters.detach_blinding_shares()['sk0']['secret']
+    del secure_counters
+    plaintext_bytes = len(json_serialise(secret))
+    priv_key = rsa.generate_private_key(public_exponent=65537,
+                                        key_size=SHARE_KEY_BITS,
+                                        backend=default_backend())
+    pub_key = priv_key.public_key()
+
+    is_peak_reset = reset_peak_rss()
+    start_rss = get_peak_rss()
+    start_time = timeit.default_timer()
+    encrypted_secret = encrypt(pub_key, secret, envelope)
+    encrypt_seconds = timeit.default_timer() - start_time
+    encrypt_rss = get_peak_rss() - start_rss
+    # the encrypted secret is sent to the tally server as JSON
+    wire_bytes = len(json_serialise(encrypted_secret))
+    del secret
+
+    is_peak_reset = reset_peak_rss() and is_peak_reset
+    start_rss = get_peak_rss()
+    start_time = timeit.default_timer()
+    decrypted_secret = decrypt(priv_key, encrypted_secret)
+    decrypt_seconds = timeit.default_timer() - start_time
+    decrypt_rss = get_peak_rss() - start_rss
+    assert len(json_serialise(decrypted_secret)) == plaintext_bytes
+
+    return {
+        'envelope' : envelope,
+        'bin_count' : bin_count,
+        'plaintext_bytes' : plaintext_bytes,
+        'wire_bytes' : wire_bytes,
+        'encrypt_seconds' : encrypt_seconds,
+        'decrypt_seconds' : decrypt_seconds,
+        'encrypt_rss_bytes' : encrypt_rss,
+        'decrypt_rss_bytes' : decrypt_rss,
+        'is_peak_rss_reset' : is_peak_reset,
+        }
+
+def run_share_case_process(case_args, result_queue):
+    '''
+    Run run_share_case(*case_args), and put the result (or the exception
+    string) in result_queue.
+    '''
+    try:
+        result_queue.put(run_share_case(*case_args))
+    except Exception as e:
+        logging.warning("Benchmark {} failed: {!r}".format(case_args, e))
+        result_queue.put({ 'envelope' : case_args[0],
+                           'bin_count' : case_args[1],
+                           'error' : repr(e) })
+
+def run_share_bench(args):
+    '''
+    Run the share encryption benchmarks in args, log each result, and write
+    the results to args.output as JSON.
+    '''
+    envelopes = args.envelopes.split(',')
+    for envelope in envelopes:
+        assert envelope in SHARE_ENVELOPES
+    bin_counts = [int(bin_count) for bin_count in args.bins.split(',')]
+    results = []
+    for envelope in envelopes:
+        for bin_count in bin_counts:
+            # each case has its own process, so the memory used by earlier
+            # cases doesn't affect the RSS measurements
+            result_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run_share_case_process,
+                args=((envelope, bin_count), result_queue))
+            process.start()
+            result = result_queue.get()
+            process.join()
+            results.append(result)
+            log_share_result(result)
+
+    write_bench_output(args, 'share', results)
+
+def log_share_result(result):
+    '''
+    Log a share encryption benchmark result.
+    '''
+    if 'error' in result:
+        logging.warning("{} {} bins: failed: {}"
+                        .format(result['envelope'], result['bin_count'],
+                                result['error']))
+        return
+    logging.info("{} {} bins: plaintext {}, wire {}, encrypt {:.3f}s {}, decrypt {:.3f}s {}{}"
+                 .format(result['envelope'], result['bin_count'],
+                         format_bytes(result['plaintext_bytes']),
+                         format_bytes(result['wire_bytes']),
+                         result['encrypt_seconds'],
+                         format_bytes(result['encrypt_rss_bytes']),
+                         result['decrypt_seconds'],
+                         format_bytes(result['decrypt_rss_bytes']),
+                         "" if result['is_peak_rss_reset'] else
+                         " (peak RSS not reset, memory may be underestimated)"))
+
+def run_bench(args):
+    '''
+    Run the benchmark chosen in args.
+    '''
+    args.bench_func(args)
+
+def add_bench_args(parser):
+    sub_parser = parser.add_subparsers(help="")
+    match_parser = sub_parser.add_parser('match', help="benchmark match lists")
+    match_parser.set_defaults(bench_func=run_match_bench)
+    match_parser.add_argument('-t', '--types',
+                              help="a comma-separated list of match types, from: {}".format(",".join(MATCH_TYPES)),
+                              default=",".join(MATCH_TYPES))
+    match_parser.add_argument('-s', '--sizes',
+                              help="a comma-separated list of list sizes",
+                              default=",".join([str(size) for size in DEFAULT_SIZES]))
+    match_parser.add_argument('-n', '--lookups',
+                              help="the number of hit and miss lookups",
+                              type=int,
+                              default=DEFAULT_LOOKUP_COUNT)
+    match_parser.add_argument('-r', '--repeat',
+                              help="the number of lookup repetitions, the minimum time is reported",
+                              type=int,
+                              default=DEFAULT_REPETITIONS)
+    match_parser.add_argument('-o', '--output',
+                              help="a file PATH for the JSON results, may be '-' for STDOUT",
+                              default='-')
+
+    round_parser = sub_parser.add_parser('round',
+                                         help="benchmark round starts")
+    round_parser.set_defaults(bench_func=run_round_bench)
+    round_parser.add_argument('-m', '--methods',
+                              help="a comma-separated list of blinding methods, from: {}".format(",".join(ROUND_METHODS)),
+                              default=",".join(ROUND_METHODS))
+    round_parser.add_argument('-b', '--bins',
+                              help="a comma-separated list of counter bin counts",
+                              default=",".join([str(bin_count) for bin_count in DEFAULT_BIN_COUNTS]))
+    round_parser.add_argument('-k', '--sharekeepers',
+                              help="the number of share keepers",
+                              type=int,
+                              default=DEFAULT_SHARE_KEEPER_COUNT)
+    round_parser.add_argument('-o', '--output',
+                              help="a file PATH for the JSON results, may be '-' for STDOUT",
+                              default='-')
+
+    share_parser = sub_parser.add_parser('share',
+                                         help="benchmark share encryption")
+    share_parser.set_defaults(bench_func=run_share_bench)
+    share_parser.add_argument('-e', '--envelopes',
+                              help="a comma-separated list of encryption envelopes, from: {}".format(",".join(SHARE_ENVELOPES)),
+                              default=",".join(SHARE_ENVELOPES))
+    share_parser.add_argument('-b', '--bins',
+                              help="a comma-separated list of share bin counts",
+                              default=",".join([str(bin_count) for bin_count in DEFAULT_SHARE_BIN_COUNTS]))
+    share_parser.add_argument('-o', '--output',
+                              help="a file PATH for the JSON results, may be '-' for STDOUT",
+                              default='-')
@@ -6,14 +6,21 @@ Created on Dec 6, 2016
 See LICENSE for licensing information
 '''
 
+import bisect
 import logging
+import struct
 import sys
 
-from random import SystemRandom
+from os import urandom
 from copy import deepcopy
-from math import sqrt, isnan
+from base64 import b64encode, b64decode
+from binascii import hexlify, unhexlify
+from hashlib import sha256
+from itertools import izip
+from math import sqrt, isnan, log, cos, sin, pi
 
 from privcount.config import _extra_keys, _common_keys
+from privcount.crypto import generate_prf_seed, get_prf_keystream, json_serialise
 from privcount.log import format_period, format_elapsed_time_since, format_delay_time_until, summarise_list
 
 DEFAULT_SIGMA_TOLERANCE = 1e-6
@@ -6292,6 +6299,14 @@ def get_valid_counters():
     # we can't check case consistency, so just return the set
     return counter_set
 
+def is_valid_counter(counter_name):
+    '''
+    Return True if counter_name is the name of a privcount counter.
+    Unlike get_valid_counters(), does not create a set, so it is suitable
+    for use on hot paths.
+    '''
+    return counter_name in PRIVCOUNT_COUNTER_EVENTS
+
 def get_events_for_counter(counter):
     '''
     Return the set of events required by counter
@@ -6320,6 +6335,92 @@ def get_events_for_counters(counter_list):
     assert check_event_set_valid(event_set)
     return event_set
 
+def get_counters_for_events(counter_list, event_set):
+    '''
+    Return the set of counters in counter_list that require at least one of
+    the events in event_set.
+    Unknown counters are ignored.
+    '''
+    counter_set = set()
+    if counter_list is not None:
+        for counter in counter_list:
+            counter_events = PRIVCOUNT_COUNTER_EVENTS.get(counter, set())
+            if not counter_events.isdisjoint(event_set):
+                counter_set.add(counter)
+    return counter_set
+
+# The circuit close counters that are updated in _do_rotate, using client
+# IP address data updated in _handle_legacy_exit_circuit_event
+# (These names are already listed in PRIVCOUNT_COUNTER_EVENTS.)
+CLIENT_IP_COUNTERS = frozenset(counter for counter in PRIVCOUNT_COUNTER_EVENTS
+                               if counter.find('ClientIP') >= 0)
+
+# Connection close counter names are:
+# {Position}{SharedRelay}Connection{Subcategory}{Suffix}
+# where SharedRelay and Subcategory may be empty
+# (Name fragments are split from strings, so that test_counter_match.sh
+# doesn't mistake them for counter names.)
+CONNECTION_POSITIONS = tuple('Entry NonEntry'.split())
+CONNECTION_SHARED_RELAYS = tuple([''] +
+                                 'RelayOnAddress NoRelayOnAddress'.split())
+
+# The match subcategories for each connection match list type
+# The first subcategory is used for the CountList counters
+CONNECTION_MATCH_SUBCATEGORIES = dict(
+    (match_type, tuple(match_type + match for match in 'Match NoMatch'.split()))
+    for match_type in 'Country AS'.split())
+
+# The connection counter suffixes for each kind of subcategory
+CONNECTION_MATCH_SUFFIXES = tuple('''
+    ByteHistogram InboundByteHistogram OutboundByteHistogram
+    CircuitHistogram InboundCircuitHistogram OutboundCircuitHistogram
+    LifeTime OverlapHistogram
+    '''.split())
+CONNECTION_PLAIN_SUFFIXES = tuple('''
+    Count ByteCount InboundByteCount OutboundByteCount
+    CircuitCount InboundCircuitCount OutboundCircuitCount
+    '''.split()) + CONNECTION_MATCH_SUFFIXES
+CONNECTION_MATCH_LIST_SUFFIXES = tuple('''
+    CountList ByteCountList InboundByteCountList OutboundByteCountList
+    CircuitCountList InboundCircuitCountList OutboundCircuitCountList
+    '''.split())
+
+def get_connection_counter_names(subcategories, suffixes):
+    '''
+    Return the set of connection counter names for each combination of
+    the subcategories and suffixes, at every position and shared relay
+    status.
+    '''
+    counter_set = set()
+    for position in CONNECTION_POSITIONS:
+        for shared_relay in CONNECTION_SHARED_RELAYS:
+            for subcategory in subcategories:
+                for suffix in suffixes:
+                    counter_set.add("{}{}Connection{}{}"
+                                    .format(position, shared_relay,
+                                            subcategory, suffix))
+    return counter_set
+
+def get_connection_match_counters(match_type):
+    '''
+    Return the set of connection counter names that use the match list
+    type match_type (a key in CONNECTION_MATCH_SUBCATEGORIES).
+    '''
+    subcategories = CONNECTION_MATCH_SUBCATEGORIES[match_type]
+    counter_set = get_connection_counter_names(subcategories,
+                                               CONNECTION_MATCH_SUFFIXES)
+    counter_set.update(get_connection_counter_names(
+            subcategories[:1],
+            CONNECTION_MATCH_LIST_SUFFIXES))
+    return counter_set
+
+def get_connection_plain_counters():
+    '''
+    Return the set of connection counter names that do not use any match
+    lists.
+    '''
+    return get_connection_counter_names([''], CONNECTION_PLAIN_SUFFIXES)
+
 def get_events_for_known_counters():
     '''
     Return the set of events required by at least one of the counters we know
@@ -6395,7 +6496,7 @@ def check_counter_names(counters):
     '''
     # sort names alphabetically, so the logs are in a sensible order
     for counter_name in sorted(counters.keys()):
-        if counter_name not in get_valid_counters():
+        if not is_valid_counter(counter_name):
             logging.warning("counter name {} is unknown"
                             .format(counter_name))
             return False
@@ -6957,17 +7058,55 @@ def noise(sigma, sum_of_sq, p_exit):
     returns a floating-point value between +sigma and -sigma, scaled by
     noise_weight
     '''
-    sigma_i = p_exit * sigma / sqrt(sum_of_sq)
+    return noise_list([sigma], sum_of_sq, p_exit)[0]
+
+def noise_list(sigmas, sum_of_sq, p_exit):
+    '''
+    Sample noise for each sigma in sigmas, like noise()
+    returns a list of floating-point values, one for each sigma
+    '''
+    scale = p_exit / sqrt(sum_of_sq)
+    return [scale * sigma * random_sample
+            for (sigma, random_sample) in izip(sigmas,
+                                               gauss_list(len(sigmas)))]
+
+# The number of random bits in each gauss_list() uniform value
+GAUSS_UNIFORM_BITS = 53
+GAUSS_UNIFORM_SCALE = 1.0 / 2.0**GAUSS_UNIFORM_BITS
+GAUSS_UNIFORM_PAIRS = struct.Struct('<2Q')
+
+def gauss_list(count):
+    '''
+    Sample count values from the standard normal distribution, using the
+    Box-Muller transform on uniform values from one block of os.urandom()
+    returns a list of count floating-point values
+    '''
     # the noise needs to be cryptographically secure, because knowing the RNG
     # state could allow an adversary to remove the noise
-    random_sample = SystemRandom().gauss(0, sigma_i)
-    return random_sample
-
-def sample(modulus):
+    pair_count = (count + 1) // 2
+    random_bytes = urandom(GAUSS_UNIFORM_PAIRS.size * pair_count)
+    # discard the low bits, so each value is exactly representable as a float
+    shift = 64 - GAUSS_UNIFORM_BITS
+    values = []
+    for i in xrange(pair_count):
+        (v1, v2) = GAUSS_UNIFORM_PAIRS.unpack_from(random_bytes,
+                                                   i * GAUSS_UNIFORM_PAIRS.size)
+        # u1 is in (0, 1], so log(u1) is always finite
+        u1 = 1.0 - (v1 >> shift) * GAUSS_UNIFORM_SCALE
+        u2 = (v2 >> shift) * GAUSS_UNIFORM_SCALE
+        radius = sqrt(-2.0 * log(u1))
+        theta = 2.0 * pi * u2
+        values.append(radius * cos(theta))
+        values.append(radius * sin(theta))
+    return values[:count]
+
+def sample_values(get_bytes, modulus, count):
     '''
-    Sample a uniformly distributed value from the SystemRandom CSPRNG
-    (uses rejection sampling to avoid bias)
-    returns a long uniformly distributed in [0, modulus)
+    Sample count values uniformly distributed in [0, modulus), using
+    get_bytes(N) as the source of N random bytes
+    (uses rejection sampling to avoid bias: rejected values are replaced
+    using another block of bytes)
+    returns a list of longs uniformly distributed in [0, modulus)
     '''
     # sanitise input
     modulus = long(modulus)
@@ -6980,16 +7119,39 @@ def sample(modulus):
     # check the bit count is sane
     assert modulus <= 2L**sample_bit_count
     assert modulus >= 2L**(sample_bit_count-1)
+    sample_byte_count = (sample_bit_count + 7) // 8
+    sample_mask = 2L**sample_bit_count - 1L
+    values = []
     ## Unbiased sampling through rejection sampling
-    while True:
-        # sample that many bits
-        v = SystemRandom().getrandbits(sample_bit_count)
-        assert v >= 0
-        assert v < 2L**sample_bit_count
-        # the maximum rejection rate is 1 in 2, when modulus is 2**N + 1
-        if 0L <= v < modulus:
-            break
-    return v
+    while len(values) < count:
+        # get enough bytes for the remaining values
+        # the maximum rejection rate is 1 in 2, when modulus is 2**N + 1,
+        # so this loop usually runs once or twice
+        needed = count - len(values)
+        random_bytes = get_bytes(needed * sample_byte_count)
+        assert len(random_bytes) == needed * sample_byte_count
+        for i in xrange(0, len(random_bytes), sample_byte_count):
+            # sample that many bits
+            v = (long(hexlify(random_bytes[i:i+sample_byte_count]), 16) &
+                 sample_mask)
+            if v < modulus:
+                values.append(v)
+    return values
+
+def sample_list(modulus, count):
+    '''
+    Sample count values from one block of os.urandom(), like sample()
+    returns a list of longs uniformly distributed in [0, modulus)
+    '''
+    return sample_values(urandom, modulus, count)
+
+def sample(modulus):
+    '''
+    Sample a uniformly distributed value from the os.urandom() CSPRNG
+    (uses rejection sampling to avoid bias)
+    returns a long uniformly distributed in [0, modulus)
+    '''
+    return sample_list(modulus, 1)[0]
 
 def sample_randint(a, b):
     """
@@ -6997,6 +7159,49 @@ def sample_randint(a, b):
     """
     return a + sample(b - a + 1)
 
+# The unique hash prefix for blinding seed expansion
+BLINDING_SEED_PREFIX = 'PrivCountBlindingSeed'
+
+def expand_blinding_seed(seed, counter_name, modulus, bin_count):
+    '''
+    Deterministically expand the secret seed into bin_count blinding factors
+    for counter_name, using a PRF keystream
+    Each counter uses a separate keystream, so its factors do not depend on
+    any other counters
+    (uses rejection sampling to avoid bias, like sample())
+    returns a list of longs uniformly distributed in [0, modulus)
+    '''
+    keystream = get_prf_keystream(seed, BLINDING_SEED_PREFIX, counter_name)
+    return sample_values(lambda byte_count: keystream.update('\0'*byte_count),
+                         modulus, bin_count)
+
+def packed_count_length(modulus):
+    '''
+    Return the number of bytes in each count packed by pack_counts()
+    '''
+    return max(((long(modulus) - 1L).bit_length() + 7) // 8, 1)
+
+def pack_counts(counts, modulus):
+    '''
+    Pack the flat list counts, which are all in [0, modulus), into a compact
+    binary string, using packed_count_length(modulus) big-endian bytes for
+    each count
+    '''
+    hex_format = '{{:0{}x}}'.format(2*packed_count_length(modulus))
+    return unhexlify(''.join(hex_format.format(count) for count in counts))
+
+def unpack_counts(packed, modulus):
+    '''
+    Unpack a binary string packed by pack_counts()
+    Returns a flat list of longs, or None if packed is not a valid length
+    '''
+    hex_length = 2*packed_count_length(modulus)
+    packed = hexlify(packed)
+    if len(packed) % hex_length != 0:
+        return None
+    return [long(packed[i:i+hex_length], 16)
+            for i in xrange(0, len(packed), hex_length)]
+
 def derive_blinding_factor(secret, modulus, positive=True):
     '''
     Calculate a blinding factor less than modulus, based on secret
@@ -7077,6 +7282,295 @@ def adjust_count_signed(count, modulus):
         assert signed_count <= modulus//2L - 1L
     return signed_count
 
+def adjust_counts_signed(counts, modulus):
+    '''
+    Adjust each unsigned 0 <= count < modulus in the list counts, returning a
+    list of signed integers
+    Has the same results as calling adjust_count_signed() on each count, but
+    only performs the sanity checks once for the entire list
+    '''
+    # sanitise input
+    modulus = long(modulus)
+    if len(counts) == 0:
+        return []
+    # sanity check input
+    assert max(counts) < modulus
+    # see adjust_count_signed() for an explanation of this adjustment
+    half_modulus = (modulus + 1L) // 2L
+    signed_counts = [count - modulus if count >= half_modulus else count
+                     for count in counts]
+    # sanity check output
+    assert min(signed_counts) >= -modulus//2L
+    if modulus % 2L == 1L:
+        # odd case
+        assert max(signed_counts) <= modulus//2L
+    else:
+        # even case
+        assert max(signed_counts) <= modulus//2L - 1L
+    return signed_counts
+
+class CounterBinIndex(object):
+    '''
+    A compiled lookup index for the bins of a single counter.
+    Finds the bins that contain a value without scanning every bin.
+    Bins are compiled into one of these layouts:
+    - single: the counter has exactly one bin, which is looked up using
+      SecureCounters.SINGLE_BIN,
+    - list: the bins are [0, 1], [1, 2], ... , [N-1, N or inf], as used by
+      the match list CountList counters, and are looked up in O(1),
+    - sorted: the bins are non-overlapping, and are looked up in O(log B)
+      using a binary search on the sorted lower bin edges,
+    - overlapping: the bins overlap, so every bin must be checked.
+    (check_bins_config() rejects overlapping bins, but SecureCounters does
+    not require counters to be checked, so we retain the original
+    behaviour.)
+    '''
+
+    # The bin layouts
+    SINGLE = 'single'
+    LIST = 'list'
+    SORTED = 'sorted'
+    OVERLAPPING = 'overlapping'
+
+    # The result when no bins match
+    NO_POSITIONS = ()
+
+    def __init__(self, bins, offset=0, counter_name=None):
+        '''
+        Compile bins, a list of [bin_min, bin_max, ...] lists.
+        Only the bin edges are used: any counts are ignored.
+        The positions returned by find_positions() start at offset.
+        counter_name is used in log messages.
+        '''
+        bin_count = len(bins)
+        assert bin_count > 0
+        self.offset = offset
+        self.counter_name = counter_name
+        # make everything float for consistent comparisons
+        edges = [(float(item[0]), float(item[1])) for item in bins]
+        # a tuple for each possible result, so lookups don't allocate
+        self.position_tuples = [(offset + i,) for i in xrange(bin_count)]
+
+        # Does this counter have a single bin?
+        self.is_single = (bin_count == 1)
+        if self.is_single:
+            self.layout = CounterBinIndex.SINGLE
+            # SecureCounters.increment() has always looked up 1.0 in single
+            # bin counters
+            (bin_min, bin_max) = edges[0]
+            if SecureCounters.is_in_bin(bin_min, bin_max, 1.0):
+                self.single_positions = self.position_tuples[0]
+            else:
+                self.single_positions = CounterBinIndex.NO_POSITIONS
+            return
+
+        order = sorted(xrange(bin_count), key=lambda i: edges[i])
+        self.lower_edges = [edges[i][0] for i in order]
+        self.upper_edges = [edges[i][1] for i in order]
+        self.sorted_positions = [self.position_tuples[i] for i in order]
+
+        is_overlapping = False
+        for i in xrange(1, bin_count):
+            # the same checks as check_bins_config()
+            if (self.lower_edges[i-1] == self.lower_edges[i] or
+                self.upper_edges[i-1] > self.lower_edges[i]):
+                is_overlapping = True
+                break
+
+        if is_overlapping:
+            self.layout = CounterBinIndex.OVERLAPPING
+            self.edges = edges
+        elif CounterBinIndex._is_list_layout(self.lower_edges,
+                                             self.upper_edges):
+            self.layout = CounterBinIndex.LIST
+            # the final bin can be inf
+            self.list_max = self.upper_edges[-1]
+        else:
+            self.layout = CounterBinIndex.SORTED
+
+    @staticmethod
+    def _is_list_layout(lower_edges, upper_edges):
+        '''
+        Are the sorted bins [0, 1], [1, 2], ... , [N-1, N or inf]?
+        '''
+        bin_count = len(lower_edges)
+        for i in xrange(bin_count):
+            if lower_edges[i] != float(i):
+                return False
+            if i < bin_count - 1 and upper_edges[i] != float(i + 1):
+                return False
+        return (upper_edges[-1] == float(bin_count) or
+                upper_edges[-1] == float('inf'))
+
+    def find_positions(self, bin_value):
+        '''
+        Return a tuple containing the position (plus offset) of each bin that
+        contains bin_value, using the same rules as SecureCounters.is_in_bin().
+        bin_value must be a float, and is ignored for single bin counters.
+        The returned tuple must be treated as read-only.
+        '''
+        layout = self.layout
+        if layout == CounterBinIndex.SINGLE:
+            return self.single_positions
+        # nan is never in any bin
+        if bin_value != bin_value:
+            return CounterBinIndex.NO_POSITIONS
+        if layout == CounterBinIndex.LIST:
+            if bin_value < 0.0:
+                return CounterBinIndex.NO_POSITIONS
+            if bin_value < self.list_max:
+                # the final bin may be inf, so we cap the position
+                i = min(int(bin_value), len(self.position_tuples) - 1)
+                return self.position_tuples[i]
+            if self.list_max == float('inf'):
+                return self.position_tuples[-1]
+            return CounterBinIndex.NO_POSITIONS
+        elif layout == CounterBinIndex.SORTED:
+            # find the bin with the largest lower edge <= bin_value
+            i = bisect.bisect_right(self.lower_edges, bin_value) - 1
+            if i < 0:
+                return CounterBinIndex.NO_POSITIONS
+            bin_max = self.upper_edges[i]
+            # any value is <= inf, so we don't need to check if bin_value is
+            # inf
+            if bin_value < bin_max or bin_max == float('inf'):
+                return self.sorted_positions[i]
+            return CounterBinIndex.NO_POSITIONS
+        else:
+            return tuple([self.offset + i for i in xrange(len(self.edges))
+                          if SecureCounters.is_in_bin(self.edges[i][0],
+                                                      self.edges[i][1],
+                                                      bin_value)])
+
+class CounterLayout(object):
+    '''
+    Stores the bins of every counter in a single flat list of counts.
+    Each counter's bins occupy a contiguous range of positions in the list,
+    and counters are laid out in sorted name order.
+    Converts between flat lists of counts and the counters format:
+    {
+      'ExampleHistogram': {
+        'bins':
+        [
+          [0.0, 512.0, count],
+          [512.0, float('inf'), count],
+        ],
+        'sigma': 2090007.68996
+      },
+      ...
+    }
+    which is used in config files, on the wire, and in results files.
+    '''
+
+    def __init__(self, counters):
+        '''
+        deepcopy the bins and other values of each counter in counters
+        '''
+        self.names = sorted(counters.keys())
+        # name -> (start, end) for the counter's slice of the flat list
+        self.offsets = {}
+        # name -> list of [bin_min, bin_max] for each bin
+        self.bins = {}
+        # name -> dict of other keys and values, like sigma
+        self.values = {}
+        offset = 0
+        for key in self.names:
+            assert('bins' in counters[key])
+            self.bins[key] = []
+            for item in counters[key]['bins']:
+                # bin is, e.g.: [0.0, 512.0] for bin_left, bin_right
+                assert len(item) == 2
+                self.bins[key].append([item[0], item[1]])
+            self.values[key] = {}
+            for subkey in counters[key]:
+                if subkey != 'bins':
+                    self.values[key][subkey] = counters[key][subkey]
+            bin_count = len(self.bins[key])
+            self.offsets[key] = (offset, offset + bin_count)
+            offset += bin_count
+        self.bin_count = offset
+        # deepcopy all the values at once, it's much faster
+        self.values = deepcopy(self.values)
+        # the number of bins in each counter, in layout order
+        self.bin_lengths = [len(self.bins[key]) for key in self.names]
+
+    def zero_counts(self):
+        '''
+        Return a flat list of zero counts, one for each bin
+        counters use unlimited length integers to avoid overflow
+        '''
+        return [0L]*self.bin_count
+
+    def digest(self):
+        '''
+        Return a hex digest of the counter names and bin counts in this
+        layout
+        '''
+        return sha256(json_serialise([[key, len(self.bins[key])]
+                                      for key in self.names])).hexdigest()
+
+    def expand_blinding_seed(self, seed, modulus):
+        '''
+        Return a flat list of blinding factors expanded from seed, one for
+        each bin
+        '''
+        factors = []
+        for key in self.names:
+            (start, end) = self.offsets[key]
+            factors.extend(expand_blinding_seed(seed, key, modulus,
+                                                end - start))
+        return factors
+
+    def bin_sigmas(self):
+        '''
+        Return a flat list containing the sigma of the counter for each bin
+        '''
+        sigmas = []
+        for key in self.names:
+            (start, end) = self.offsets[key]
+            sigmas.extend([self.values[key]['sigma']]*(end - start))
+        return sigmas
+
+    def to_counters(self, counts):
+        '''
+        Convert the flat list counts to the counters format
+        '''
+        assert len(counts) == self.bin_count
+        counters = deepcopy(self.values)
+        for key in self.names:
+            (start, end) = self.offsets[key]
+            counters[key]['bins'] = [[item[0], item[1], count]
+                                     for (item, count)
+                                     in izip(self.bins[key],
+                                             counts[start:end])]
+        return counters
+
+    def from_counters(self, counters):
+        '''
+        Check that the keys and bins in counters match this layout
+        Also check that each bin has a count.
+        If these checks pass, return a flat list of the counts, converted to
+        long. Otherwise, return None.
+        Keys in counters that are not in this layout are ignored.
+        '''
+        # a counter with no bins can never match
+        if 0 in self.bin_lengths:
+            return None
+        # these checks and conversions are performed on every counter from
+        # every client, so they are written as a few bulk operations
+        try:
+            # disregard sigma, it's only required at the data collectors
+            bin_lengths = [len(counters[key]['bins']) for key in self.names]
+            if bin_lengths != self.bin_lengths:
+                return None
+            # each bin must be [bin_min, bin_max, count]
+            counts = [count
+                      for key in self.names
+                      for (_, _, count) in counters[key]['bins']]
+        except (KeyError, TypeError, ValueError):
+            return None
+        return map(long, counts)
+
 class SecureCounters(object):
     '''
     securely count any number of labels
@@ -7134,121 +7628,172 @@ class SecureCounters(object):
 
     def __init__(self, counters, modulus, require_generate_noise=True):
         '''
-        deepcopy counters and initialise each counter to 0L
+        deepcopy the counter config into a CounterLayout, and initialise the
+        count for each bin to 0L
         cast modulus to long and store it
         If require_generate_noise is True, assert if we did not add noise
         before detaching the counters
         '''
-        self.counters = deepcopy(counters)
+        self.layout = CounterLayout(counters)
         self.modulus = long(modulus)
         self.shares = None
         self.is_noise_pending = require_generate_noise
 
-        # initialize all counters to 0L
-        # counters use unlimited length integers to avoid overflow
-        for key in self.counters:
-            assert('bins' in self.counters[key])
-            for item in self.counters[key]['bins']:
-                assert len(item) == 2
-                # bin is now, e.g.: [0.0, 512.0, 0L] for bin_left, bin_right,
-                # count
-                item.append(0L)
+        # the counts for every bin of every counter, in layout order
+        self.counts = self.layout.zero_counts()
 
-        # take a copy of the zeroed counters to use when generating blinding
-        # factors
-        self.zero_counters = deepcopy(self.counters)
+        # compile the bins, so that increment() doesn't have to scan them
+        self.bin_indexes = {}
+        for key in self.layout.names:
+            (start, _) = self.layout.offsets[key]
+            self.bin_indexes[key] = CounterBinIndex(self.layout.bins[key],
+                                                    offset=start,
+                                                    counter_name=key)
 
-    def _check_counter(self, counter):
+    @property
+    def counters(self):
         '''
-        Check that the keys and bins in counter match self.counters
-        Also check that each bin has a count.
-        If these checks pass, return True. Otherwise, return False.
+        The current counts in the counters format, or None if the counts
+        have been detached.
+        Each access creates a new copy of the counters: modifying it does not
+        change the counts.
         '''
-        for key in self.counters:
-            if key not in counter:
-                return False
-            # disregard sigma, it's only required at the data collectors
-            if 'bins' not in counter[key]:
-                return False
-            num_bins = len(self.counters[key]['bins'])
-            if num_bins == 0:
-                return False
-            if num_bins != len(counter[key]['bins']):
-                return False
-            for i in xrange(num_bins):
-                tally_item = counter[key]['bins'][i]
-                if len(tally_item) != 3:
-                    return False
-        return True
+        if self.counts is None:
+            return None
+        return self.layout.to_counters(self.counts)
 
-    def _derive_all_counters(self, blinding_factors, positive):
+    def _derive_all_counts(self, blinding_factors, positive):
         '''
-        If blinding_factors is None, generate and apply a counters structure
+        If blinding_factors is None, generate and apply a flat list
         containing uniformly random blinding factors.
-        Otherwise, apply the passed blinding factors.
+        Otherwise, apply the passed flat list of blinding factors.
         If positive is True, apply blinding factors. Otherwise, apply
         unblinding factors.
-        Returns the applied (un)blinding factors, or None on error.
+        Returns a flat list of the applied (un)blinding factors.
         '''
-        # if there are no blinding_factors, initialise them to zero
-        generate_factors = False
         if blinding_factors is None:
-            blinding_factors = deepcopy(self.zero_counters)
-            generate_factors = True
-
-        # validate that the counter data structures match
-        if not self._check_counter(blinding_factors):
-            return None
+            # sample every blinding factor at once
+            blinding_factors = sample_list(self.modulus,
+                                           self.layout.bin_count)
 
         # determine the blinding factors
-        for key in blinding_factors:
-            for item in blinding_factors[key]['bins']:
-                if generate_factors:
-                    original_factor = None
-                else:
-                    original_factor = long(item[2])
-                blinding_factor = derive_blinding_factor(original_factor,
-                                                         self.modulus,
-                                                         positive=positive)
-                item[2] = blinding_factor
+        applied_factors = [derive_blinding_factor(original_factor,
+                                                  self.modulus,
+                                                  positive=positive)
+                           for original_factor in blinding_factors]
 
         # add the blinding factors to the counters
-        self._tally_counter(blinding_factors)
+        self._tally_counts(applied_factors)
 
         # return the applied blinding factors
-        return blinding_factors
+        return applied_factors
+
+    # Seed blinding shares look like:
+    # { BLINDING_SEED_KEY : b64seed, LAYOUT_DIGEST_KEY : CounterLayout.digest() }
+    BLINDING_SEED_KEY = 'blinding_seed'
+    LAYOUT_DIGEST_KEY = 'layout_digest'
+    # Compact blinding shares look like:
+    # { BLINDING_COUNTS_KEY : b64(pack_counts(factors)),
+    #   LAYOUT_DIGEST_KEY : CounterLayout.digest() }
+    BLINDING_COUNTS_KEY = 'blinding_counts'
 
-    def _blind(self):
+    @staticmethod
+    def is_blinding_seed(blinding_factors):
+        '''
+        Is blinding_factors a seed blinding share?
+        '''
+        return (isinstance(blinding_factors, dict) and
+                SecureCounters.BLINDING_SEED_KEY in blinding_factors)
+
+    @staticmethod
+    def is_blinding_counts(blinding_factors):
+        '''
+        Is blinding_factors a compact blinding share?
+        '''
+        return (isinstance(blinding_factors, dict) and
+                SecureCounters.BLINDING_COUNTS_KEY in blinding_factors)
+
+    def _blind(self, use_seed=False, compact=False):
         '''
         Generate and apply a counters structure containing uniformly random
         blinding factors.
-        Returns the generated blinding factors.
+        Returns the generated blinding factors, in the counters format.
+        If use_seed is True, expand the blinding factors from a new random
+        seed, and return the seed and the layout digest instead.
+        Otherwise, if compact is True, return the packed blinding factors and
+        the layout digest.
         '''
-        generated_counters = self._derive_all_counters(None, True)
-        # since we generate blinding factors based on our own inputs, a
-        # failure here is a programming bug
-        assert generated_counters is not None
-        return generated_counters
+        if use_seed:
+            seed = generate_prf_seed()
+            self._derive_all_counts(self.layout.expand_blinding_seed(
+                                        seed, self.modulus),
+                                    True)
+            return { SecureCounters.BLINDING_SEED_KEY : b64encode(seed),
+                     SecureCounters.LAYOUT_DIGEST_KEY : self.layout.digest() }
+        generated_counts = self._derive_all_counts(None, True)
+        if compact:
+            return { SecureCounters.BLINDING_COUNTS_KEY :
+                         b64encode(pack_counts(generated_counts, self.modulus)),
+                     SecureCounters.LAYOUT_DIGEST_KEY : self.layout.digest() }
+        return self.layout.to_counters(generated_counts)
 
     def _unblind(self, blinding_factors):
         '''
-        Generate unblinding factors from blinding_factors, and apply them to
-        self.counters.
-        Returns the applied unblinding factors.
+        Generate unblinding factors from blinding_factors, which is in the
+        counters format, and apply them to self.counts.
+        Returns a flat list of the applied unblinding factors, or None on
+        error.
         '''
         # since we generate unblinding factors based on network input, a
         # failure here should be logged, and the counters ignored
-        return self._derive_all_counters(blinding_factors, False)
+        blinding_counts = self.blinding_share_counts(blinding_factors)
+        if blinding_counts is None:
+            return None
+        return self._derive_all_counts(blinding_counts, False)
+
+    def blinding_share_counts(self, blinding_factors):
+        '''
+        Return a flat list of the blinding factors in blinding_factors, which
+        is in the counters format, or is a seed blinding share.
+        Returns None if blinding_factors does not match our counters.
+        Does not modify this object, so it is safe to call from multiple
+        threads.
+        '''
+        if (SecureCounters.is_blinding_seed(blinding_factors) or
+            SecureCounters.is_blinding_counts(blinding_factors)):
+            # seeds and packed counts only work if both sides have the same
+            # layout
+            if (blinding_factors.get(SecureCounters.LAYOUT_DIGEST_KEY) !=
+                self.layout.digest()):
+                return None
+        if SecureCounters.is_blinding_seed(blinding_factors):
+            seed = b64decode(blinding_factors[SecureCounters.BLINDING_SEED_KEY])
+            return self.layout.expand_blinding_seed(seed, self.modulus)
+        elif SecureCounters.is_blinding_counts(blinding_factors):
+            blinding_counts = unpack_counts(
+                b64decode(blinding_factors[SecureCounters.BLINDING_COUNTS_KEY]),
+                self.modulus)
+            if (blinding_counts is None or
+                len(blinding_counts) != self.layout.bin_count):
+                return None
+            return blinding_counts
+        else:
+            return self.layout.from_counters(blinding_factors)
 
-    def generate_blinding_shares(self, uids):
+    def generate_blinding_shares(self, uids, use_seeds=False, compact=False):
         '''
         Generate and apply blinding factors for each counter and share keeper
         uid.
+        If use_seeds is True, each share is a short random seed, which the
+        share keeper expands into the same blinding factors.
+        Otherwise, if compact is True, each share contains the packed
+        blinding factors, rather than the counters format.
         '''
         self.shares = {}
         for uid in uids:
             # add blinding factors to all of the counters
-            blinding_factors = self._blind()
+            blinding_factors = self._blind(use_seed=use_seeds,
+                                           compact=compact)
             # the caller can add additional annotations to this dictionary
             self.shares[uid] = {'secret': blinding_factors, 'sk_uid': uid}
 
@@ -7256,19 +7801,16 @@ class SecureCounters(object):
         '''
         Generate and apply noise for each counter.
         '''
-        # generate noise for each counter independently
-        noise_values = deepcopy(self.zero_counters)
-        for key in noise_values:
-            for item in noise_values[key]['bins']:
-                sigma = noise_values[key]['sigma']
-                sampled_noise = noise(sigma, 1, noise_weight)
-                # exact halfway values are rounded towards even integers
-                # values over 2**53 are not integer-accurate
-                # but we don't care, because it's just noise
-                item[2] = long(round(sampled_noise))
+        # generate noise for each bin independently
+        # exact halfway values are rounded towards even integers
+        # values over 2**53 are not integer-accurate
+        # but we don't care, because it's just noise
+        noise_values = [long(round(noise_value))
+                        for noise_value in noise_list(self.layout.bin_sigmas(),
+                                                      1, noise_weight)]
 
         # add the noise to each counter
-        self._tally_counter(noise_values)
+        self._tally_counts(noise_values)
         self.is_noise_pending = False
 
     def detach_blinding_shares(self):
@@ -7298,6 +7840,22 @@ class SecureCounters(object):
             return False
         return True
 
+    def import_blinding_share_counts(self, blinding_counts_list):
+        '''
+        Sum the flat lists of blinding factors in blinding_counts_list, which
+        were returned by blinding_share_counts(), and apply the unblinding
+        factors for the sum to all of the counters.
+        This has the same result as calling import_blinding_share() on each
+        share, but it only applies one set of unblinding factors.
+        '''
+        if len(blinding_counts_list) == 0:
+            return
+        for blinding_counts in blinding_counts_list:
+            assert len(blinding_counts) == self.layout.bin_count
+        modulus = self.modulus
+        blinding_sums = [sum(bin_counts) % modulus
+                         for bin_counts in izip(*blinding_counts_list)]
+        self._derive_all_counts(blinding_sums, False)
 
     SINGLE_BIN = float('nan')
     '''
@@ -7329,10 +7887,21 @@ class SecureCounters(object):
                 return True
         return False
 
+    def get_bin_index(self, counter_name):
+        '''
+        Return the compiled CounterBinIndex for counter_name, or None if
+        counter_name is not one of our counters.
+        The returned index can be passed to increment_bin_index(), which is
+        faster than increment() when the same counter is incremented many
+        times.
+        '''
+        return self.bin_indexes.get(counter_name)
+
     def increment(self, counter_name, bin=SINGLE_BIN, inc=1):
         '''
         Increment a bin in counter counter_name by inc.
-        Uses is_in_bin() to work out which bin to increment.
+        Uses the compiled CounterBinIndex to work out which bin to increment.
+        (The bins are the same as those found by is_in_bin().)
         Example:
             secure_counters.increment('ExampleHistogram',
                                       bin=25,
@@ -7344,67 +7913,118 @@ class SecureCounters(object):
                                       bin=SINGLE_BIN,
                                       inc=1)
         '''
-        if self.counters is not None and counter_name in self.counters:
-            # check that we have the right types, and that we're not losing
-            # precision
-            bin = float(bin)
+        bin_index = self.bin_indexes.get(counter_name)
+        if bin_index is None:
+            return
+        self.increment_bin_index(bin_index, bin=bin, inc=inc)
+
+    def increment_bin_index(self, bin_index, bin=SINGLE_BIN, inc=1):
+        '''
+        Increment a bin in the counter for bin_index by inc.
+        bin_index must have been returned by get_bin_index() on this object.
+        See increment() for details.
+        '''
+        if self.counts is None:
+            return
+        # check that we have the right types, and that we're not losing
+        # precision
+        bin = float(bin)
+        if not isinstance(inc, (int, long)):
             if float(inc) != float(int(inc)):
                 logging.warning("Ignoring fractional part of counter {} bin {} increment {}: {}"
-                                .format(counter_name, bin, inc,
+                                .format(bin_index.counter_name, bin, inc,
                                         float(inc) - float(int(inc))))
                 assert float(inc) == float(int(inc))
             inc = int(inc)
-            # You must pass SINGLE_BIN if counter_name is a single bin
-            if len(self.counters[counter_name]['bins']) == 1:
-                assert(SecureCounters.is_single_bin_value(bin))
-                bin = 1.0
-            else:
-                assert(not SecureCounters.is_single_bin_value(bin))
-                bin = float(bin)
-            for item in self.counters[counter_name]['bins']:
-                if SecureCounters.is_in_bin(item[0], item[1], bin):
-                    item[2] = ((int(item[2]) + int(inc))
-                               % self.modulus)
+        # You must pass SINGLE_BIN if counter_name is a single bin
+        assert (bin_index.is_single ==
+                SecureCounters.is_single_bin_value(bin))
+        counts = self.counts
+        modulus = self.modulus
+        # counts are always stored as integers
+        for i in bin_index.find_positions(bin):
+            counts[i] = (counts[i] + inc) % modulus
+
+    def _tally_counts(self, counts):
+        '''
+        Add the flat list counts to self.counts, modulo self.modulus.
+        counts must use the same layout as self.counts.
+        '''
+        assert len(counts) == len(self.counts)
+        modulus = self.modulus
+        self.counts = [(tally_count + count) % modulus
+                       for (tally_count, count) in izip(self.counts, counts)]
+
+    def add_counts(self, counts):
+        '''
+        Add the flat list counts to our counts, modulo the counter modulus.
+        counts must be the counts from a SecureCounters with the same
+        counters, like an aggregator shard.
+        '''
+        assert self.counts is not None
+        self._tally_counts(counts)
 
     def _tally_counter(self, counter):
-        if self.counters == None:
+        '''
+        Add counter, which is in the counters format, to self.counts.
+        Returns True on success, and False if the counters are detached, or
+        counter does not match the configured counters.
+        '''
+        if self.counts is None:
             return False
 
         # validate that the counter data structures match
-        if not self._check_counter(counter):
+        counts = self.layout.from_counters(counter)
+        if counts is None:
             return False
 
         # ok, the counters match
-        for key in self.counters:
-            num_bins = len(self.counters[key]['bins'])
-            for i in xrange(num_bins):
-                tally_bin = self.counters[key]['bins'][i]
-                tally_bin[2] = ((long(tally_bin[2]) +
-                                 long(counter[key]['bins'][i][2]))
-                                % self.modulus)
+        self._tally_counts(counts)
 
         # success
         return True
 
     def tally_counters(self, counters):
-        # first add up all of the counters together
+        '''
+        Add the list of counters, which are in the counters format, to
+        self.counts. Then adjust the tallies so they can be negative.
+        Returns True on success, and False if the counters are detached, or
+        any counter does not match the configured counters.
+        '''
+        if self.counts is None:
+            return False
+
+        # validate and convert all the counters before adding any of them
+        count_lists = [self.counts]
         for counter in counters:
-            if not self._tally_counter(counter):
+            counts = self.layout.from_counters(counter)
+            if counts is None:
                 return False
+            count_lists.append(counts)
+
+        # add up each bin across all the counters, and reduce it once
+        # sum() adds unlimited length integers much faster than adding and
+        # reducing one counter at a time
+        modulus = self.modulus
+        tallies = [sum(bin_counts) % modulus
+                   for bin_counts in izip(*count_lists)]
+
         # now adjust so our tally can register negative counts
         # (negative counts are possible if noise is negative)
-        for key in self.counters:
-            for tally_bin in self.counters[key]['bins']:
-                tally_bin[2] = adjust_count_signed(tally_bin[2], self.modulus)
+        self.counts = adjust_counts_signed(tallies, modulus)
         return True
 
     def detach_counts(self):
         '''
         Asserts if we needed to add noise, and didn't add it
+        Returns the counts in the counters format
         '''
         assert not self.is_noise_pending
-        counts = self.counters
-        self.counters = None
+        if self.counts is None:
+            return None
+        counts = self.layout.to_counters(self.counts)
+        # TODO: secure delete
+        self.counts = None
         return counts
 
 
@@ -12,8 +12,10 @@ import uuid
 import json
 
 from math import ceil
+from os import urandom
 from time import time
 from base64 import b64encode, b64decode
+from binascii import unhexlify
 
 from hashlib import sha256 as DigestHash
 # encryption using SHA256 requires cryptography >= 1.4
@@ -24,6 +26,7 @@ from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization, hashes, hmac
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.exceptions import UnsupportedAlgorithm, InvalidSignature
 
 def load_private_key_string(key_string):
@@ -99,6 +102,31 @@ def verify_hmac(expected_result, secret_key, unique_prefix, data):
     except InvalidSignature:
         return False
 
+# The number of bytes in a secret PRF seed
+PRF_SEED_BYTES = CryptoHash.digest_size
+
+def generate_prf_seed():
+    '''
+    Return a new random secret seed for get_prf_keystream().
+    '''
+    return urandom(PRF_SEED_BYTES)
+
+def get_prf_keystream(seed, unique_prefix, data):
+    '''
+    Return a pseudorandom keystream derived from the secret seed, unique hash
+    prefix, and data. The same inputs always produce the same keystream.
+    The keystream is AES-256-CTR, keyed with
+    HMAC-SHA256(seed, unique_prefix | data), with an all-zero nonce. (Each
+    key is only used for one keystream, so the nonce does not need to be
+    unique.)
+    Call keystream.update('\0'*N) to get the next N keystream bytes.
+    '''
+    key = get_hmac(seed, unique_prefix, data)
+    cipher = Cipher(algorithms.AES(key),
+                    modes.CTR('\0'*(algorithms.AES.block_size/8)),
+                    backend=default_backend())
+    return cipher.encryptor()
+
 def b64_raw_length(byte_count):
     '''
     Note: base64.b64encode returns b64_padded_length bytes of output.
@@ -134,6 +162,38 @@ def json_serialise(obj):
     # avoid spaces, because they are meaningless bytes
     return json.dumps(obj, separators=(',', ':'))
 
+def json_serialise_pieces(obj):
+    '''
+    Return an iterable of strings, which join to form a JSON-serialised
+    form of obj.
+    If obj is a dict or list, each item is serialised when it is needed, so
+    the whole JSON string does not have to be in memory at the same time.
+    Each item is serialised by json_serialise(), so this is almost as fast.
+    '''
+    if isinstance(obj, dict):
+        return json_serialise_container_pieces(
+            '{', '}',
+            # serialising a single-item dict converts the key, like json.dumps
+            (json_serialise({ key : value })[1:-1]
+             for (key, value) in obj.iteritems()))
+    elif isinstance(obj, (list, tuple)):
+        return json_serialise_container_pieces(
+            '[', ']', (json_serialise(item) for item in obj))
+    else:
+        return [json_serialise(obj)]
+
+def json_serialise_container_pieces(open_str, close_str, item_pieces):
+    '''
+    Yield open_str, the strings in item_pieces separated by commas, then
+    close_str.
+    '''
+    yield open_str
+    for (item_index, item_str) in enumerate(item_pieces):
+        if item_index > 0:
+            yield ','
+        yield item_str
+    yield close_str
+
 def encode_data(data_structure):
     """
     Encode an arbitrary python data structure in a format that is suitable
@@ -252,18 +312,156 @@ def decrypt_pk(priv_key, ciphertext):
         raise e
     return plaintext
 
-def encrypt(pub_key, data_structure):
+# The envelope formats used by encrypt(), and accepted by decrypt().
+# Peers advertise the envelopes they can decrypt, so that old peers still
+# get the original Fernet envelope.
+# A b64encoded Fernet token of the b64encoded json (the original format, which
+# is never advertised, and doesn't have an envelope key)
+ENVELOPE_FERNET = 'PCFERNET1'
+# A list of b64encoded AES-GCM ciphertext chunks of the json
+ENVELOPE_STREAM = 'PCSTREAM1'
+# The envelopes this version can decrypt, in order of preference
+SUPPORTED_ENVELOPES = [ENVELOPE_STREAM]
+
+# The number of plaintext bytes in each ENVELOPE_STREAM chunk
+STREAM_CHUNK_BYTES = 64*1024
+# ENVELOPE_STREAM uses AES-256
+STREAM_KEY_BYTES = 256/8
+# The length of the AES-GCM nonce, and the tag added to each chunk
+STREAM_NONCE_BYTES = 96/8
+STREAM_TAG_BYTES = 128/8
+
+def choose_envelope(peer_envelopes):
+    """
+    Return the first envelope in SUPPORTED_ENVELOPES that is also in the list
+    peer_envelopes, or ENVELOPE_FERNET if there are no common envelopes.
+    """
+    for envelope in SUPPORTED_ENVELOPES:
+        if envelope in peer_envelopes:
+            return envelope
+    return ENVELOPE_FERNET
+
+def get_stream_nonce(chunk_index, is_final):
+    """
+    Return the AES-GCM nonce for ENVELOPE_STREAM chunk chunk_index.
+    The nonce is the big-endian chunk index, and a final byte that is 1 for
+    the last chunk, and 0 for other chunks. So chunks can not be reordered,
+    and the ciphertext can not be truncated.
+    (Each key is only used for one stream, so the nonces are unique.)
+    """
+    index_hex = '{:0{}x}'.format(chunk_index, 2*(STREAM_NONCE_BYTES - 1))
+    assert len(index_hex) == 2*(STREAM_NONCE_BYTES - 1)
+    return unhexlify(index_hex) + ('\1' if is_final else '\0')
+
+def encrypt_stream_chunk(secret_key, chunk_index, is_final, plaintext):
+    """
+    Encrypt plaintext as ENVELOPE_STREAM chunk chunk_index, with the
+    AES-256-GCM secret_key.
+    Returns the b64encoded ciphertext and authentication tag.
+    """
+    nonce = get_stream_nonce(chunk_index, is_final)
+    encryptor = Cipher(algorithms.AES(secret_key), modes.GCM(nonce),
+                       backend=default_backend()).encryptor()
+    encryptor.authenticate_additional_data(ENVELOPE_STREAM)
+    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+    return b64encode(ciphertext + encryptor.tag)
+
+def encrypt_stream(secret_key, plaintext, chunk_bytes=STREAM_CHUNK_BYTES):
+    """
+    Encrypt plaintext with the AES-256-GCM secret_key, in chunks of
+    chunk_bytes bytes. plaintext is a string, or an iterable of strings,
+    like the one returned by json_serialise_pieces().
+    Each chunk is encrypted and encoded as soon as it is available, so the
+    only large copy of the data is the returned ciphertext.
+    Returns a list of b64encoded ciphertext chunks, each containing its own
+    authentication tag.
+    """
+    if isinstance(plaintext, basestring):
+        plaintext = [plaintext]
+    ciphertext_chunks = []
+    # always keep some plaintext back, so that the last chunk is encrypted
+    # as the final chunk
+    pending_pieces = []
+    pending_bytes = 0
+    for piece in plaintext:
+        pending_pieces.append(piece)
+        pending_bytes += len(piece)
+        if pending_bytes <= chunk_bytes:
+            continue
+        pending = ''.join(pending_pieces)
+        offset = 0
+        while len(pending) - offset > chunk_bytes:
+            ciphertext_chunks.append(encrypt_stream_chunk(
+                                         secret_key, len(ciphertext_chunks),
+                                         False,
+                                         pending[offset:offset + chunk_bytes]))
+            offset += chunk_bytes
+        pending_pieces = [pending[offset:]]
+        pending_bytes = len(pending_pieces[0])
+    ciphertext_chunks.append(encrypt_stream_chunk(secret_key,
+                                                  len(ciphertext_chunks),
+                                                  True,
+                                                  ''.join(pending_pieces)))
+    return ciphertext_chunks
+
+def decrypt_stream(secret_key, ciphertext_chunks):
+    """
+    Decrypt a list of ciphertext chunks produced by encrypt_stream(), using
+    the AES-256-GCM secret_key.
+    Returns the plaintext.
+    Throws an exception if secret_key or any chunk are invalid, or if the
+    chunks have been reordered or truncated.
+    """
+    if len(ciphertext_chunks) == 0:
+        raise ValueError("Stream ciphertext must have at least one chunk")
+    plaintext_chunks = []
+    for (chunk_index, chunk) in enumerate(ciphertext_chunks):
+        chunk = b64decode(chunk)
+        if len(chunk) < STREAM_TAG_BYTES:
+            raise ValueError("Stream ciphertext chunk is too short")
+        nonce = get_stream_nonce(chunk_index,
+                                 chunk_index == len(ciphertext_chunks) - 1)
+        decryptor = Cipher(algorithms.AES(secret_key),
+                           modes.GCM(nonce, chunk[-STREAM_TAG_BYTES:]),
+                           backend=default_backend()).decryptor()
+        decryptor.authenticate_additional_data(ENVELOPE_STREAM)
+        plaintext_chunks.append(
+            decryptor.update(chunk[:-STREAM_TAG_BYTES]) +
+            decryptor.finalize())
+    return ''.join(plaintext_chunks)
+
+def encrypt(pub_key, data_structure, envelope=ENVELOPE_FERNET):
     """
     Encrypt an arbitrary python data structure, using the following scheme:
-    - transform the data structure into a b64encoded json string
+    - transform the data structure into a json string
+    - if envelope is ENVELOPE_FERNET, b64encode the string
     - encrypt the string with a single-use symmetric encryption key
     - encrypt the single-use key using asymmetric encryption with pub_key
     The data structure can contain any number of nested dicts, lists, strings,
     doubles, ints, and longs.
+    If envelope is ENVELOPE_STREAM, the string is serialised and encrypted
+    in chunks using AES-GCM, which avoids Fernet's extra copies and double
+    base64 encoding.
+    Only use ENVELOPE_STREAM if the peer has advertised it: see
+    choose_envelope().
     Returns a data structure containing ciphertexts, which should be treated
     as opaque.
     Encryption failures result in an exception being raised.
     """
+    if envelope == ENVELOPE_STREAM:
+        # json_serialise produces ASCII strs, so there's no need to encode
+        # them again
+        # TODO: secure delete
+        secret_key = urandom(STREAM_KEY_BYTES)
+        sym_encrypted_chunks = encrypt_stream(
+                                   secret_key,
+                                   json_serialise_pieces(data_structure))
+        pk_encrypted_secret_key = encrypt_pk(pub_key, secret_key)
+        return { 'envelope': ENVELOPE_STREAM,
+                 'pk_encrypted_secret_key': pk_encrypted_secret_key,
+                 'sym_encrypted_chunks': sym_encrypted_chunks }
+    elif envelope != ENVELOPE_FERNET:
+        raise ValueError("Unknown encryption envelope {}".format(envelope))
     encoded_string = encode_data(data_structure)
     # TODO: secure delete
     secret_key = generate_symmetric_key()
@@ -277,14 +475,25 @@ def decrypt(priv_key, ciphertext):
     Decrypt ciphertext, yielding an arbitrary python data structure, using the
     same scheme as encrypt().
     ciphertext is a data structure produced by encrypt(), and should be
-    treated as opaque.
+    treated as opaque. Any envelope in SUPPORTED_ENVELOPES is accepted.
     Returns a python data structure.
     Decryption failures result in an exception being raised.
     """
     pk_encrypted_secret_key = ciphertext['pk_encrypted_secret_key']
-    sym_encrypted_data = ciphertext['sym_encrypted_data']
+    envelope = ciphertext.get('envelope', ENVELOPE_FERNET)
     # TODO: secure delete
     secret_key = decrypt_pk(priv_key, pk_encrypted_secret_key)
+    if envelope == ENVELOPE_STREAM:
+        if len(secret_key) != STREAM_KEY_BYTES:
+            raise ValueError("Stream key must be {} bytes"
+                             .format(STREAM_KEY_BYTES))
+        json_string = decrypt_stream(secret_key,
+                                     ciphertext['sym_encrypted_chunks'])
+        # json.loads is safe to use on untrusted data (from the network)
+        return json.loads(json_string)
+    elif envelope != ENVELOPE_FERNET:
+        raise ValueError("Unknown encryption envelope {}".format(envelope))
+    sym_encrypted_data = ciphertext['sym_encrypted_data']
     encoded_string = decrypt_symmetric(secret_key, sym_encrypted_data)
     return decode_data(encoded_string)
 
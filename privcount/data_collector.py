@@ -3,6 +3,7 @@
 import ipaddress
 import logging
 import math
+import multiprocessing
 import os
 import cPickle as pickle
 import string
@@ -10,21 +11,24 @@ import sys
 import yaml
 
 from time import time
+from array import array
 from copy import deepcopy
+from Queue import Empty
+from itertools import izip
 from base64 import b64decode
 
-from twisted.internet import task, reactor, ssl
+from twisted.internet import task, reactor, ssl, threads, defer
 from twisted.internet.protocol import ReconnectingClientFactory
 
 from privcount.config import normalise_path, choose_secret_handshake_path, validate_ip_address
 from privcount.connection import connect, disconnect, validate_connection_config, choose_a_connection, get_a_control_password
-from privcount.counter import SecureCounters, counter_modulus, add_counter_limits_to_config, combine_counters, has_noise_weight, get_noise_weight, count_bins, are_events_expected, get_valid_counters
-from privcount.crypto import get_public_digest_string, load_public_key_string, encrypt
-from privcount.log import log_error, format_delay_time_wait, format_last_event_time_since, format_elapsed_time_since, errorCallback, summarise_string
-from privcount.match import exact_match_prepare_collection, exact_match, suffix_match, ipasn_prefix_match_prepare_string, ipasn_prefix_match
+from privcount.counter import SecureCounters, counter_modulus, add_counter_limits_to_config, combine_counters, has_noise_weight, get_noise_weight, count_bins, are_events_expected, get_valid_counters, is_valid_counter, get_counters_for_events, get_connection_plain_counters, get_connection_match_counters, CLIENT_IP_COUNTERS, CONNECTION_MATCH_SUBCATEGORIES, STREAM_EVENT, CIRCUIT_EVENT, CONNECTION_EVENT, HSDIR_STORE_EVENT, HSDIR_FETCH_EVENT
+from privcount.crypto import get_public_digest_string, load_public_key_string, encrypt, choose_envelope
+from privcount.log import log_error, format_delay_time_wait, format_last_event_time_since, format_elapsed_time_since, errorCallback, summarise_string, is_debug_enabled, SampledDebugLog
+from privcount.match import exact_match_load, exact_match, ExactMatchIndex, suffix_match, suffix_match_load, ipasn_prefix_match_prepare_string, ipasn_prefix_match, SUPPORTED_MATCH_LIST_FORMATS
 from privcount.node import PrivCountClient, EXPECTED_EVENT_INTERVAL_MAX, EXPECTED_CONTROL_ESTABLISH_MAX
 from privcount.protocol import PrivCountClientProtocol, TorControlClientProtocol, get_privcount_version
-from privcount.tagged_event import parse_tagged_event, is_string_valid, is_list_valid, is_int_valid, is_flag_valid, is_float_valid, is_ip_address_valid, get_string_value, get_list_value, get_int_value, get_flag_value, get_float_value, get_ip_address_value, get_ip_address_object
+from privcount.tagged_event import parse_tagged_event, make_field_spec, are_fields_valid, STRING_FIELD, LIST_FIELD, INT_FIELD, FLAG_FIELD, FLOAT_FIELD, IP_ADDRESS_FIELD, is_string_valid, is_list_valid, is_int_valid, is_flag_valid, is_float_valid, is_ip_address_valid, get_string_value, get_list_value, get_int_value, get_flag_value, get_float_value, get_ip_address_value, get_ip_address_object
 from privcount.traffic_model import TrafficModel, check_traffic_model_config
 
 SINGLE_BIN = SecureCounters.SINGLE_BIN
@@ -46,6 +50,12 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
         self.is_aggregator_pending = False
         self.context = {}
         self.expected_aggregator_start_time = None
+        # the loaded public keys of the share keepers from the most recent
+        # round: { pub_key_b64 : (digest, public_key) }
+        self.sk_public_keys = {}
+        # the aggregator worker processes, which are started before the
+        # reactor runs, and reused for every round
+        self.worker_pool = None
 
     def buildProtocol(self, addr):
         '''
@@ -85,6 +95,12 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
             logging.critical("cannot start due to error in config file")
             return
 
+        # start the aggregator worker processes before the reactor has any
+        # threads or connections that they could inherit
+        if self.config['aggregator_worker_count'] > 0:
+            self.worker_pool = AggregatorWorkerPool(
+                                      self.config['aggregator_worker_count'])
+
         # connect to the tally server, register, and wait for commands
         self.do_checkin()
         reactor.run()
@@ -99,10 +115,12 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
             'name' : self.config['name'],
             'state' : 'active' if self.aggregator is not None else 'idle',
             'privcount_version' : get_privcount_version(),
+            'match_list_formats' : SUPPORTED_MATCH_LIST_FORMATS,
                  }
         # store the latest context, so we have it even when the aggregator goes away
         if self.aggregator is not None:
             self.context.update(self.aggregator.get_context())
+            self.aggregator.log_local_status()
         # and include the latest context values in the status
         status.update(self.context)
         return status
@@ -194,11 +212,29 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
         logging.info("checking in with TallyServer at {}:{}".format(ts_ip, ts_port))
         reactor.connectSSL(ts_ip, ts_port, self, ssl.ClientContextFactory()) # pylint: disable=E1101
 
+    def get_sk_public_key(self, pub_key_b64, sk_public_keys):
+        '''
+        Return a tuple containing the digest and loaded public key for the
+        base64-encoded share keeper public key pub_key_b64.
+        Uses the keys loaded in the previous round, and adds the key to
+        sk_public_keys.
+        '''
+        sk_key_info = self.sk_public_keys.get(pub_key_b64)
+        if sk_key_info is None:
+            pub_key_str = b64decode(pub_key_b64)
+            sk_key_info = (get_public_digest_string(pub_key_str,
+                                                    is_private_key=False),
+                           load_public_key_string(pub_key_str))
+        sk_public_keys[pub_key_b64] = sk_key_info
+        return sk_key_info
+
     def do_start(self, config):
         '''
         this is called by the protocol when we receive a command from the TS
         to start a new collection phase
         return None if failure, otherwise json will encode result
+        if the config is valid, returns a deferred that fires with the
+        result, after the shares have been encrypted
         '''
         # keep the start config to send to the TS at the end of the collection
         # deepcopy in case we make any modifications later
@@ -227,9 +263,12 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
 
         # verify that we have the public cert for each share keeper that the TS wants to use
         digest_error = False
+        # only keep the keys for the share keepers in this round
+        sk_public_keys = {}
         for sk_uid in config['sharekeepers']:
-            pub_key_str = b64decode(config['sharekeepers'][sk_uid])
-            requested_sk_digest = get_public_digest_string(pub_key_str, is_private_key=False)
+            (requested_sk_digest, _) = self.get_sk_public_key(
+                                              config['sharekeepers'][sk_uid],
+                                              sk_public_keys)
 
             if requested_sk_digest not in expected_sk_digests:
                 logging.info('we received an unexpected key for share keeper {}'.format(sk_uid))
@@ -241,6 +280,8 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
             logging.info('refusing to start collecting without required share keepers')
             return None
 
+        self.sk_public_keys = sk_public_keys
+
         # if we got a traffic model from the tally server and it passes validation,
         # then load the traffic model object that we will use during aggregation
         traffic_model_config = None
@@ -259,13 +300,23 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
                                      config.get('max_cell_events_per_circuit', -1),
                                      config.get('circuit_sample_rate', 1.0),
                                      config.get('domain_lists', []),
-                                     config.get('domain_suffixes', {}),
+                                     # older tally servers send a nested dict
+                                     config.get('domain_suffix_table',
+                                                config.get('domain_suffixes', {})),
                                      config.get('country_lists', []),
                                      config.get('as_data', {}),
                                      config.get('hsdir_store_lists', []),
                                      config.get('hsdir_fetch_lists', []),
                                      config.get('circuit_failure_lists', []),
-                                     config.get('onion_address_lists', []))
+                                     config.get('onion_address_lists', []),
+                                     debug_event_log_interval=self.config['debug_event_log_interval'],
+                                     event_queue_length=self.config['event_queue_length'],
+                                     event_batch_size=self.config['event_batch_size'],
+                                     worker_pool=self.worker_pool,
+                                     match_cache_dir=self.config['match_cache_dir'],
+                                     exact_match_index=self.config['exact_match_index'],
+                                     blinding_seeds=self.config['blinding_seeds'],
+                                     compact_blinding_shares=self.config['compact_blinding_shares'])
 
         defer_time = config['defer_time'] if 'defer_time' in config else 0.0
         logging.info("got start command from tally server, starting aggregator in {}".format(format_delay_time_wait(defer_time, 'at')))
@@ -276,16 +327,42 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
         aggregator_deferred = task.deferLater(reactor, defer_time,
                                               self._start_aggregator_deferred)
         aggregator_deferred.addErrback(errorCallback)
-        # return the generated shares now
+        # return the generated shares when they are encrypted
         shares = self.aggregator.get_shares()
         # this is a dict {sk_uid : sk_msg} for each sk
-        for sk_uid in shares:
+        sk_uids = shares.keys()
+        # Encrypting shares is slow, so we do it in the reactor thread pool,
+        # and keep responding to the tally server.
+        # (Most of the encryption happens in OpenSSL, which releases the GIL.)
+        encrypt_deferreds = []
+        for sk_uid in sk_uids:
             # add the sender's name for debugging purposes
             shares[sk_uid]['dc_name'] = self.config['name']
             # encrypt shares[sk_uid] for that sk
-            pub_key_str = b64decode(config['sharekeepers'][sk_uid])
-            sk_pub_key = load_public_key_string(pub_key_str)
-            encrypted_secret = encrypt(sk_pub_key, shares[sk_uid]['secret'])
+            (_, sk_pub_key) = self.sk_public_keys[
+                                      config['sharekeepers'][sk_uid]]
+            # older tally servers and share keepers don't send envelopes
+            envelope = choose_envelope(
+                config.get('sharekeeper_envelopes', {}).get(sk_uid, []))
+            encrypt_deferreds.append(threads.deferToThread(
+                                         encrypt, sk_pub_key,
+                                         shares[sk_uid]['secret'],
+                                         envelope))
+        # if encryption fails, the protocol stops the reactor
+        start_deferred = defer.gatherResults(encrypt_deferreds,
+                                             consumeErrors=True)
+        start_deferred.addCallback(self._set_encrypted_shares, sk_uids,
+                                   shares, dc_counters)
+        return start_deferred
+
+    def _set_encrypted_shares(self, encrypted_secrets, sk_uids, shares,
+                              dc_counters):
+        '''
+        Called when the secret in each share for the share keepers in
+        sk_uids has been encrypted into encrypted_secrets.
+        Returns the shares, with the encrypted secrets.
+        '''
+        for (sk_uid, encrypted_secret) in zip(sk_uids, encrypted_secrets):
             # TODO: secure delete
             shares[sk_uid]['secret'] = encrypted_secret
 
@@ -315,13 +392,15 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
         they may or may not want us to send back our counters
         stop the node from running
         return a dictionary containing counters (if available and wanted)
-        and the local and start configs
+        and the local and start configs, or a deferred that fires with that
+        dictionary after the events that have already been received are
+        counted
         '''
         logging.info("got command to stop collection phase")
 
-        counts = None
+        counts_deferred = None
         if self.aggregator is not None and not self.is_aggregator_pending:
-            counts = self.aggregator.stop()
+            counts_deferred = self.aggregator.stop()
 
         if self.aggregator is not None:
             # TODO: secure delete
@@ -336,7 +415,11 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
 
         self.expected_aggregator_start_time = None
 
-        return self.check_stop_config(config, counts)
+        if counts_deferred is not None:
+            counts_deferred.addCallback(
+                lambda counts: self.check_stop_config(config, counts))
+            return counts_deferred
+        return self.check_stop_config(config, None)
 
     DEFAULT_ROTATE_PERIOD = 600
 
@@ -376,6 +459,52 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
             dc_conf.setdefault('use_setconf', True)
             dc_conf['use_setconf'] = bool(dc_conf['use_setconf'])
 
+            # Data collectors log every event at debug level by default
+            dc_conf.setdefault('debug_event_log_interval', 1)
+            dc_conf['debug_event_log_interval'] = int(
+                dc_conf['debug_event_log_interval'])
+            assert dc_conf['debug_event_log_interval'] >= 1
+
+            # Events are queued, and processed in batches
+            dc_conf.setdefault('event_queue_length',
+                               TorControlClientProtocol.DEFAULT_EVENT_QUEUE_LENGTH)
+            dc_conf['event_queue_length'] = int(dc_conf['event_queue_length'])
+            assert dc_conf['event_queue_length'] >= 1
+            dc_conf.setdefault('event_batch_size',
+                               TorControlClientProtocol.DEFAULT_EVENT_BATCH_SIZE)
+            dc_conf['event_batch_size'] = int(dc_conf['event_batch_size'])
+            assert dc_conf['event_batch_size'] >= 1
+
+            # Data collectors process events in the reactor process by default
+            dc_conf.setdefault('aggregator_worker_count', 0)
+            dc_conf['aggregator_worker_count'] = int(
+                dc_conf['aggregator_worker_count'])
+            assert dc_conf['aggregator_worker_count'] >= 0
+
+            # Data collectors load compiled match lists into memory by
+            # default
+            dc_conf.setdefault('match_cache_dir', None)
+            if dc_conf['match_cache_dir'] is not None:
+                dc_conf['match_cache_dir'] = normalise_path(
+                    dc_conf['match_cache_dir'])
+
+            # Data collectors search each exact match list in turn by
+            # default
+            dc_conf.setdefault('exact_match_index', None)
+            assert dc_conf['exact_match_index'] in Aggregator.EXACT_MATCH_INDEX_TYPES
+
+            # Data collectors send every blinding factor to the share
+            # keepers by default
+            dc_conf.setdefault('blinding_seeds', False)
+            assert isinstance(dc_conf['blinding_seeds'], bool)
+            dc_conf.setdefault('compact_blinding_shares', False)
+            assert isinstance(dc_conf['compact_blinding_shares'], bool)
+
+            # Data collectors don't offer protocol extensions by default,
+            # because older tally servers reject them
+            dc_conf.setdefault('chunked_lines', False)
+            assert isinstance(dc_conf['chunked_lines'], bool)
+
             dc_conf['sigma_decrease_tolerance'] = \
                 self.get_valid_sigma_decrease_tolerance(dc_conf)
 
@@ -407,6 +536,88 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
             logging.warning("problem reading config file: missing required keys")
             log_error()
 
+class ExitCircuitStreams(object):
+    '''
+    The class and start time of each stream that has ended on an exit
+    circuit, for the legacy exit circuit counters.
+    Busy exits can have millions of open circuits, so this class uses
+    __slots__, a bytearray of stream class indexes, and an array of start
+    times.
+    '''
+
+    __slots__ = ('stream_classes', 'start_times')
+
+    # The stream classes from Aggregator._classify_port(), in index order
+    STREAM_CLASSES = ('Interactive', 'Web', 'P2P', 'OtherPort')
+    STREAM_CLASS_INDEXES = dict(zip(STREAM_CLASSES,
+                                    xrange(len(STREAM_CLASSES))))
+
+    # The approximate number of bytes used by each stream
+    STREAM_SIZE = 1 + 8
+
+    def __init__(self):
+        self.stream_classes = bytearray()
+        self.start_times = array('d')
+
+    def __len__(self):
+        '''
+        Returns the number of streams.
+        '''
+        return len(self.start_times)
+
+    def add_stream(self, stream_class, start):
+        '''
+        Add a stream of stream_class that started at start.
+        '''
+        self.stream_classes.append(
+            ExitCircuitStreams.STREAM_CLASS_INDEXES[stream_class])
+        self.start_times.append(start)
+
+    def get_stream_counts(self):
+        '''
+        Returns a dictionary containing the number of streams for each
+        stream class.
+        '''
+        counts = [0]*len(ExitCircuitStreams.STREAM_CLASSES)
+        for class_index in self.stream_classes:
+            counts[class_index] += 1
+        return dict(zip(ExitCircuitStreams.STREAM_CLASSES, counts))
+
+    def get_stream_start_times(self):
+        '''
+        Returns a dictionary containing a list of stream start times for
+        each stream class.
+        '''
+        times = [[] for _ in ExitCircuitStreams.STREAM_CLASSES]
+        for (class_index, start) in izip(self.stream_classes,
+                                         self.start_times):
+            times[class_index].append(start)
+        return dict(zip(ExitCircuitStreams.STREAM_CLASSES, times))
+
+    def get_size(self):
+        '''
+        Returns the approximate number of bytes used by this object.
+        '''
+        return (sys.getsizeof(self) + sys.getsizeof(self.stream_classes) +
+                sys.getsizeof(self.start_times))
+
+class ClientIPState(object):
+    '''
+    Whether a client IP address has been active in a rotation period, and
+    the number of circuits it completed, for the legacy entry client IP
+    counters.
+    Busy guards can have millions of client IP addresses, so this class
+    uses __slots__.
+    '''
+
+    __slots__ = ('is_active', 'num_active_completed',
+                 'num_inactive_completed')
+
+    def __init__(self):
+        self.is_active = False
+        self.num_active_completed = 0
+        self.num_inactive_completed = 0
+
 class Aggregator(ReconnectingClientFactory):
     '''
     receive data from Tor control port
@@ -421,14 +632,56 @@ class Aggregator(ReconnectingClientFactory):
                  use_setconf, max_cell_events_per_circuit, circuit_sample_rate,
                  domain_lists, domain_suffixes, country_lists, as_data,
                  hsdir_store_lists, hsdir_fetch_lists, circuit_failure_lists,
-                 onion_address_lists):
+                 onion_address_lists, debug_event_log_interval=1,
+                 event_queue_length=TorControlClientProtocol.DEFAULT_EVENT_QUEUE_LENGTH,
+                 event_batch_size=TorControlClientProtocol.DEFAULT_EVENT_BATCH_SIZE,
+                 worker_pool=None, match_cache_dir=None, exact_match_index=None,
+                 blinding_seeds=False, compact_blinding_shares=False):
         # initialise counters
         self.secure_counters = SecureCounters(counters, modulus,
                                               require_generate_noise=True)
         self.collection_counters = counters
+
+        # If worker_pool is not None, events are processed by an aggregator
+        # shard in each of its worker processes. The shards are created
+        # using these arguments, but without share keepers, so their counts
+        # are not blinded. Noise is only added to our counts.
+        self.worker_pool = worker_pool
+        self.shard_args = None
+        self.shard_kwargs = None
+        if self.worker_pool is not None:
+            self.shard_args = (counters, traffic_model_config, [],
+                               noise_weight, modulus, None, rotate_period,
+                               use_setconf, max_cell_events_per_circuit,
+                               circuit_sample_rate,
+                               domain_lists, domain_suffixes, country_lists,
+                               as_data, hsdir_store_lists, hsdir_fetch_lists,
+                               circuit_failure_lists, onion_address_lists)
+            self.shard_kwargs = {
+                'debug_event_log_interval' : debug_event_log_interval,
+                'match_cache_dir' : match_cache_dir,
+                'exact_match_index' : exact_match_index,
+                }
+        self.shards = None
+        self.shard_round_id = None
+        self.shard_flusher = None
+        self.shard_round_robin = 0
         # we can't generate the noise yet, because we don't know the
         # DC fingerprint
-        self.secure_counters.generate_blinding_shares(sk_uids)
+        self.secure_counters.generate_blinding_shares(
+                                        sk_uids,
+                                        use_seeds=blinding_seeds,
+                                        compact=compact_blinding_shares)
+
+        # Tables of counter handles, keyed by the event subcategories that
+        # are used to create counter names. Each entry is resolved the first
+        # time an event uses it in this round. After that, events do not
+        # format counter names or look them up.
+        self.stream_end_counter_handles = {}
+        self.stream_end_histogram_handles = {}
+        self.stream_end_count_list_handles = {}
+        self.circuit_close_status_handles = {}
+        self.connection_close_handles = {}
 
         # the traffic model is optional
         self.traffic_model = None
@@ -444,6 +697,10 @@ class Aggregator(ReconnectingClientFactory):
         self.circuit_sample_rate = float(circuit_sample_rate)
 
         # Prepare or check match lists
+        # Compiled match lists from the tally server are used without any
+        # processing. If match_cache_dir is not None, they are memory-mapped
+        # from files in that directory, so their memory is shared with any
+        # other processes that use the same lists and directory.
 
         # Check whether we need to collect exact or suffix match domain counters
         self.needs_domain_exact_match = False
@@ -461,13 +718,16 @@ class Aggregator(ReconnectingClientFactory):
         if self.needs_domain_exact_match:
             for i in xrange(len(domain_lists)):
                 logging.info('Preparing domain list {}'.format(i))
-                exact_match_prepare_collection(domain_lists[i],
-                                               existing_exacts=self.domain_exact_objs)
+                exact_match_load(domain_lists[i],
+                                 existing_exacts=self.domain_exact_objs,
+                                 cache_dir=match_cache_dir)
         else:
             logging.info('No domain exact counters, skipping domain exact lists')
         self.domain_suffix_obj = {}
         if self.needs_domain_suffix_match:
-            self.domain_suffix_obj = domain_suffixes
+            self.domain_suffix_obj = suffix_match_load(domain_suffixes,
+                                                       separator=".",
+                                                       cache_dir=match_cache_dir)
         else:
             logging.info('No domain suffix counters, skipping domain suffix object')
 
@@ -475,8 +735,9 @@ class Aggregator(ReconnectingClientFactory):
         self.country_exact_objs = []
         for i in xrange(len(country_lists)):
             logging.info('Preparing country list {}'.format(i))
-            exact_match_prepare_collection(country_lists[i],
-                                           existing_exacts=self.country_exact_objs)
+            exact_match_load(country_lists[i],
+                             existing_exacts=self.country_exact_objs,
+                             cache_dir=match_cache_dir)
 
         # IP addresses are prefix-matched against IP to AS maps,
         # then the ASs are exact-matched against AS lists
@@ -491,37 +752,68 @@ class Aggregator(ReconnectingClientFactory):
         self.as_exact_objs = []
         for i in xrange(len(as_data.get('lists', []))):
             logging.info('Preparing AS list {}'.format(i))
-            exact_match_prepare_collection(as_data['lists'][i],
-                                           existing_exacts=self.as_exact_objs)
+            exact_match_load(as_data['lists'][i],
+                             existing_exacts=self.as_exact_objs,
+                             cache_dir=match_cache_dir)
 
         # Prepare HSDir store failure match lists
         self.hsdir_store_exact_objs = []
         for i in xrange(len(hsdir_store_lists)):
             logging.info('Preparing HSDir store failure list {}'.format(i))
-            exact_match_prepare_collection(hsdir_store_lists[i],
-                                           existing_exacts=self.hsdir_store_exact_objs)
+            exact_match_load(hsdir_store_lists[i],
+                             existing_exacts=self.hsdir_store_exact_objs,
+                             cache_dir=match_cache_dir)
 
         # Prepare HSDir fetch failure match lists
         self.hsdir_fetch_exact_objs = []
         for i in xrange(len(hsdir_fetch_lists)):
             logging.info('Preparing HSDir fetch failure list {}'.format(i))
-            exact_match_prepare_collection(hsdir_fetch_lists[i],
-                                           existing_exacts=self.hsdir_fetch_exact_objs)
+            exact_match_load(hsdir_fetch_lists[i],
+                             existing_exacts=self.hsdir_fetch_exact_objs,
+                             cache_dir=match_cache_dir)
 
         # Prepare Circuit Failure match lists
         self.circuit_failure_exact_objs = []
         for i in xrange(len(circuit_failure_lists)):
             logging.info('Preparing Circuit Failure list {}'.format(i))
-            exact_match_prepare_collection(circuit_failure_lists[i],
-                                           existing_exacts=self.circuit_failure_exact_objs)
+            exact_match_load(circuit_failure_lists[i],
+                             existing_exacts=self.circuit_failure_exact_objs,
+                             cache_dir=match_cache_dir)
 
         # Prepare Onion Address match lists
         # These lists are used for both stores and fetches
         self.onion_address_exact_objs = []
         for i in xrange(len(onion_address_lists)):
             logging.info('Preparing Onion Address list {}'.format(i))
-            exact_match_prepare_collection(onion_address_lists[i],
-                                           existing_exacts=self.onion_address_exact_objs)
+            exact_match_load(onion_address_lists[i],
+                             existing_exacts=self.onion_address_exact_objs,
+                             cache_dir=match_cache_dir)
+
+        # Combine each group of exact match lists into a single index
+        assert exact_match_index in Aggregator.EXACT_MATCH_INDEX_TYPES
+        bloom_filter = (exact_match_index == 'bloom')
+        # Onion addresses are always indexed, so that each search is only
+        # hashed once, and only if the lists contain hashes. Without an
+        # exact_match_index type, the index searches each list in turn, so
+        # the lists are not copied.
+        self.onion_address_exact_objs = ExactMatchIndex(
+                                            self.onion_address_exact_objs,
+                                            bloom_filter=bloom_filter,
+                                            match_onion_md5=True,
+                                            item_map=(exact_match_index == 'map'))
+        if exact_match_index is not None:
+            for name in ['domain', 'country', 'as', 'hsdir_store',
+                         'hsdir_fetch', 'circuit_failure']:
+                attr = '{}_exact_objs'.format(name)
+                exact_objs = getattr(self, attr)
+                if len(exact_objs) > 1:
+                    setattr(self, attr,
+                            ExactMatchIndex(exact_objs,
+                                            bloom_filter=bloom_filter))
+
+        # Work out which event handlers and handler branches can increment
+        # the counters we are collecting, so we can skip the rest
+        self._plan_event_handlers()
 
         # initialise state and local config
         self.connector = None
@@ -532,10 +824,16 @@ class Aggregator(ReconnectingClientFactory):
         self.tor_control_port = tor_control_port
         self.rotate_period = rotate_period
         self.use_setconf = use_setconf
+        self.event_debug_log = SampledDebugLog(debug_event_log_interval)
+        self.event_queue_length = event_queue_length
+        self.event_batch_size = event_batch_size
 
         self.last_event_time = None
         self.num_rotations = 0
+        # circ_info maps get_circuit_key() to ExitCircuitStreams
         self.circ_info = {}
+        self.circ_info_stream_count = 0
+        # cli_ips map packed IP addresses to ClientIPState
         self.cli_ips_rotated = time()
         self.cli_ips_current = {}
         self.cli_ips_previous = {}
@@ -551,6 +849,115 @@ class Aggregator(ReconnectingClientFactory):
         self.geoip_file = None
         self.geoipv6_file = None
 
+    # The default client IP address for the legacy entry circuit counters
+    UNKNOWN_IP_ADDRESS = ipaddress.ip_address(u'0.0.0.0')
+
+    # The counter name suffixes that _handle_circuit_close_event()
+    # increments, in the order it increments them
+    # (Name fragments are split from strings, so that test_counter_match.sh
+    # doesn't mistake them for counter names.)
+    CIRCUIT_CLOSE_SUFFIXES = tuple('''
+        Count InboundCellCount OutboundCellCount
+        InboundCellHistogram OutboundCellHistogram
+        CellRatio LifeTime ReasonCountList
+        '''.split())
+
+    @staticmethod
+    def _get_circuit_close_suffix(counter_name):
+        '''
+        Return the suffix in CIRCUIT_CLOSE_SUFFIXES that
+        _handle_circuit_close_event() uses to increment counter_name,
+        or None if it does not increment counter_name.
+        '''
+        for counter_suffix in Aggregator.CIRCUIT_CLOSE_SUFFIXES:
+            if counter_name.endswith('Circuit{}'.format(counter_suffix)):
+                return counter_suffix
+        return None
+
+    def _plan_event_handlers(self):
+        '''
+        Use the events required by each collected counter to decide which
+        event handlers and handler branches need to run this round.
+        Events with no collected counters are ignored before they are
+        parsed and validated. Events with some collected counters skip the
+        branches that only increment counters that are not being collected.
+        If a collected counter is not incremented by any known branch, logs
+        a warning and runs every branch for its event.
+        '''
+        counter_names = self.collection_counters.keys()
+
+        # PRIVCOUNT_CIRCUIT_CLOSE
+        circuit_counters = get_counters_for_events(counter_names,
+                                                   { CIRCUIT_EVENT })
+        stream_counters = get_counters_for_events(counter_names,
+                                                  { STREAM_EVENT })
+        self.needs_circuit_close_suffixes = set()
+        # the legacy circuit code updates state for counters that are
+        # incremented later: the client IP counters are incremented on
+        # rotation, and the Exit circuit stream counters need data from
+        # stream events
+        self.needs_client_ip_info = False
+        self.needs_exit_circuit_stream_info = False
+        unplanned_circuit_counters = set()
+        for counter_name in circuit_counters:
+            is_planned = False
+            counter_suffix = Aggregator._get_circuit_close_suffix(counter_name)
+            if counter_suffix is not None:
+                self.needs_circuit_close_suffixes.add(counter_suffix)
+                is_planned = True
+            if counter_name in CLIENT_IP_COUNTERS:
+                self.needs_client_ip_info = True
+                is_planned = True
+            if counter_name in stream_counters:
+                self.needs_exit_circuit_stream_info = True
+                is_planned = True
+            if not is_planned:
+                unplanned_circuit_counters.add(counter_name)
+        if len(unplanned_circuit_counters) > 0:
+            logging.warning("Running all circuit close branches for counters with no known branch: {}"
+                            .format(", ".join(sorted(unplanned_circuit_counters))))
+            self.needs_circuit_close_suffixes.update(
+                Aggregator.CIRCUIT_CLOSE_SUFFIXES)
+            self.needs_client_ip_info = True
+            self.needs_exit_circuit_stream_info = True
+        self.needs_legacy_circuit_info = (self.needs_client_ip_info or
+                                          self.needs_exit_circuit_stream_info)
+
+        # PRIVCOUNT_CONNECTION_CLOSE
+        connection_counters = get_counters_for_events(counter_names,
+                                                      { CONNECTION_EVENT })
+        plain_counters = connection_counters.intersection(
+            get_connection_plain_counters())
+        country_counters = connection_counters.intersection(
+            get_connection_match_counters('Country'))
+        as_counters = connection_counters.intersection(
+            get_connection_match_counters('AS'))
+        self.needs_connection_close = len(plain_counters) > 0
+        self.needs_connection_close_country_match = len(country_counters) > 0
+        self.needs_connection_close_as_match = len(as_counters) > 0
+        unplanned_connection_counters = connection_counters.difference(
+            plain_counters, country_counters, as_counters)
+        if len(unplanned_connection_counters) > 0:
+            logging.warning("Running all connection close branches for counters with no known branch: {}"
+                            .format(", ".join(sorted(unplanned_connection_counters))))
+            self.needs_connection_close = True
+            self.needs_connection_close_country_match = True
+            self.needs_connection_close_as_match = True
+
+        # skip these events entirely if there's nothing to count
+        self.skipped_events = set()
+        if (len(self.needs_circuit_close_suffixes) == 0 and
+            not self.needs_legacy_circuit_info):
+            self.skipped_events.add(CIRCUIT_EVENT)
+        if len(connection_counters) == 0:
+            self.skipped_events.add(CONNECTION_EVENT)
+        for event in (HSDIR_STORE_EVENT, HSDIR_FETCH_EVENT):
+            if len(get_counters_for_events(counter_names, { event })) == 0:
+                self.skipped_events.add(event)
+
+        logging.info("Skipping events with no collected counters: {}"
+                     .format(", ".join(sorted(self.skipped_events))))
+
     def buildProtocol(self, addr):
         if self.protocol is not None:
             if self.protocol.isConnected():
@@ -583,23 +990,43 @@ class Aggregator(ReconnectingClientFactory):
         self.connector_list = connect(self, self.tor_control_port)
         # Twisted doesn't want a list of connectors, it only wants one
         self.connector = choose_a_connection(self.connector_list)
-        self.rotator = task.LoopingCall(self._do_rotate)
-        rotator_deferred = self.rotator.start(self.rotate_period, now=False)
-        rotator_deferred.addErrback(errorCallback)
+        if self.worker_pool is not None and self.worker_pool.is_running():
+            # each shard rotates its own client IP addresses
+            self._start_shards()
+        else:
+            self.rotator = task.LoopingCall(self._do_rotate)
+            rotator_deferred = self.rotator.start(self.rotate_period,
+                                                  now=False)
+            rotator_deferred.addErrback(errorCallback)
         # if we've already built the protocol before starting
         if self.protocol is not None:
             self.protocol.startCollection(self.collection_counters, traffic_model=self.traffic_model_config)
 
-    def _stop_protocol(self):
+    def _stop_protocol(self, discard_events=False):
         '''
         Stop protocol and connection activities.
+        Unless discard_events is True, the events that have already been
+        received are processed first.
+        Returns a deferred that fires when the protocol has stopped.
         '''
         # don't try to reconnect
         self.stopTrying()
 
-        # stop reading from Tor control port
+        # stop reading from Tor control port, after processing the events
+        # that have already been received
+        if self.protocol is not None:
+            stop_deferred = self.protocol.stopCollection(
+                                              discard_events=discard_events)
+        else:
+            stop_deferred = defer.succeed(True)
+        stop_deferred.addCallback(self._disconnect_protocol)
+        return stop_deferred
+
+    def _disconnect_protocol(self, _is_drained=True):
+        '''
+        Disconnect from the control port, and stop rotating.
+        '''
         if self.protocol is not None:
-            self.protocol.stopCollection()
             self.protocol.quit()
             self.protocol = None
         if self.rotator is not None and self.rotator.running:
@@ -610,20 +1037,181 @@ class Aggregator(ReconnectingClientFactory):
             self.connector_list = None
             self.connector = None
 
+    # The number of events sent to a shard in each message
+    SHARD_EVENT_BATCH_SIZE = 100
+    # The number of seconds between sending partial batches to shards
+    SHARD_FLUSH_PERIOD = 1.0
+    # The number of seconds we wait for each shard's counts when stopping
+    SHARD_STOP_TIMEOUT = 120.0
+
+    def _start_shards(self):
+        '''
+        Start an aggregator shard in each worker process, and start flushing
+        events to them regularly.
+        '''
+        logging.info("Starting aggregator shards in {} worker processes"
+                     .format(self.worker_pool.get_worker_count()))
+        self.shard_round_id = self.worker_pool.start_round(self.shard_args,
+                                                           self.shard_kwargs)
+        self.shards = []
+        for event_queue in self.worker_pool.get_event_queues():
+            self.shards.append({ 'event_queue' : event_queue,
+                                 'events' : [] })
+        self.shard_flusher = task.LoopingCall(self._flush_shard_events)
+        flusher_deferred = self.shard_flusher.start(
+                                           Aggregator.SHARD_FLUSH_PERIOD,
+                                           now=False)
+        flusher_deferred.addErrback(errorCallback)
+
+    @staticmethod
+    def get_shard_key(event):
+        '''
+        Return the key used to choose a shard for event, or None if event can
+        be processed by any shard.
+        Events that share circuit or client state must go to the same shard:
+        exit streams and circuits are keyed on their channel and circuit ids,
+        and entry circuits are keyed on their client IP address.
+        event is a list of tokens from the event line, split on spaces.
+        '''
+        event_code = event[0]
+        if event_code == 'PRIVCOUNT_STREAM_ENDED':
+            # ChanID and CircID are positional fields
+            return (event[1], event[2])
+        elif event_code == 'PRIVCOUNT_CIRCUIT_CLOSE':
+            chanid = None
+            circid = None
+            previp = None
+            is_entry = False
+            # the tagged fields are parsed by the shard: just find the values
+            for item in event[1:]:
+                if item.startswith("PreviousChannelId="):
+                    chanid = item[len("PreviousChannelId="):]
+                elif item.startswith("PreviousCircuitId="):
+                    circid = item[len("PreviousCircuitId="):]
+                elif item.startswith("PreviousNodeIPAddress="):
+                    previp = item[len("PreviousNodeIPAddress="):]
+                elif item == "IsEntryFlag=1":
+                    is_entry = True
+            if is_entry:
+                return previp
+            return (chanid, circid)
+        else:
+            return None
+
+    def _queue_shard_event(self, event):
+        '''
+        Add event to the batch for its shard, and send the batch to the
+        shard if it is full.
+        '''
+        shard_key = Aggregator.get_shard_key(event)
+        if shard_key is None:
+            self.shard_round_robin = ((self.shard_round_robin + 1) %
+                                      len(self.shards))
+            shard = self.shards[self.shard_round_robin]
+        else:
+            shard = self.shards[hash(shard_key) % len(self.shards)]
+        shard['events'].append(event)
+        if len(shard['events']) >= Aggregator.SHARD_EVENT_BATCH_SIZE:
+            shard['event_queue'].put(shard['events'])
+            shard['events'] = []
+
+    def _flush_shard_events(self):
+        '''
+        Send any partial batches of events to their shards.
+        This function is called using LoopingCall, so any exceptions will be
+        turned into log messages.
+        '''
+        if self.shards is None:
+            return
+        for shard in self.shards:
+            if len(shard['events']) > 0:
+                shard['event_queue'].put(shard['events'])
+                shard['events'] = []
+
+    def _stop_shards(self, counts_are_valid=True):
+        '''
+        Stop the aggregator shards.
+        Returns a deferred. If counts_are_valid, the deferred waits for the
+        counts from each shard in a thread, and adds them to our counts.
+        The deferred fires with False if any shard's counts are missing,
+        and True otherwise.
+        '''
+        if self.shards is None:
+            return defer.succeed(True)
+        if self.shard_flusher is not None and self.shard_flusher.running:
+            self.shard_flusher.stop()
+        self.shard_flusher = None
+        self._flush_shard_events()
+        # ask the shards to finish processing their events and stop
+        for shard in self.shards:
+            shard['event_queue'].put(None)
+        self.shards = None
+        if not counts_are_valid:
+            # the workers discard the counts from this round
+            return defer.succeed(True)
+        shard_deferred = threads.deferToThread(
+                                           self.worker_pool.get_round_counts,
+                                           self.shard_round_id,
+                                           Aggregator.SHARD_STOP_TIMEOUT)
+        shard_deferred.addCallback(self._add_shard_counts)
+        return shard_deferred
+
+    def _add_shard_counts(self, shard_results):
+        '''
+        Add the counts in shard_results from get_round_counts() to our
+        counts. If shard_results is None, stop the worker processes, and
+        return False. Otherwise, return True.
+        '''
+        if shard_results is None:
+            logging.error("Aggregator worker processes did not return counts within {}s. Stopping them: events will be counted in the data collector process until it is restarted."
+                          .format(Aggregator.SHARD_STOP_TIMEOUT))
+            self.worker_pool.terminate()
+            return False
+        rejected_count = 0
+        for (shard_counts, shard_rejected_count) in shard_results:
+            # shard counts are sums modulo counter_modulus(), so they
+            # can be added to our blinded and noisy counts in any order
+            self.secure_counters.add_counts(shard_counts)
+            rejected_count += shard_rejected_count
+        if rejected_count > 0:
+            logging.warning("Aggregator worker processes rejected {} events"
+                            .format(rejected_count))
+        return True
+
     def _stop_secure_counters(self, counts_are_valid=True):
         '''
-        If counts_are_valid, detach and return the counts from secure counters.
-        Otherwise, return None.
+        Returns a deferred that fires after the counts from the worker
+        processes (if any) have been added to secure counters.
+        If counts_are_valid, the deferred fires with the counts from secure
+        counters. Otherwise, it fires with None.
+        If counts_are_valid is False, the deferred has already fired.
         '''
         # if we've already stopped counting due to an error, there are no
         # counters
+        if self.secure_counters is None:
+            return defer.succeed(None)
+
+        # add the counts from the worker processes, if any
+        shard_deferred = self._stop_shards(counts_are_valid=counts_are_valid)
+        shard_deferred.addCallback(self._detach_secure_counters,
+                                   counts_are_valid)
+        return shard_deferred
+
+    def _detach_secure_counters(self, are_shard_counts_complete,
+                                counts_are_valid):
+        '''
+        If counts_are_valid and are_shard_counts_complete, detach and
+        return the counts from secure counters. Otherwise, return None.
+        '''
         if self.secure_counters is None:
             return None
 
+        self._clear_as_prefix_caches()
+
         # return the final counts (if available) and make sure we can't be
         # restarted
         counts = None
-        if counts_are_valid:
+        if counts_are_valid and are_shard_counts_complete:
             counts = self.secure_counters.detach_counts()
             # TODO: secure delete?
         del self.secure_counters
@@ -634,8 +1222,9 @@ class Aggregator(ReconnectingClientFactory):
         '''
         Stop counting, and stop connecting to the ControlPort and Tally Server.
         Retrieve the counts, and delete the counters.
-        If counts_are_valid is True, return the counts.
-        Otherwise, return None.
+        Returns a deferred that fires after the events that have already
+        been received are counted. If counts_are_valid is True, the deferred
+        fires with the counts. Otherwise, it fires with None.
         '''
         # make sure we added noise
         if self.noise_weight_value is None and counts_are_valid:
@@ -643,10 +1232,15 @@ class Aggregator(ReconnectingClientFactory):
             self.generate_noise()
 
         # stop trying to collect data
-        self._stop_protocol()
+        stop_deferred = self._stop_protocol(
+                                       discard_events=not counts_are_valid)
 
         # stop using the counters
-        return self._stop_secure_counters(counts_are_valid=counts_are_valid)
+        # (returning a deferred from a callback chains it)
+        stop_deferred.addCallback(
+            lambda _: self._stop_secure_counters(
+                                           counts_are_valid=counts_are_valid))
+        return stop_deferred
 
     def get_shares(self):
         return self.secure_counters.detach_blinding_shares()
@@ -672,7 +1266,7 @@ class Aggregator(ReconnectingClientFactory):
                             .format(self.fingerprint,
                                     self.noise_weight_config))
             # stop collecting and stop counting
-            self._stop_protocol()
+            self._stop_protocol(discard_events=True)
             self._stop_secure_counters(counts_are_valid=False)
 
     def get_control_password(self):
@@ -690,6 +1284,28 @@ class Aggregator(ReconnectingClientFactory):
         '''
         return self.use_setconf
 
+    def get_debug_event_log_interval(self):
+        '''
+        Returns the number of event path debug messages per logged
+        message. Defaults to 1 (log every message).
+        '''
+        return self.event_debug_log.interval
+
+    def get_event_queue_length(self):
+        '''
+        Returns the number of received events that can wait to be
+        processed. Reading from tor pauses when half this many events are
+        waiting.
+        '''
+        return self.event_queue_length
+
+    def get_event_batch_size(self):
+        '''
+        Returns the maximum number of queued events that are processed before
+        yielding to the reactor.
+        '''
+        return self.event_batch_size
+
     def get_max_cell_events_per_circuit(self):
         '''
         Returns the PrivCountMaxCellEventsPerCircuit, an integer number in
@@ -1064,6 +1680,44 @@ class Aggregator(ReconnectingClientFactory):
             context['geoipv6_file'] = self.geoipv6_file
         return context
 
+    def log_local_status(self):
+        '''
+        Log status information that depends on client activity.
+        This information is not sent to the tally server, because it is not
+        protected by differential privacy.
+        '''
+        if self.protocol is not None:
+            self.protocol.logEventQueueStatus()
+        self.log_state_memory_usage()
+
+    # The approximate number of bytes used by each ClientIPState, including
+    # its packed IPv4 address key
+    CLIENT_IP_SIZE = sys.getsizeof(ClientIPState()) + sys.getsizeof('\0'*4)
+    # The approximate number of bytes used by each ExitCircuitStreams,
+    # including its integer key, but not its streams
+    EXIT_CIRCUIT_SIZE = ExitCircuitStreams().get_size() + sys.getsizeof(2**40)
+
+    def log_state_memory_usage(self):
+        '''
+        Log the number of circuits, streams, and client IP addresses in the
+        aggregator's state tables, and an estimate of the number of bytes
+        they use.
+        Does not iterate through the tables, because they can be very large.
+        '''
+        cli_ips_count = len(self.cli_ips_current) + len(self.cli_ips_previous)
+        state_bytes = (sys.getsizeof(self.circ_info) +
+                       sys.getsizeof(self.cli_ips_current) +
+                       sys.getsizeof(self.cli_ips_previous) +
+                       len(self.circ_info)*Aggregator.EXIT_CIRCUIT_SIZE +
+                       self.circ_info_stream_count*ExitCircuitStreams.STREAM_SIZE +
+                       cli_ips_count*Aggregator.CLIENT_IP_SIZE)
+        logging.info("Aggregator state: {} circuits with {} streams, {} current and {} previous client IP addresses, using about {} bytes"
+                     .format(len(self.circ_info),
+                             self.circ_info_stream_count,
+                             len(self.cli_ips_current),
+                             len(self.cli_ips_previous),
+                             state_bytes))
+
     def handle_event(self, event):
         if not self.secure_counters:
             return False
@@ -1075,6 +1729,12 @@ class Aggregator(ReconnectingClientFactory):
         event_code, items = event[0], event[1:]
         self.last_event_time = time()
 
+        # hand events off to the aggregator shards, if there are any
+        if self.shards is not None:
+            if event_code not in self.skipped_events:
+                self._queue_shard_event(event)
+            return True
+
         # hand valid events off to the aggregator
         # keep events in order of frequency, particularly the cell and bytes
         # events (cell happens every 514 bytes, bytes happens every ~16kB)
@@ -1137,6 +1797,10 @@ class Aggregator(ReconnectingClientFactory):
         Handle an event with tagged fields.
         '''
 
+        # don't parse or validate events that can't change any counters
+        if event_code in self.skipped_events:
+            return True
+
         if (event_code == 'PRIVCOUNT_CIRCUIT_CELL' or
             event_code == 'PRIVCOUNT_CIRCUIT_CLOSE' or
             event_code == 'PRIVCOUNT_CONNECTION_CLOSE' or
@@ -1194,15 +1858,73 @@ class Aggregator(ReconnectingClientFactory):
 
         return True
 
-    def is_circ_known(self, chanid=None, circid=None):
+    @staticmethod
+    def get_circuit_key(chanid, circid):
         '''
-        Have we seen circid on chanid before?
-        Must be called before setting circ_info in _handle_stream_event().
-        When circid on chanid closes, it is marked as unknown again.
+        Returns a compact key for circid on chanid.
+        Tor circuit ids are 32 bit, so valid ids are packed into a single
+        integer. Otherwise, returns a tuple.
         '''
-        assert chanid is not None
-        assert circid is not None
-        return chanid in self.circ_info and circid in self.circ_info[chanid]
+        if 0 <= circid <= 0xffffffff:
+            return (chanid << 32) | circid
+        else:
+            return (chanid, circid)
+
+    def _resolve_counter_handles(self, counter_names):
+        '''
+        Return a tuple containing the SecureCounters bin index for each name
+        in counter_names, or None for each counter that is not being
+        collected. If none of the counters are being collected, return an
+        empty tuple.
+        The bin indexes can be passed to _increment_counter_handles().
+        '''
+        handles = tuple([self.secure_counters.get_bin_index(counter_name)
+                         for counter_name in counter_names])
+        if all([handle is None for handle in handles]):
+            return ()
+        return handles
+
+    def _increment_counter_handles(self, handles, bin_incs):
+        '''
+        Increment each counter in handles that is being collected, using the
+        (bin, inc) tuple in the same position in bin_incs.
+        handles must have been created by _resolve_counter_handles().
+        '''
+        increment_bin_index = self.secure_counters.increment_bin_index
+        for (handle, (bin, inc)) in izip(handles, bin_incs):
+            if handle is not None:
+                increment_bin_index(handle, bin=bin, inc=inc)
+
+    # The counter name suffixes incremented by each stream end method
+    # (Split from strings, like CIRCUIT_CLOSE_SUFFIXES.)
+    STREAM_END_COUNTER_SUFFIXES = tuple('''
+        StreamCount StreamByteCount
+        StreamOutboundByteCount StreamInboundByteCount
+        '''.split())
+    STREAM_END_HISTOGRAM_SUFFIXES = tuple('''
+        StreamByteHistogram StreamOutboundByteHistogram
+        StreamInboundByteHistogram StreamByteRatio StreamLifeTime
+        '''.split())
+    STREAM_END_COUNT_LIST_SUFFIXES = tuple('''
+        StreamCountList StreamByteCountList
+        StreamOutboundByteCountList StreamInboundByteCountList
+        '''.split())
+
+    def _get_stream_end_handles(self, handle_table, subcategory,
+                                counter_suffixes):
+        '''
+        Return the counter handles for the Exit counters named using the
+        subcategory tuple and each suffix in counter_suffixes.
+        Uses handle_table to cache the handles for each subcategory.
+        '''
+        handles = handle_table.get(subcategory)
+        if handles is None:
+            subcategory_name = "".join(subcategory)
+            handles = self._resolve_counter_handles(
+                ['Exit{}{}'.format(subcategory_name, counter_suffix)
+                 for counter_suffix in counter_suffixes])
+            handle_table[subcategory] = handles
+        return handles
 
     def _increment_stream_end_counters(self, subcategory,
                                        totalbw, writebw, readbw,
@@ -1210,24 +1932,18 @@ class Aggregator(ReconnectingClientFactory):
         '''
         Increment the Stream counters for subcategory using the fields
         provided.
+        subcategory is a tuple of strings, which are joined to create the
+        counter names.
         '''
-        self.secure_counters.increment('Exit{}StreamCount'
-                                       .format(subcategory),
-                                       bin=SINGLE_BIN,
-                                       inc=1)
-
-        self.secure_counters.increment('Exit{}StreamByteCount'
-                                       .format(subcategory),
-                                       bin=SINGLE_BIN,
-                                       inc=totalbw)
-        self.secure_counters.increment('Exit{}StreamOutboundByteCount'
-                                       .format(subcategory),
-                                       bin=SINGLE_BIN,
-                                       inc=writebw)
-        self.secure_counters.increment('Exit{}StreamInboundByteCount'
-                                       .format(subcategory),
-                                       bin=SINGLE_BIN,
-                                       inc=readbw)
+        handles = self._get_stream_end_handles(self.stream_end_counter_handles,
+                                               subcategory,
+                                               Aggregator.STREAM_END_COUNTER_SUFFIXES)
+        if handles:
+            self._increment_counter_handles(handles,
+                                            ((SINGLE_BIN, 1),
+                                             (SINGLE_BIN, totalbw),
+                                             (SINGLE_BIN, writebw),
+                                             (SINGLE_BIN, readbw)))
 
         self._increment_stream_end_histograms(subcategory,
                                               totalbw, writebw, readbw,
@@ -1239,28 +1955,19 @@ class Aggregator(ReconnectingClientFactory):
         '''
         Increment the Stream histogram counters for subcategory using the
         fields provided.
+        subcategory is a tuple of strings, which are joined to create the
+        counter names.
         '''
-        self.secure_counters.increment('Exit{}StreamByteHistogram'
-                                       .format(subcategory),
-                                       bin=totalbw,
-                                       inc=1)
-        self.secure_counters.increment('Exit{}StreamOutboundByteHistogram'
-                                       .format(subcategory),
-                                       bin=writebw,
-                                       inc=1)
-        self.secure_counters.increment('Exit{}StreamInboundByteHistogram'
-                                       .format(subcategory),
-                                       bin=readbw,
-                                       inc=1)
-
-        self.secure_counters.increment('Exit{}StreamByteRatio'
-                                       .format(subcategory),
-                                       bin=ratio,
-                                       inc=1)
-        self.secure_counters.increment('Exit{}StreamLifeTime'
-                                       .format(subcategory),
-                                       bin=lifetime,
-                                       inc=1)
+        handles = self._get_stream_end_handles(self.stream_end_histogram_handles,
+                                               subcategory,
+                                               Aggregator.STREAM_END_HISTOGRAM_SUFFIXES)
+        if handles:
+            self._increment_counter_handles(handles,
+                                            ((totalbw, 1),
+                                             (writebw, 1),
+                                             (readbw, 1),
+                                             (ratio, 1),
+                                             (lifetime, 1)))
 
     def _increment_stream_end_count_lists(self, subcategory,
                                           matching_bin,
@@ -1268,6 +1975,8 @@ class Aggregator(ReconnectingClientFactory):
         '''
         Increment the Stream*ListCount counters for subcategory using
         matching_bin and the fields provided.
+        subcategory is a tuple of strings, which are joined to create the
+        counter names.
         If matching_bin is None, increment the final bin in each counter.
         '''
         #logging.debug("subcategory: {} bin: {} total: {} write: {} read:  {}"
@@ -1282,28 +1991,28 @@ class Aggregator(ReconnectingClientFactory):
 
         # there will always be at least two bins in each counter:
         # the matching bin for the first list, and the unmatched bin
-        self.secure_counters.increment('Exit{}StreamCountList'
-                                       .format(subcategory),
-                                       bin=matching_bin,
-                                       inc=1)
-
-        self.secure_counters.increment('Exit{}StreamByteCountList'
-                                       .format(subcategory),
-                                       bin=matching_bin,
-                                       inc=totalbw)
-        self.secure_counters.increment('Exit{}StreamOutboundByteCountList'
-                                       .format(subcategory),
-                                       bin=matching_bin,
-                                       inc=writebw)
-        self.secure_counters.increment('Exit{}StreamInboundByteCountList'
-                                       .format(subcategory),
-                                       bin=matching_bin,
-                                       inc=readbw)
+        handles = self._get_stream_end_handles(self.stream_end_count_list_handles,
+                                               subcategory,
+                                               Aggregator.STREAM_END_COUNT_LIST_SUFFIXES)
+        if handles:
+            self._increment_counter_handles(handles,
+                                            ((matching_bin, 1),
+                                             (matching_bin, totalbw),
+                                             (matching_bin, writebw),
+                                             (matching_bin, readbw)))
+
+    # The exact_match_index option values:
+    # None: search each list in turn (onion address lists are always
+    #       indexed using a map)
+    # 'map': search a combined map of every item
+    # 'bloom': check a bloom filter, then search each list in turn
+    EXACT_MATCH_INDEX_TYPES = [None, 'map', 'bloom']
 
     @staticmethod
     def _exact_match_bin(exact_objs, search_string, match_onion_md5=False):
         '''
-        Finds the bin number of search_string in exact_objs.
+        Finds the bin number of search_string in exact_objs, which is a list
+        of exact match objects, or an ExactMatchIndex.
 
         If match_onion_md5 is True, also try to match:
             hashlib.md5(search_string + '.onion').hexdigest()
@@ -1313,6 +2022,10 @@ class Aggregator(ReconnectingClientFactory):
         search_string, or +inf if no object matches. The return value is
         always a float.
         '''
+        if isinstance(exact_objs, ExactMatchIndex):
+            i = exact_objs.find(search_string,
+                                match_onion_md5=match_onion_md5)
+            return float(i) if i is not None else float('inf')
         for i in xrange(len(exact_objs)):
             # check for an exact match
             # this is O(N), but obviously correct
@@ -1352,12 +2065,18 @@ class Aggregator(ReconnectingClientFactory):
 
         is_stream_first_on_circ = (exit_stream_number == 1)
 
-        self.circ_info.setdefault(chanid, {}).setdefault(circid, {'num_streams': {'Interactive':0, 'Web':0, 'P2P':0, 'OtherPort':0}, 'stream_starttimes': {'Interactive':[], 'Web':[], 'P2P':[], 'OtherPort':[]}})
-
         stream_class = Aggregator._classify_port(port)
         stream_web = Aggregator._classify_port_web(port)
-        self.circ_info[chanid][circid]['num_streams'][stream_class] += 1
-        self.circ_info[chanid][circid]['stream_starttimes'][stream_class].append(start)
+
+        # only keep circuit stream data if the legacy circuit code uses it
+        if self.needs_exit_circuit_stream_info:
+            circ_key = Aggregator.get_circuit_key(chanid, circid)
+            circ_streams = self.circ_info.get(circ_key)
+            if circ_streams is None:
+                circ_streams = ExitCircuitStreams()
+                self.circ_info[circ_key] = circ_streams
+            circ_streams.add_stream(stream_class, start)
+            self.circ_info_stream_count += 1
 
         # the amount we read from the stream is bound for the client
         # the amount we write to the stream is bound to the server
@@ -1365,10 +2084,10 @@ class Aggregator(ReconnectingClientFactory):
         lifetime = end-start
 
         # Increment the base and per-class counters
-        self._increment_stream_end_counters("",
+        self._increment_stream_end_counters((),
                                             totalbw, writebw, readbw,
                                             ratio, lifetime)
-        self._increment_stream_end_counters(stream_class,
+        self._increment_stream_end_counters((stream_class,),
                                             totalbw, writebw, readbw,
                                             ratio, lifetime)
 
@@ -1390,49 +2109,49 @@ class Aggregator(ReconnectingClientFactory):
         # collect IP version after DNS resolution
         # IPv4 / IPv6
         if ip_version is not None:
-            self._increment_stream_end_counters(ip_version,
+            self._increment_stream_end_counters((ip_version,),
                                                 totalbw, writebw, readbw,
                                                 ratio, lifetime)
             # and combined ip / stream
             # IPv4 / IPv6 + Initial / Subsequent
-            self._increment_stream_end_counters(ip_version + stream_circ,
+            self._increment_stream_end_counters((ip_version, stream_circ),
                                                 totalbw, writebw, readbw,
                                                 ratio, lifetime)
 
         # collect IP version and hostname before DNS resolution
         # IPv4Literal / IPv6Literal / Hostname
-        self._increment_stream_end_counters(host_ip_version,
+        self._increment_stream_end_counters((host_ip_version,),
                                             totalbw, writebw, readbw,
                                             ratio, lifetime)
 
         # collect stream position on circuit
         # Initial / Subsequent
-        self._increment_stream_end_counters(stream_circ,
+        self._increment_stream_end_counters((stream_circ,),
                                             totalbw, writebw, readbw,
                                             ratio, lifetime)
         # and combined host / stream
         # IPv4Literal / IPv6Literal / Hostname + Initial / Subsequent
-        self._increment_stream_end_counters(host_ip_version + stream_circ,
+        self._increment_stream_end_counters((host_ip_version, stream_circ),
                                             totalbw, writebw, readbw,
                                             ratio, lifetime)
 
         # collect web class
         # NonWeb only: Web is collected above
         if stream_web != "Web":
-            self._increment_stream_end_counters(stream_web,
+            self._increment_stream_end_counters((stream_web,),
                                                 totalbw, writebw, readbw,
                                                 ratio, lifetime)
 
         if host_ip_version == "Hostname":
             # and combined host / web class
             # Hostname + Web / NonWeb
-            self._increment_stream_end_counters(host_ip_version + stream_web,
+            self._increment_stream_end_counters((host_ip_version, stream_web),
                                                 totalbw, writebw, readbw,
                                                 ratio, lifetime)
 
             # and combined host / web / stream on circuit
             # Hostname + Web / NonWeb + Initial / Subsequent
-            self._increment_stream_end_counters(host_ip_version + stream_web + stream_circ,
+            self._increment_stream_end_counters((host_ip_version, stream_web, stream_circ),
                                                 totalbw, writebw, readbw,
                                                 ratio, lifetime)
 
@@ -1456,7 +2175,7 @@ class Aggregator(ReconnectingClientFactory):
                 # there is no match in the first list
 
                 # collect exact match / no match counts for the first list
-                self._increment_stream_end_histograms(exact_match_str + stream_web + stream_circ,
+                self._increment_stream_end_histograms((exact_match_str, stream_web, stream_circ),
                                                       totalbw, writebw, readbw,
                                                       ratio, lifetime)
 
@@ -1465,7 +2184,7 @@ class Aggregator(ReconnectingClientFactory):
                 # increment the final bin if none of the lists match
 
                 # collect exact match counts per list
-                self._increment_stream_end_count_lists("DomainExactMatch" + stream_web + stream_circ,
+                self._increment_stream_end_count_lists(("DomainExactMatch", stream_web, stream_circ),
                                                        domain_exact_match_bin,
                                                        totalbw, writebw,
                                                        readbw)
@@ -1484,7 +2203,9 @@ class Aggregator(ReconnectingClientFactory):
                     # this is O(N), but obviously correct
                     # assert suffix_match(domain_suffix_obj, remote_host) == any([remote_host.endswith("." + domain) for domain in domain_exact_obj])
 
-                    # this is O(D), where D is the number of domain components
+                    # this is O(D*log(E)), where D is the number of domain
+                    # components, and E is the number of suffixes with the
+                    # same parent domain
                     # The TS guarantees that the lists are disjoint
                     domain_suffix_match_bin = suffix_match(self.domain_suffix_obj,
                                                            remote_host,
@@ -1496,12 +2217,12 @@ class Aggregator(ReconnectingClientFactory):
                     suffix_match_str = "DomainNoSuffixMatch"
 
                 # collect suffix match / no match counts for the first list
-                self._increment_stream_end_histograms(suffix_match_str + stream_web + stream_circ,
+                self._increment_stream_end_histograms((suffix_match_str, stream_web, stream_circ),
                                                       totalbw, writebw, readbw,
                                                       ratio, lifetime)
 
                 # collect suffix match counts per list
-                self._increment_stream_end_count_lists("DomainSuffixMatch" + stream_web + stream_circ,
+                self._increment_stream_end_count_lists(("DomainSuffixMatch", stream_web, stream_circ),
                                                        domain_suffix_match_bin,
                                                        totalbw, writebw,
                                                        readbw)
@@ -1648,10 +2369,10 @@ class Aggregator(ReconnectingClientFactory):
                               fields, event_desc,
                               is_mandatory=False)
 
-        previp = get_ip_address_value("PreviousNodeIPAddress",
-                                      fields, event_desc,
-                                      is_mandatory=False,
-                                      default="0.0.0.0")
+        previp = get_ip_address_object("PreviousNodeIPAddress",
+                                       fields, event_desc,
+                                       is_mandatory=False,
+                                       default=Aggregator.UNKNOWN_IP_ADDRESS)
         prevIsClient = get_flag_value("IsEntryFlag",
                                       fields, event_desc,
                                       is_mandatory=False,
@@ -1680,40 +2401,49 @@ class Aggregator(ReconnectingClientFactory):
         if prevIsClient:
             # prev hop is a client, we are entry
 
+            if not self.needs_client_ip_info:
+                return True
+
             # is this circuit active, based on its cell counts?
             # non-exit circuits only see cells
             is_active = Aggregator._is_circuit_active(ncellsin, ncellsout)
 
             # count unique client ips
             # we saw this client within current rotation window
-            self.cli_ips_current.setdefault(previp, {'is_active':False})
+            # packed addresses are much smaller than address strings
+            client_key = previp.packed
+            client = self.cli_ips_current.get(client_key)
+            if client is None:
+                client = ClientIPState()
+                self.cli_ips_current[client_key] = client
             if is_active:
-                self.cli_ips_current[previp]['is_active'] = True
+                client.is_active = True
             if start < self.cli_ips_rotated:
                 # we also saw the client in the previous rotation window
-                self.cli_ips_previous.setdefault(previp, {'is_active':False})
+                previous_client = self.cli_ips_previous.get(client_key)
+                if previous_client is None:
+                    previous_client = ClientIPState()
+                    self.cli_ips_previous[client_key] = previous_client
                 if is_active:
-                    self.cli_ips_previous[previp]['is_active'] = True
+                    previous_client.is_active = True
 
             # count number of completed circuits per client
-            self.cli_ips_current[previp].setdefault('num_active_completed',
-                                                    0)
-            self.cli_ips_current[previp].setdefault('num_inactive_completed',
-                                                    0)
             if is_active:
-                self.cli_ips_current[previp]['num_active_completed'] += 1
+                client.num_active_completed += 1
             else:
-                self.cli_ips_current[previp]['num_inactive_completed'] += 1
+                client.num_inactive_completed += 1
 
         elif nextIsEdge:
             # prev hop is a relay and next is an edge connection, we are exit
             # don't count single-hop exits
 
             # check if we have any stream info in this circuit
-            circ_is_known = self.is_circ_known(chanid=chanid, circid=circid)
+            circ_key = Aggregator.get_circuit_key(chanid, circid)
+            circ_streams = self.circ_info.get(circ_key)
+            circ_is_known = circ_streams is not None
             has_completed_stream = False
             if circ_is_known:
-                if sum(self.circ_info[chanid][circid]['num_streams'].values()) > 0:
+                if len(circ_streams) > 0:
                     has_completed_stream = True
 
             if circ_is_known and has_completed_stream:
@@ -1721,8 +2451,8 @@ class Aggregator(ReconnectingClientFactory):
                 # all Exit circuits should pass this test
 
                 # convenience
-                counts = self.circ_info[chanid][circid]['num_streams']
-                times = self.circ_info[chanid][circid]['stream_starttimes']
+                counts = circ_streams.get_stream_counts()
+                times = circ_streams.get_stream_start_times()
 
                 # first increment general counters
                 self.secure_counters.increment('ExitCircuitStreamHistogram',
@@ -1781,17 +2511,29 @@ class Aggregator(ReconnectingClientFactory):
             # cleanup
             # TODO: secure delete
             if circ_is_known:
-                # remove circ from channel
-                self.circ_info[chanid].pop(circid, None)
-                # if that was the last circuit on channel, remove the channel too
-                if len(self.circ_info[chanid]) == 0:
-                    self.circ_info.pop(chanid, None)
+                self.circ_info_stream_count -= len(circ_streams)
+                del self.circ_info[circ_key]
         return True
 
     # The legacy event is still processed by the injector, but is ignored
     # by PrivCount 1.2.0 and later
     CONNECTION_ENDED_ITEMS = 5
 
+    @staticmethod
+    def get_hs_version_field_spec(is_mandatory=False,
+                                  prefix=None):
+        '''
+        Return the field specification for HiddenServiceVersionNumber,
+        which must be 2 or 3. Uses prefix before HiddenServiceVersionNumber
+        if it is set.
+        '''
+        if prefix is None:
+            prefix = ""
+        return make_field_spec("{}HiddenServiceVersionNumber".format(prefix),
+                               INT_FIELD,
+                               is_mandatory=is_mandatory,
+                               min_value=2, max_value=3)
+
     @staticmethod
     def is_hs_version_valid(fields, event_desc,
                             is_mandatory=False,
@@ -1847,8 +2589,9 @@ class Aggregator(ReconnectingClientFactory):
             full_value_message = value_message
         logging.warning("Unexpected {} {}. Maybe we should add a counter for it?"
                         .format(value_message, event_desc))
-        logging.debug("Unexpected {} {}. Maybe we should add a counter for it?"
-                      .format(full_value_message, event_desc))
+        if is_debug_enabled():
+            logging.debug("Unexpected {} {}. Maybe we should add a counter for it?"
+                          .format(full_value_message, event_desc))
 
     @staticmethod
     def warn_unknown_counter(counter_name, origin_desc, event_desc):
@@ -1856,20 +2599,21 @@ class Aggregator(ReconnectingClientFactory):
         If counter_name is an unknown counter name, log a warning containing
         origin_desc and event_desc.
         '''
-        if counter_name not in get_valid_counters():
+        if not is_valid_counter(counter_name):
             logging.warning("Ignored unknown counter {} from {} {}. Is your PrivCount Tor version newer than your PrivCount version?"
                             .format(counter_name, origin_desc, event_desc))
 
+    # Field specifications for are_fields_valid(), keyed by the name of the
+    # get_*_field_specs() method and its arguments
+    # Each specification is created the first time it is used
+    FIELD_SPECS = {}
+
     @staticmethod
-    def are_circuit_id_fields_valid(fields, event_desc,
-                                    is_mandatory=False,
-                                    prefix=None):
+    def get_circuit_id_field_specs(is_mandatory=False,
+                                   prefix=None):
         '''
-        Check if the circuit id fields are valid.
+        Return the field specifications for the circuit id fields.
         If prefix is not none, use it as the field name prefix.
-
-        Returns True if they are all valid, False if one or more are not.
-        Logs a warning using event_desc for the first field that is invalid.
         '''
         if prefix is None:
             prefix = ""
@@ -1877,19 +2621,30 @@ class Aggregator(ReconnectingClientFactory):
         # Channel and Circuit IDs do have maximum values (and CircuitId can't
         # be zero), but there's not much point in checking maxima: the code
         # will work regardless
-        if not is_int_valid("{}ChannelId".format(prefix),
-                            fields, event_desc,
-                            is_mandatory=is_mandatory,
-                            min_value=0):
-            return False
+        return (make_field_spec("{}ChannelId".format(prefix), INT_FIELD,
+                                is_mandatory=is_mandatory,
+                                min_value=0),
+                make_field_spec("{}CircuitId".format(prefix), INT_FIELD,
+                                is_mandatory=is_mandatory,
+                                min_value=0),
+                )
 
-        if not is_int_valid("{}CircuitId".format(prefix),
-                            fields, event_desc,
-                            is_mandatory=is_mandatory,
-                            min_value=0):
-            return False
+    @staticmethod
+    def are_circuit_id_fields_valid(fields, event_desc,
+                                    is_mandatory=False,
+                                    prefix=None):
+        '''
+        Check if the circuit id fields are valid.
+        If prefix is not none, use it as the field name prefix.
 
-        return True
+        Returns True if they are all valid, False if one or more are not.
+        Logs a warning using event_desc for the first field that is invalid.
+        '''
+        return are_fields_valid(fields,
+                                Aggregator.get_circuit_id_field_specs(
+                                    is_mandatory=is_mandatory,
+                                    prefix=prefix),
+                                event_desc)
 
     @staticmethod
     def make_circuit_common_fields_valid(fields, event_desc,
@@ -1934,132 +2689,68 @@ class Aggregator(ReconnectingClientFactory):
             fields.pop("{}IsExitFlag".format(prefix), None)
 
     @staticmethod
-    def are_circuit_common_fields_valid(fields, event_desc,
-                                        is_mandatory=False,
-                                        prefix=None):
+    def get_circuit_common_field_specs(is_mandatory=False,
+                                       prefix=None):
         '''
-        Check if the common fields across the circuit and cell events are
-        valid. If is_mandatory is True, potentially mandatory fields are
-        treated as mandatory. (Some fields are always optional.)
+        Return the field specifications for the common fields across the
+        circuit and cell events. If is_mandatory is True, potentially
+        mandatory fields are treated as mandatory. (Some fields are always
+        optional.)
         If prefix is not none, use it as the field name prefix.
-
-        Returns True if they are all valid, False if one or more are not.
-        Logs a warning using event_desc for the first field that is invalid.
         '''
         if prefix is None:
             prefix = ""
 
-        # Work around some unexpected flags from Tor
-        Aggregator.make_circuit_common_fields_valid(fields, event_desc,
-                                                    is_mandatory=is_mandatory,
-                                                    prefix=prefix)
+        spec_key = ("get_circuit_common_field_specs", is_mandatory, prefix)
+        if spec_key in Aggregator.FIELD_SPECS:
+            return Aggregator.FIELD_SPECS[spec_key]
 
         # Validate the potentially mandatory fields
-
-        if not is_float_valid("EventTimestamp",
-                              fields, event_desc,
-                              is_mandatory=is_mandatory,
-                              min_value=0.0):
-            return False
+        field_specs = [make_field_spec("EventTimestamp", FLOAT_FIELD,
+                                       is_mandatory=is_mandatory,
+                                       min_value=0.0)]
 
         # Validate the always optional fields
 
         # in some rare cases, NextChannelId can be missing
-        if not Aggregator.are_circuit_id_fields_valid(fields, event_desc,
-                                                      is_mandatory=False,
-                                                      prefix="{}Next"
-                                                      .format(prefix)):
-            return False
-
-
-        if not Aggregator.are_circuit_id_fields_valid(fields, event_desc,
-                                                      is_mandatory=False,
-                                                      prefix="{}Previous"
-                                                      .format(prefix)):
-            return False
+        field_specs.extend(Aggregator.get_circuit_id_field_specs(
+                                is_mandatory=False,
+                                prefix="{}Next".format(prefix)))
+        field_specs.extend(Aggregator.get_circuit_id_field_specs(
+                                is_mandatory=False,
+                                prefix="{}Previous".format(prefix)))
 
         # We could try to validate that the position flags occur in the right
         # combinations, but the Tor patch already does that
 
         # These flags are only present when they are 1
-        if not is_flag_valid("{}IsOriginFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        if not is_flag_valid("{}IsEntryFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        if not is_flag_valid("{}IsMidFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        if not is_flag_valid("{}IsEndFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
         # Similarly, the Tor patch checks some subcategory combinations
-        if not is_flag_valid("{}IsExitFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        if not is_flag_valid("{}IsDirFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        if not is_flag_valid("{}IsHSDirFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        if not is_flag_valid("{}IsIntroFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        # Only appears when IsIntroFlag and IsHSClientSideFlag are true
-        # But there's not much point in checking for that
-        if not is_flag_valid("{}IsClientIntroLegacyFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        if not is_flag_valid("{}IsRendFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        # This flag is only present for HSDir and Intro positions,
-        # but is present whether it is 0 or 1
-        if not is_flag_valid("{}IsHSClientSideFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        # This flag is only present when it is 1
-        if not is_flag_valid("{}IsMarkedForCloseFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
+        # IsClientIntroLegacyFlag only appears when IsIntroFlag and
+        # IsHSClientSideFlag are true, but there's not much point in checking
+        # for that
+        for flag_name in ["IsOriginFlag", "IsEntryFlag", "IsMidFlag",
+                          "IsEndFlag", "IsExitFlag", "IsDirFlag",
+                          "IsHSDirFlag", "IsIntroFlag",
+                          "IsClientIntroLegacyFlag", "IsRendFlag",
+                          # This flag is only present for HSDir and Intro
+                          # positions, but is present whether it is 0 or 1
+                          "IsHSClientSideFlag",
+                          # This flag is only present when it is 1
+                          "IsMarkedForCloseFlag"]:
+            field_specs.append(make_field_spec("{}{}".format(prefix,
+                                                             flag_name),
+                                               FLAG_FIELD))
 
         # Make sure we were designed to work with the event's
         # HiddenServiceVersionNumber
-        if not Aggregator.is_hs_version_valid(fields, event_desc,
-                                              is_mandatory=False,
-                                              prefix=prefix):
-            return False
+        field_specs.append(Aggregator.get_hs_version_field_spec(
+                                is_mandatory=False,
+                                prefix=prefix))
 
         # This flag is only present when it is 1
-        if not is_flag_valid("{}HasReceivedCreateCellFlag".format(prefix),
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
+        field_specs.append(make_field_spec(
+                                "{}HasReceivedCreateCellFlag".format(prefix),
+                                FLAG_FIELD))
 
         # This flag is only present when HasReceivedCreateCellFlag is 1
         # (and this circuit is an OR circuit)
@@ -2067,103 +2758,108 @@ class Aggregator(ReconnectingClientFactory):
         # ONION_HANDSHAKE_TYPE_TAP  0x0000
         # ONION_HANDSHAKE_TYPE_FAST 0x0001
         # ONION_HANDSHAKE_TYPE_NTOR 0x0002
-        if not is_int_valid("{}OnionHandshakeType".format(prefix),
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0, max_value=2):
-            return False
+        field_specs.append(make_field_spec(
+                                "{}OnionHandshakeType".format(prefix),
+                                INT_FIELD,
+                                min_value=0, max_value=2))
 
         # 50 is an arbitrary maximum failure reason length
-        if not is_string_valid("{}FailureReasonString".format(prefix),
-                    fields, event_desc,
-                    is_mandatory=False,
-                    min_len=1, max_len=50):
-            return False
+        field_specs.append(make_field_spec(
+                                "{}FailureReasonString".format(prefix),
+                                STRING_FIELD,
+                                min_value=1, max_value=50))
 
-        if not is_int_valid("{}ExitStreamCount".format(prefix),
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=1, max_value=None):
-            return False
+        field_specs.append(make_field_spec(
+                                "{}ExitStreamCount".format(prefix),
+                                INT_FIELD,
+                                min_value=1, max_value=None))
 
-        # if everything passed, this much is ok
-        return True
+        field_specs = tuple(field_specs)
+        Aggregator.FIELD_SPECS[spec_key] = field_specs
+        return field_specs
 
     @staticmethod
-    def are_circuit_cell_fields_valid(fields, event_desc):
+    def are_circuit_common_fields_valid(fields, event_desc,
+                                        is_mandatory=False,
+                                        prefix=None):
         '''
-        Check if the PRIVCOUNT_CIRCUIT_CELL fields are valid.
+        Check if the common fields across the circuit and cell events are
+        valid. If is_mandatory is True, potentially mandatory fields are
+        treated as mandatory. (Some fields are always optional.)
+        If prefix is not none, use it as the field name prefix.
+
         Returns True if they are all valid, False if one or more are not.
         Logs a warning using event_desc for the first field that is invalid.
         '''
+        # Work around some unexpected flags from Tor
+        Aggregator.make_circuit_common_fields_valid(fields, event_desc,
+                                                    is_mandatory=is_mandatory,
+                                                    prefix=prefix)
 
-        if not Aggregator.are_circuit_common_fields_valid(fields, event_desc,
-                                                          is_mandatory=True,
-                                                          prefix=None):
-            return False
-
-        # Validate the mandatory cell-specific fields
-
-
-        if not is_flag_valid("IsSentFlag",
-                             fields, event_desc,
-                             is_mandatory=True):
-            return False
+        return are_fields_valid(fields,
+                                Aggregator.get_circuit_common_field_specs(
+                                    is_mandatory=is_mandatory,
+                                    prefix=prefix),
+                                event_desc)
 
-        # the cell circuit id is allowed to be zero, for non-circuit cells
-        if not is_int_valid("CellCircuitId",
-                            fields, event_desc,
+    @staticmethod
+    def get_circuit_cell_field_specs():
+        '''
+        Return the field specifications for the PRIVCOUNT_CIRCUIT_CELL
+        fields.
+        '''
+        spec_key = ("get_circuit_cell_field_specs",)
+        if spec_key in Aggregator.FIELD_SPECS:
+            return Aggregator.FIELD_SPECS[spec_key]
+
+        field_specs = Aggregator.get_circuit_common_field_specs(
+                                                    is_mandatory=True,
+                                                    prefix=None)
+        field_specs += (
+            # Validate the mandatory cell-specific fields
+            make_field_spec("IsSentFlag", FLAG_FIELD,
+                            is_mandatory=True),
+            # the cell circuit id is allowed to be zero, for non-circuit
+            # cells
+            make_field_spec("CellCircuitId", INT_FIELD,
                             is_mandatory=True,
-                            min_value=0):
-            return False
-
-        # 50 is an arbitrary limit, the current maximum is 14 characters
-        if not is_string_valid("CellCommandString",
-                               fields, event_desc,
-                               is_mandatory=True,
-                               min_len=1,
-                               max_len=50):
-            return False
-
-        # Validate the optional cell-specific fields
-
-        if not is_flag_valid("IsOutboundFlag",
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
-
-        if not is_int_valid("RelayCellPayloadByteCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
-
-        if not is_int_valid("RelayCellStreamId",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
-
-        # 50 is an arbitrary limit, the current maximum is 22 characters
-        if not is_string_valid("RelayCellCommandString",
-                               fields, event_desc,
-                               is_mandatory=False,
-                               min_len=1,
-                               max_len=50):
-            return False
-
-        if not is_flag_valid("IsRecognizedFlag",
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
+                            min_value=0),
+            # 50 is an arbitrary limit, the current maximum is 14 characters
+            make_field_spec("CellCommandString", STRING_FIELD,
+                            is_mandatory=True,
+                            min_value=1, max_value=50),
+
+            # Validate the optional cell-specific fields
+            make_field_spec("IsOutboundFlag", FLAG_FIELD),
+            make_field_spec("RelayCellPayloadByteCount", INT_FIELD,
+                            min_value=0),
+            make_field_spec("RelayCellStreamId", INT_FIELD,
+                            min_value=0),
+            # 50 is an arbitrary limit, the current maximum is 22 characters
+            make_field_spec("RelayCellCommandString", STRING_FIELD,
+                            min_value=1, max_value=50),
+            make_field_spec("IsRecognizedFlag", FLAG_FIELD),
+            make_field_spec("WasRelayCryptSuccessfulFlag", FLAG_FIELD),
+            )
+
+        Aggregator.FIELD_SPECS[spec_key] = field_specs
+        return field_specs
 
-        if not is_flag_valid("WasRelayCryptSuccessfulFlag",
-                             fields, event_desc,
-                             is_mandatory=False):
-            return False
+    @staticmethod
+    def are_circuit_cell_fields_valid(fields, event_desc):
+        '''
+        Check if the PRIVCOUNT_CIRCUIT_CELL fields are valid.
+        Returns True if they are all valid, False if one or more are not.
+        Logs a warning using event_desc for the first field that is invalid.
+        '''
+        # Work around some unexpected flags from Tor
+        Aggregator.make_circuit_common_fields_valid(fields, event_desc,
+                                                    is_mandatory=True,
+                                                    prefix=None)
 
-        # if everything passed, we're ok
-        return True
+        return are_fields_valid(fields,
+                                Aggregator.get_circuit_cell_field_specs(),
+                                event_desc)
 
     def _handle_viterbi_packets_event(self, fields):
         event_desc = "in PRIVCOUNT_VITERBI_PACKETS event"
@@ -2298,210 +2994,151 @@ class Aggregator(ReconnectingClientFactory):
         return True
 
     @staticmethod
-    def are_circuit_node_fields_valid(fields, event_desc,
-                                      is_mandatory=False,
-                                      prefix=None):
+    def get_circuit_node_field_specs(is_mandatory=False,
+                                     prefix=None):
         '''
-        Check if the circuit node fields are valid.
+        Return the field specifications for the circuit node fields.
         If prefix is not none, use it as the field name prefix.
-
-        Returns True if they are all valid, False if one or more are not.
-        Logs a warning using event_desc for the first field that is invalid.
         '''
         if prefix is None:
             prefix = ""
 
-        if not is_ip_address_valid("{}NodeIPAddress".format(prefix),
-                                   fields, event_desc,
-                                   is_mandatory=is_mandatory):
-            return False
-
-        if not is_string_valid("{}NodeFingerprint".format(prefix),
-                               fields, event_desc,
-                               is_mandatory=is_mandatory,
-                               min_len=40,
-                               max_len=40):
-            return False
-
-        # All nodes have the Running flag in their networkstatus.
-        # Almost all nodes have the Valid flag as well
-        # 20 is an arbitrary limit, there are currently only 10 flags
-        if not is_list_valid("{}NodeRelayFlagList".format(prefix),
-                               fields, event_desc,
-                               is_mandatory=is_mandatory,
-                               min_count=1,
-                               max_count=20):
-            return False
-
-        return True
+        return (make_field_spec("{}NodeIPAddress".format(prefix),
+                                IP_ADDRESS_FIELD,
+                                is_mandatory=is_mandatory),
+                make_field_spec("{}NodeFingerprint".format(prefix),
+                                STRING_FIELD,
+                                is_mandatory=is_mandatory,
+                                min_value=40, max_value=40),
+                # All nodes have the Running flag in their networkstatus.
+                # Almost all nodes have the Valid flag as well
+                # 20 is an arbitrary limit, there are currently only 10 flags
+                make_field_spec("{}NodeRelayFlagList".format(prefix),
+                                LIST_FIELD,
+                                is_mandatory=is_mandatory,
+                                min_value=1, max_value=20),
+                )
 
     @staticmethod
-    def are_circuit_close_fields_valid(fields, event_desc):
-        '''
-        Check if the PRIVCOUNT_CIRCUIT_CLOSE fields are valid.
-        Returns True if they are all valid, False if one or more are not.
-        Logs a warning using event_desc for the first field that is invalid.
+    def are_circuit_node_fields_valid(fields, event_desc,
+                                      is_mandatory=False,
+                                      prefix=None):
         '''
+        Check if the circuit node fields are valid.
+        If prefix is not none, use it as the field name prefix.
 
-        if not Aggregator.are_circuit_common_fields_valid(fields, event_desc,
-                                                          is_mandatory=True,
-                                                          prefix=None):
-            return False
-
-        # Validate the mandatory circuit-specific fields
-        if not is_float_valid("CreatedTimestamp",
-                              fields, event_desc,
-                              is_mandatory=True,
-                              min_value=0.0):
-            return False
-
-        if not is_flag_valid("IsLegacyCircuitEndEventFlag",
-                             fields, event_desc,
-                             is_mandatory=True):
-            return False
-
-        # 50 is an arbitrary limit, the current maximum is 11 characters
-        if not is_string_valid("StateString",
-                               fields, event_desc,
-                               is_mandatory=True,
-                               min_len=1,
-                               max_len=50):
-            return False
-
-        if not is_int_valid("PurposeCode",
-                            fields, event_desc,
-                            is_mandatory=True,
-                            min_value=1,
-                            max_value=20):
-            return False
-
-        # Validate the optional circuit-specific fields
-
-        # 50 is an arbitrary limit, the current maximum is 17 characters
-        if not is_string_valid("PurposeString",
-                               fields, event_desc,
-                               is_mandatory=False,
-                               min_len=1,
-                               max_len=50):
-            return False
-
-        # We don't check if the purpose and hidden service state match
-        # 50 is an arbitrary limit, the current maximum is 24 characters
-        if not is_string_valid("HSStateString",
-                               fields, event_desc,
-                               is_mandatory=False,
-                               min_len=1,
-                               max_len=50):
-            return False
-
-        # Check the connected node fields
-
-        if not Aggregator.are_circuit_node_fields_valid(fields, event_desc,
-                                                        is_mandatory=False,
-                                                        prefix="Previous"):
-            return False
-
-        if not Aggregator.are_circuit_node_fields_valid(fields, event_desc,
-                                                        is_mandatory=False,
-                                                        prefix="Next"):
-            return False
-
-        # Check the related circuit fields
-
-        if not Aggregator.are_circuit_common_fields_valid(
-                                                    fields, event_desc,
-                                                    is_mandatory=False,
-                                                    prefix="IntroClientSink"):
-            return False
-
-
-        if not Aggregator.are_circuit_common_fields_valid(
-                                                    fields, event_desc,
-                                                    is_mandatory=False,
-                                                    prefix="RendSplice"):
-            return False
-
-        # Check the cell and byte counts
-
-        if not is_int_valid("InboundSentCellCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
-
-        if not is_int_valid("InboundReceivedCellCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
-
-        if not is_int_valid("OutboundSentCellCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
+        Returns True if they are all valid, False if one or more are not.
+        Logs a warning using event_desc for the first field that is invalid.
+        '''
+        return are_fields_valid(fields,
+                                Aggregator.get_circuit_node_field_specs(
+                                    is_mandatory=is_mandatory,
+                                    prefix=prefix),
+                                event_desc)
 
-        if not is_int_valid("OutboundReceivedCellCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
+    # The prefixes of the related circuit fields in PRIVCOUNT_CIRCUIT_CLOSE
+    CIRCUIT_CLOSE_RELATED_PREFIXES = ("IntroClientSink", "RendSplice")
 
-        if not is_int_valid("InboundExitCellCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
+    @staticmethod
+    def get_circuit_close_field_specs():
+        '''
+        Return the field specifications for the PRIVCOUNT_CIRCUIT_CLOSE
+        fields.
+        '''
+        spec_key = ("get_circuit_close_field_specs",)
+        if spec_key in Aggregator.FIELD_SPECS:
+            return Aggregator.FIELD_SPECS[spec_key]
 
-        if not is_int_valid("OutboundExitCellCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
+        field_specs = Aggregator.get_circuit_common_field_specs(
+                                                    is_mandatory=True,
+                                                    prefix=None)
+        field_specs += (
+            # Validate the mandatory circuit-specific fields
+            make_field_spec("CreatedTimestamp", FLOAT_FIELD,
+                            is_mandatory=True,
+                            min_value=0.0),
+            make_field_spec("IsLegacyCircuitEndEventFlag", FLAG_FIELD,
+                            is_mandatory=True),
+            # 50 is an arbitrary limit, the current maximum is 11 characters
+            make_field_spec("StateString", STRING_FIELD,
+                            is_mandatory=True,
+                            min_value=1, max_value=50),
+            make_field_spec("PurposeCode", INT_FIELD,
+                            is_mandatory=True,
+                            min_value=1, max_value=20),
 
-        if not is_int_valid("InboundExitByteCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
+            # Validate the optional circuit-specific fields
 
-        if not is_int_valid("OutboundExitByteCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
+            # 50 is an arbitrary limit, the current maximum is 17 characters
+            make_field_spec("PurposeString", STRING_FIELD,
+                            min_value=1, max_value=50),
+            # We don't check if the purpose and hidden service state match
+            # 50 is an arbitrary limit, the current maximum is 24 characters
+            make_field_spec("HSStateString", STRING_FIELD,
+                            min_value=1, max_value=50),
+            )
 
-        if not is_int_valid("InboundDirByteCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
+        # Check the connected node fields
+        field_specs += Aggregator.get_circuit_node_field_specs(
+                                                    is_mandatory=False,
+                                                    prefix="Previous")
+        field_specs += Aggregator.get_circuit_node_field_specs(
+                                                    is_mandatory=False,
+                                                    prefix="Next")
 
-        if not is_int_valid("OutboundDirByteCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0):
-            return False
+        # Check the related circuit fields
+        for prefix in Aggregator.CIRCUIT_CLOSE_RELATED_PREFIXES:
+            field_specs += Aggregator.get_circuit_common_field_specs(
+                                                    is_mandatory=False,
+                                                    prefix=prefix)
 
-        # if everything passed, we're ok
-        return True
+        # Check the cell and byte counts
+        for count_name in ["InboundSentCellCount",
+                           "InboundReceivedCellCount",
+                           "OutboundSentCellCount",
+                           "OutboundReceivedCellCount",
+                           "InboundExitCellCount",
+                           "OutboundExitCellCount",
+                           "InboundExitByteCount",
+                           "OutboundExitByteCount",
+                           "InboundDirByteCount",
+                           "OutboundDirByteCount"]:
+            field_specs += (make_field_spec(count_name, INT_FIELD,
+                                            min_value=0),)
+
+        Aggregator.FIELD_SPECS[spec_key] = field_specs
+        return field_specs
 
-    def _increment_circuit_close_status_counters(self, counter_prefix,
-                                                 counter_suffix,
-                                                 is_active,
-                                                 is_failure,
-                                                 bin=SINGLE_BIN,
-                                                 inc=1):
+    @staticmethod
+    def are_circuit_close_fields_valid(fields, event_desc):
         '''
-        Increment bin by inc for the counter variants starting with
-        counter_prefix and ending in counter_suffix, using is_active and
-        is_failure to create counter names.
-
-        Unknown counter names are ignored.
+        Check if the PRIVCOUNT_CIRCUIT_CLOSE fields are valid.
+        Returns True if they are all valid, False if one or more are not.
+        Logs a warning using event_desc for the first field that is invalid.
         '''
-        assert counter_prefix is not None
-        assert counter_suffix is not None
+        # Work around some unexpected flags from Tor
+        Aggregator.make_circuit_common_fields_valid(fields, event_desc,
+                                                    is_mandatory=True,
+                                                    prefix=None)
+        for prefix in Aggregator.CIRCUIT_CLOSE_RELATED_PREFIXES:
+            Aggregator.make_circuit_common_fields_valid(fields, event_desc,
+                                                        is_mandatory=False,
+                                                        prefix=prefix)
 
+        return are_fields_valid(fields,
+                                Aggregator.get_circuit_close_field_specs(),
+                                event_desc)
+
+    @staticmethod
+    def _get_circuit_close_status_counter_names(counter_prefix,
+                                                counter_suffix,
+                                                is_active,
+                                                is_failure):
+        '''
+        Return a list of the counter variants starting with counter_prefix
+        and ending in counter_suffix, using is_active and is_failure to create
+        counter names.
+        '''
         if is_active:
             activity = "Active"
         else:
@@ -2512,33 +3149,57 @@ class Aggregator(ReconnectingClientFactory):
         else:
             status = "Success"
 
-        # Prefix Circuit Suffix
-        self.secure_counters.increment('{}Circuit{}'
-                                       .format(counter_prefix, counter_suffix),
-                                       bin=bin,
-                                       inc=inc)
-
-        # Prefix Failure/Success Circuit Suffix
-        self.secure_counters.increment('{}{}Circuit{}'
-                                       .format(counter_prefix, status, counter_suffix),
-                                       bin=bin,
-                                       inc=inc)
+        counter_names = [
+            # Prefix Circuit Suffix
+            '{}Circuit{}'.format(counter_prefix, counter_suffix),
+            # Prefix Failure/Success Circuit Suffix
+            '{}{}Circuit{}'.format(counter_prefix, status, counter_suffix),
+            ]
 
         # Exit, Dir, and HSDir are always Active
         if (not counter_prefix.startswith("Exit") and
             not counter_prefix.startswith("Dir") and
             not counter_prefix.startswith("HSDir")):
-            # Prefix Active/Inactive Circuit Suffix
-            self.secure_counters.increment('{}{}Circuit{}'
-                                           .format(counter_prefix, activity, counter_suffix),
-                                           bin=bin,
-                                           inc=inc)
+            counter_names.extend([
+                # Prefix Active/Inactive Circuit Suffix
+                '{}{}Circuit{}'.format(counter_prefix, activity,
+                                       counter_suffix),
+                # Prefix Active/Inactive Failure/Success Circuit Suffix
+                '{}{}{}Circuit{}'.format(counter_prefix, activity, status,
+                                         counter_suffix),
+                ])
 
-            # Prefix Active/Inactive Failure/Success Circuit Suffix
-            self.secure_counters.increment('{}{}Circuit{}'
-                                           .format(counter_prefix, activity, status, counter_suffix),
-                                           bin=bin,
-                                           inc=inc)
+        return counter_names
+
+    def _increment_circuit_close_status_counters(self, counter_prefix,
+                                                 counter_suffix,
+                                                 is_active,
+                                                 is_failure,
+                                                 bin=SINGLE_BIN,
+                                                 inc=1):
+        '''
+        Increment bin by inc for the counter variants starting with
+        counter_prefix and ending in counter_suffix, using is_active and
+        is_failure to create counter names.
+
+        Unknown counter names are ignored.
+        '''
+        assert counter_prefix is not None
+        assert counter_suffix is not None
+
+        handle_key = (counter_prefix, counter_suffix,
+                      bool(is_active), bool(is_failure))
+        handles = self.circuit_close_status_handles.get(handle_key)
+        if handles is None:
+            handles = self._resolve_counter_handles(
+                Aggregator._get_circuit_close_status_counter_names(
+                    *handle_key))
+            self.circuit_close_status_handles[handle_key] = handles
+
+        increment_bin_index = self.secure_counters.increment_bin_index
+        for handle in handles:
+            if handle is not None:
+                increment_bin_index(handle, bin=bin, inc=inc)
 
     def _increment_circuit_close_hs_status_counters(self, counter_prefix,
                                                     counter_suffix,
@@ -2598,6 +3259,10 @@ class Aggregator(ReconnectingClientFactory):
         '''
         assert counter_suffix is not None
 
+        # skip all the variants if none of them are being collected
+        if counter_suffix not in self.needs_circuit_close_suffixes:
+            return
+
         is_single_hop = is_entry and is_end
 
         # Positions: at least one of these flags is true for each circuit
@@ -2846,11 +3511,16 @@ class Aggregator(ReconnectingClientFactory):
                                    fields, event_desc,
                                    is_mandatory=True)
 
-        if is_legacy:
+        if is_legacy and self.needs_legacy_circuit_info:
             if not self._handle_legacy_exit_circuit_event(fields, event_desc):
                 logging.warning("Error while processing legacy circuit event with '{}' {}"
                                 .format(" ".join(sorted(fields)), event_desc))
 
+        # skip the rest of the event if we aren't collecting any of its
+        # counter variants
+        if len(self.needs_circuit_close_suffixes) == 0:
+            return True
+
         # Extract mandatory fields
         start_time = get_float_value("CreatedTimestamp",
                                      fields, event_desc,
@@ -3032,7 +3702,8 @@ class Aggregator(ReconnectingClientFactory):
                                                inc=1)
 
         # Only increment Failure Reasons for failed circuits
-        if is_failure:
+        if (is_failure and
+            "ReasonCountList" in self.needs_circuit_close_suffixes):
 
             reason_exact_match_bin = Aggregator._exact_match_bin(self.circuit_failure_exact_objs,
                                                                  failure_string)
@@ -3057,56 +3728,31 @@ class Aggregator(ReconnectingClientFactory):
     # We actually see up to 3 on the live network, but it's pretty rare
     MAX_IP_RELAY_COUNTER = 2
 
-    @staticmethod
-    def are_connection_close_fields_valid(fields, event_desc):
-        '''
-        Check if the PRIVCOUNT_CONNECTION_CLOSE fields are valid.
-        Returns True if they are all valid, False if one or more are not.
-        Logs a warning using event_desc for the first field that is invalid.
-        '''
-
+    # Field specifications for the PRIVCOUNT_CONNECTION_CLOSE fields
+    CONNECTION_CLOSE_FIELD_SPECS = (
         # Validate the mandatory fields
-
-        if not is_float_valid("EventTimestamp",
-                              fields, event_desc,
-                              is_mandatory=True,
-                              min_value=0.0):
-            return False
-
-        if not is_float_valid("CreatedTimestamp",
-                              fields, event_desc,
-                              is_mandatory=True,
-                              min_value=0.0):
-            return False
-
-        if not is_int_valid("ChannelId",
-                            fields, event_desc,
-                            is_mandatory=True,
-                            min_value=0):
-            return False
-
-        if not is_flag_valid("RemoteIsClientFlag",
-                             fields, event_desc,
-                             is_mandatory=True):
-            return False
-
-        if not is_ip_address_valid("RemoteIPAddress",
-                                   fields, event_desc,
-                                   is_mandatory=True):
-            return False
-
+        make_field_spec("EventTimestamp", FLOAT_FIELD,
+                        is_mandatory=True,
+                        min_value=0.0),
+        make_field_spec("CreatedTimestamp", FLOAT_FIELD,
+                        is_mandatory=True,
+                        min_value=0.0),
+        make_field_spec("ChannelId", INT_FIELD,
+                        is_mandatory=True,
+                        min_value=0),
+        make_field_spec("RemoteIsClientFlag", FLAG_FIELD,
+                        is_mandatory=True),
+        make_field_spec("RemoteIPAddress", IP_ADDRESS_FIELD,
+                        is_mandatory=True),
         # the number of possible OR connections from a remote IP address is
         # limited by the number of available ports on the remote host.
         # (There are only a few ORPorts on this host, typically one or two.)
         # Allow for 2x as many connections as the limit. This allows for
         # connections that are marked for close (and may have been closed by
         # the OS already), and IPv4 and IPv6 ORPorts.
-        if not is_int_valid("RemoteIPAddressConnectionCount",
-                            fields, event_desc,
-                            is_mandatory=True,
-                            min_value=0, max_value=2**17):
-            return False
-
+        make_field_spec("RemoteIPAddressConnectionCount", INT_FIELD,
+                        is_mandatory=True,
+                        min_value=0, max_value=2**17),
         # the number of relays in the consensus on the PeerIPAddress,
         # if present, or if not, the RemoteIPAddress. This should be limited
         # to 2 by the directory authorities, except in test networks.
@@ -3114,60 +3760,48 @@ class Aggregator(ReconnectingClientFactory):
         # warning when we see more than 2. (100 may be too small for shadow
         # and other large-scale simulators, but they should be using unique
         # addresses anyway.)
-        if not is_int_valid("PeerIPAddressConsensusRelayCount",
-                            fields, event_desc,
-                            is_mandatory=True,
-                            min_value=0, max_value=100):
-            return False
-
-        ip_relay_count = get_int_value("PeerIPAddressConsensusRelayCount",
-                                       fields, event_desc,
-                                       is_mandatory=True)
-
-        # Allow triple the limit before issuing a warning
-        if ip_relay_count > Aggregator.MAX_IP_RELAY_COUNTER * 3:
-            Aggregator.warn_unexpected_field_value("PeerIPAddressConsensusRelayCount",
-                                                   fields, event_desc)
+        make_field_spec("PeerIPAddressConsensusRelayCount", INT_FIELD,
+                        is_mandatory=True,
+                        min_value=0, max_value=100),
 
         # Validate the optional fields
 
         # Only present when the remote end is an authenticated peer relay
-        if not is_ip_address_valid("PeerIPAddress",
-                                   fields, event_desc,
-                                   is_mandatory=False):
-            return False
+        make_field_spec("PeerIPAddress", IP_ADDRESS_FIELD),
 
         # Only present in newer PrivCount Tor Patch versions
+        make_field_spec("InboundByteCount", INT_FIELD,
+                        min_value=0, max_value=None),
+        make_field_spec("OutboundByteCount", INT_FIELD,
+                        min_value=0, max_value=None),
+        make_field_spec("InboundCircuitCount", INT_FIELD,
+                        min_value=0, max_value=None),
+        make_field_spec("OutboundCircuitCount", INT_FIELD,
+                        min_value=0, max_value=None),
+        make_field_spec("RemoteCountryCode", STRING_FIELD,
+                        min_value=2, max_value=2),
+        )
 
-        if not is_int_valid("InboundByteCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0, max_value=None):
-            return False
-
-        if not is_int_valid("OutboundByteCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0, max_value=None):
-            return False
-
-        if not is_int_valid("InboundCircuitCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0, max_value=None):
+    @staticmethod
+    def are_connection_close_fields_valid(fields, event_desc):
+        '''
+        Check if the PRIVCOUNT_CONNECTION_CLOSE fields are valid.
+        Returns True if they are all valid, False if one or more are not.
+        Logs a warning using event_desc for the first field that is invalid.
+        '''
+        if not are_fields_valid(fields,
+                                Aggregator.CONNECTION_CLOSE_FIELD_SPECS,
+                                event_desc):
             return False
 
-        if not is_int_valid("OutboundCircuitCount",
-                            fields, event_desc,
-                            is_mandatory=False,
-                            min_value=0, max_value=None):
-            return False
+        ip_relay_count = get_int_value("PeerIPAddressConsensusRelayCount",
+                                       fields, event_desc,
+                                       is_mandatory=True)
 
-        if not is_string_valid("RemoteCountryCode",
-                               fields, event_desc,
-                               is_mandatory=False,
-                               min_len=2, max_len=2):
-            return False
+        # Allow triple the limit before issuing a warning
+        if ip_relay_count > Aggregator.MAX_IP_RELAY_COUNTER * 3:
+            Aggregator.warn_unexpected_field_value("PeerIPAddressConsensusRelayCount",
+                                                   fields, event_desc)
 
         # if everything passed, we're ok
         return True
@@ -3186,13 +3820,41 @@ class Aggregator(ReconnectingClientFactory):
         is not in the table in counters.py. Otherwise, unknown names are
         ignored.
         '''
-        # create counter names from is_client and ip_relay_count
+        has_relay = ip_relay_count > 0
+        handle_key = (counter_suffix, bool(is_client), has_relay)
+        entry = self.connection_close_handles.get(handle_key)
+        if entry is None:
+            entry = self._resolve_connection_close_variants(*handle_key)
+            self.connection_close_handles[handle_key] = entry
+        (handles, unknown_counters) = entry
+
+        # warn the operator if we don't know the counter name
+        if log_missing_counters:
+            for (counter_name, origin_desc) in unknown_counters:
+                logging.warning("Ignored unknown counter {} from {} {}. Is your PrivCount Tor version newer than your PrivCount version?"
+                                .format(counter_name, origin_desc, event_desc))
+
+        # Increment the counters
+        increment_bin_index = self.secure_counters.increment_bin_index
+        for handle in handles:
+            if handle is not None:
+                increment_bin_index(handle, bin=bin, inc=inc)
+
+    def _resolve_connection_close_variants(self, counter_suffix,
+                                           is_client, has_relay):
+        '''
+        Create the connection counter variant names ending in
+        counter_suffix, using is_client and has_relay.
+        Returns a tuple containing the counter handles for the names, and a
+        list of (counter_name, origin_desc) for unknown counter names.
+        '''
+        # create counter names from is_client and has_relay
 
         # If the remote end is a client, this is an entry connection,
         # otherwise, it's middle or exit or both
         position_str = "Entry" if is_client else "NonEntry"
         # Say if the remote end has relays on its address
-        if ip_relay_count > 0:
+        if has_relay:
             shared_relay_str = "RelayOnAddress"
         else:
             shared_relay_str = "NoRelayOnAddress"
@@ -3203,24 +3865,19 @@ class Aggregator(ReconnectingClientFactory):
                                                          shared_relay_str,
                                                          counter_suffix)
 
-        # warn the operator if we don't know the counter name
-        if log_missing_counters:
+        valid_counters = get_valid_counters()
+        unknown_counters = []
+        if position_counter not in valid_counters:
             position_origin = "RemoteIsClientFlag and {}".format(counter_suffix)
-            Aggregator.warn_unknown_counter(position_counter,
-                                            position_origin,
-                                            event_desc)
+            unknown_counters.append((position_counter, position_origin))
+        if shared_relay_counter not in valid_counters:
             shared_relay_origin= "RemoteIsClientFlag and PeerIPAddressConsensusRelayCount and {}".format(counter_suffix)
-            Aggregator.warn_unknown_counter(shared_relay_counter,
-                                            shared_relay_origin,
-                                            event_desc)
+            unknown_counters.append((shared_relay_counter,
+                                     shared_relay_origin))
 
-        # Increment the counters
-        self.secure_counters.increment(position_counter,
-                                       bin=bin,
-                                       inc=inc)
-        self.secure_counters.increment(shared_relay_counter,
-                                       bin=bin,
-                                       inc=inc)
+        handles = self._resolve_counter_handles([position_counter,
+                                                 shared_relay_counter])
+        return (handles, unknown_counters)
 
     def _increment_connection_close_histograms(self, subcategory,
                                                inbound_bytes, outbound_bytes,
@@ -3535,9 +4192,6 @@ class Aggregator(ReconnectingClientFactory):
                                               fields, event_desc,
                                               is_mandatory=True)
 
-        remote_as = ipasn_prefix_match(self.as_prefix_map_objs.get(remote_ip_obj.version),
-                                       remote_ip_obj)
-
         # Extract the optional fields, and give them defaults
 
         inbound_bytes = get_int_value("InboundByteCount",
@@ -3569,23 +4223,57 @@ class Aggregator(ReconnectingClientFactory):
         # Increment counters for mandatory fields and optional fields that
         # have defaults
 
-        self._increment_connection_close_counters("",
+        if self.needs_connection_close:
+            self._increment_connection_close_counters("",
+                                                      inbound_bytes, outbound_bytes,
+                                                      inbound_circuits, outbound_circuits,
+                                                      elapsed_time,
+                                                      ip_connection_count,
+                                                      is_client, ip_relay_count,
+                                                      event_desc,
+                                                      log_missing_counters=True)
+
+        if self.needs_connection_close_country_match:
+            self._increment_connection_close_country_match(country_code,
+                                                           inbound_bytes, outbound_bytes,
+                                                           inbound_circuits, outbound_circuits,
+                                                           elapsed_time,
+                                                           ip_connection_count,
+                                                           is_client, ip_relay_count,
+                                                           event_desc)
+
+        if self.needs_connection_close_as_match:
+            remote_as = ipasn_prefix_match(self.as_prefix_map_objs.get(remote_ip_obj.version),
+                                           remote_ip_obj)
+            self._increment_connection_close_as_match(remote_as,
+                                                      inbound_bytes, outbound_bytes,
+                                                      inbound_circuits, outbound_circuits,
+                                                      elapsed_time,
+                                                      ip_connection_count,
+                                                      is_client, ip_relay_count,
+                                                      event_desc)
+
+        # we processed and handled the event
+        return True
+
+    def _increment_connection_close_country_match(self, country_code,
                                                   inbound_bytes, outbound_bytes,
                                                   inbound_circuits, outbound_circuits,
                                                   elapsed_time,
                                                   ip_connection_count,
                                                   is_client, ip_relay_count,
-                                                  event_desc,
-                                                  log_missing_counters=True)
-
-
+                                                  event_desc):
+        '''
+        Increment the connection counters for country_code matches.
+        '''
         # Increment counters for country code matches
         country_exact_match_bin = Aggregator._exact_match_bin(self.country_exact_objs,
                                                               country_code)
+        (match_str, no_match_str) = CONNECTION_MATCH_SUBCATEGORIES['Country']
         if country_exact_match_bin == 0:
-            exact_match_str = "CountryMatch"
+            exact_match_str = match_str
         else:
-            exact_match_str = "CountryNoMatch"
+            exact_match_str = no_match_str
 
         # The first country list is used for the *CountryMatchConnection, LifeTime and *Histogram counters
         # Their *CountryNoMatchConnection equivalents are used when there is no match in the first list
@@ -3601,7 +4289,7 @@ class Aggregator(ReconnectingClientFactory):
         # Now that we know which list matched, increment its CountList
         # counters. Instead of using NoMatch counters, we increment the
         # final bin if none of the lists match
-        self._increment_connection_close_count_lists("CountryMatch",
+        self._increment_connection_close_count_lists(match_str,
                                                      country_exact_match_bin,
                                                      inbound_bytes, outbound_bytes,
                                                      inbound_circuits, outbound_circuits,
@@ -3609,14 +4297,24 @@ class Aggregator(ReconnectingClientFactory):
                                                      event_desc,
                                                      log_missing_counters=True)
 
-
+    def _increment_connection_close_as_match(self, remote_as,
+                                             inbound_bytes, outbound_bytes,
+                                             inbound_circuits, outbound_circuits,
+                                             elapsed_time,
+                                             ip_connection_count,
+                                             is_client, ip_relay_count,
+                                             event_desc):
+        '''
+        Increment the connection counters for remote_as matches.
+        '''
         # Increment counters for AS number matches
         as_exact_match_bin = Aggregator._exact_match_bin(self.as_exact_objs,
                                                          remote_as)
+        (match_str, no_match_str) = CONNECTION_MATCH_SUBCATEGORIES['AS']
         if as_exact_match_bin == 0:
-            exact_match_str = "ASMatch"
+            exact_match_str = match_str
         else:
-            exact_match_str = "ASNoMatch"
+            exact_match_str = no_match_str
 
         # The first AS list is used for the *ASMatchConnection, LifeTime and *Histogram counters
         # Their *ASNoMatchConnection equivalents are used when there is no match in the first list
@@ -3632,7 +4330,7 @@ class Aggregator(ReconnectingClientFactory):
         # Now that we know which list matched, increment its CountList
         # counters. Instead of using NoMatch counters, we increment the
         # final bin if none of the lists match
-        self._increment_connection_close_count_lists("ASMatch",
+        self._increment_connection_close_count_lists(match_str,
                                                      as_exact_match_bin,
                                                      inbound_bytes, outbound_bytes,
                                                      inbound_circuits, outbound_circuits,
@@ -3640,10 +4338,6 @@ class Aggregator(ReconnectingClientFactory):
                                                      event_desc,
                                                      log_missing_counters=True)
 
-
-        # we processed and handled the event
-        return True
-
     @staticmethod
     def is_allowed_version_valid(field_name, fields, event_desc,
                                  allowed_version=None):
@@ -4735,21 +5429,17 @@ class Aggregator(ReconnectingClientFactory):
 
         # cli_ips_previous are the IPs from 2*period to period seconds ago,
         # or are empty for the first rotation
-        for ip in self.cli_ips_previous:
-            client = self.cli_ips_previous[ip]
-
-            if client['is_active']:
+        for client in self.cli_ips_previous.itervalues():
+            if client.is_active:
                 client_ips_active += 1
             else:
                 client_ips_inactive += 1
 
-            num_active_completed = client.get('num_active_completed', 0)
             self.secure_counters.increment('EntryClientIPActiveCircuitHistogram',
-                                           bin=num_active_completed,
+                                           bin=client.num_active_completed,
                                            inc=1)
-            num_inactive_completed = client.get('num_inactive_completed', 0)
             self.secure_counters.increment('EntryClientIPInactiveCircuitHistogram',
-                                           bin=num_inactive_completed,
+                                           bin=client.num_inactive_completed,
                                            inc=1)
 
         self.secure_counters.increment('EntryClientIPCount',
@@ -4769,3 +5459,149 @@ class Aggregator(ReconnectingClientFactory):
         self.cli_ips_current = {}
         self.cli_ips_rotated = time()
         self.num_rotations += 1
+
+        # forget the remote IP addresses cached by the AS prefix maps
+        self._clear_as_prefix_caches()
+
+    def _clear_as_prefix_caches(self):
+        '''
+        Clear the lookup caches in the AS prefix maps, so that remote IP
+        addresses are not kept for the whole round.
+        '''
+        for prefix_map in self.as_prefix_map_objs.values():
+            prefix_map.clear_cache()
+
+class AggregatorWorkerPool(object):
+    '''
+    A set of worker processes, which each run an aggregator shard during
+    every collection round.
+    The processes should be started before the reactor runs, so they do not
+    inherit the reactor's threads, connections, or timers.
+    '''
+
+    def __init__(self, worker_count):
+        '''
+        Start worker_count worker processes.
+        '''
+        assert worker_count > 0
+        logging.info("Starting {} aggregator worker processes"
+                     .format(worker_count))
+        self.result_queue = multiprocessing.Queue()
+        self.workers = []
+        self.round_id = 0
+        for _ in xrange(worker_count):
+            event_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_aggregator_worker,
+                                              args=(event_queue,
+                                                    self.result_queue))
+            # don't outlive the data collector
+            process.daemon = True
+            process.start()
+            self.workers.append({ 'process' : process,
+                                  'event_queue' : event_queue })
+
+    def get_worker_count(self):
+        '''
+        Return the number of worker processes.
+        '''
+        return len(self.workers)
+
+    def get_event_queues(self):
+        '''
+        Return a list containing the event queue for each worker process.
+        '''
+        return [worker['event_queue'] for worker in self.workers]
+
+    def is_running(self):
+        '''
+        Return True if the worker processes are running.
+        '''
+        return len(self.workers) > 0
+
+    def start_round(self, aggregator_args, aggregator_kwargs):
+        '''
+        Ask each worker process to start an aggregator shard, using
+        aggregator_args and aggregator_kwargs.
+        Returns the round id, which identifies the round's counts.
+        '''
+        self.round_id += 1
+        for worker in self.workers:
+            worker['event_queue'].put((self.round_id, aggregator_args,
+                                       aggregator_kwargs))
+        return self.round_id
+
+    def get_round_counts(self, round_id, timeout):
+        '''
+        Wait up to timeout seconds for the counts from each worker process
+        for round_id. Ignores counts from earlier rounds.
+        Returns a list containing (counts, rejected_count) for each worker,
+        or None if any worker's counts are missing.
+        Blocks, so it must be called using threads.deferToThread().
+        '''
+        end_time = time() + timeout
+        shard_results = []
+        while len(shard_results) < len(self.workers):
+            try:
+                (result_round_id, counts, rejected_count) = \
+                    self.result_queue.get(timeout=max(end_time - time(),
+                                                      0.0))
+            except Empty:
+                return None
+            if result_round_id == round_id:
+                shard_results.append((counts, rejected_count))
+        return shard_results
+
+    def terminate(self):
+        '''
+        Stop the worker processes.
+        '''
+        for worker in self.workers:
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+        self.workers = []
+
+def run_aggregator_worker(event_queue, result_queue):
+    '''
+    Run an aggregator shard in a worker process for each round.
+    Each round starts when event_queue yields a tuple containing the round
+    id, and the aggregator args and kwargs. When the round ends, put a tuple
+    containing the round id and the result of run_aggregator_shard() on
+    result_queue.
+    '''
+    while True:
+        message = event_queue.get()
+        # events from a round that ended early
+        if not isinstance(message, tuple):
+            continue
+        (round_id, aggregator_args, aggregator_kwargs) = message
+        (counts, rejected_count) = run_aggregator_shard(aggregator_args,
+                                                        aggregator_kwargs,
+                                                        event_queue)
+        result_queue.put((round_id, counts, rejected_count))
+
+def run_aggregator_shard(aggregator_args, aggregator_kwargs, event_queue):
+    '''
+    Run an aggregator shard in a worker process.
+    Create an Aggregator using aggregator_args and aggregator_kwargs, and
+    pass it each batch of events from event_queue, rotating client IP
+    addresses every rotate_period.
+    When event_queue yields None, return a tuple containing the shard's
+    counts and the number of rejected events.
+    '''
+    aggregator = Aggregator(*aggregator_args, **aggregator_kwargs)
+    rotate_time = time() + aggregator.rotate_period
+    rejected_count = 0
+    while True:
+        try:
+            events = event_queue.get(timeout=max(rotate_time - time(), 0.0))
+        except Empty:
+            events = []
+        if events is None:
+            break
+        for event in events:
+            if not aggregator.handle_event(event):
+                rejected_count += 1
+        if time() >= rotate_time:
+            aggregator._do_rotate()
+            rotate_time += aggregator.rotate_period
+    return (aggregator.secure_counters.counts, rejected_count)
@@ -35,6 +35,49 @@ def log_error():
         logging.error("An error occurred, but the traceback has already been cleared.")
     logging.debug(traceback.format_exc())
 
+def is_debug_enabled():
+    '''
+    Returns True if debug messages will be logged.
+    Hot paths should check this before formatting debug messages, or
+    calling functions that are only used in debug messages.
+    '''
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+class SampledDebugLog(object):
+    '''
+    Logs one in every interval debug messages from a hot path, like the
+    per-event code in the data collector.
+    Messages are only formatted when they are logged. When debug logging
+    is disabled, messages are not counted or formatted.
+    '''
+
+    def __init__(self, interval=1):
+        '''
+        Log one in every interval debug messages.
+        If interval is 1, log every debug message.
+        '''
+        assert interval >= 1
+        self.interval = int(interval)
+        self.skipped_count = 0
+
+    def log(self, format_str, *args):
+        '''
+        If debug logging is enabled, and interval - 1 messages have been
+        skipped since the last logged message, log format_str.format(*args).
+        Otherwise, skip the message.
+        '''
+        if not is_debug_enabled():
+            return
+        if self.skipped_count < self.interval - 1:
+            self.skipped_count += 1
+            return
+        self.skipped_count = 0
+        if self.interval == 1:
+            logging.debug(format_str.format(*args))
+        else:
+            logging.debug("{} (logging 1 in {})"
+                          .format(format_str.format(*args), self.interval))
+
 ## Logging: Time Formatting Functions ##
 ## a timestamp is an absolute point in time, in seconds since unix epoch
 ## a period is a relative time duration, in seconds
@@ -93,6 +93,12 @@ def log_tally_server_status(status):
     t, r = status['sks_total'], status['sks_required']
     a, i = status['sks_active'], status['sks_idle']
     logging.info("--server status: ShareKeepers: have {}, need {}, {}/{} active, {}/{} idle".format(t, r, a, t, i, t))
+    # older tally servers don't cache match files
+    if 'match_file_cache_hits' in status:
+        logging.info("--server status: Match files: {} cached, {} cache hits, {} cache misses"
+                     .format(status['match_file_cache_files'],
+                             status['match_file_cache_hits'],
+                             status['match_file_cache_misses']))
     continue_str = ""
     next_round_str = ""
     if continue_collecting(status['completed_phases'],
@@ -403,6 +409,10 @@ class PrivCountClient(PrivCountNode):
         self.collection_start_time = None
         # the task for client checkins
         self.checkin_task = None
+        # the large strings from recent START configs, by hash
+        self.start_blobs = {}
+        # the last time each START blob was used, by hash
+        self.start_blob_times = {}
 
     def set_checkin_task(self, c_task):
         '''
@@ -419,6 +429,45 @@ class PrivCountClient(PrivCountNode):
         '''
         return self.checkin_task
 
+    def get_chunked_lines(self):
+        '''
+        Called by protocol
+        Return True if the client should offer to send and receive long
+        lines in chunks
+        '''
+        return self.config.get('chunked_lines', False)
+
+    def update_start_blobs(self, start_blobs, max_age):
+        '''
+        Called by protocol
+        Store start_blobs, a dict of { hash : blob } from the most recent
+        START config, so the server doesn't have to send them again.
+        Forget blobs that haven't been used for max_age seconds.
+        '''
+        now = time()
+        self.start_blobs.update(start_blobs)
+        for blob_hash in start_blobs:
+            self.start_blob_times[blob_hash] = now
+        for blob_hash in self.start_blobs.keys():
+            if self.start_blob_times[blob_hash] < now - max_age:
+                del self.start_blobs[blob_hash]
+                del self.start_blob_times[blob_hash]
+
+    def clear_start_blobs(self):
+        '''
+        Called by protocol
+        Forget all the stored START blobs
+        '''
+        self.start_blobs = {}
+        self.start_blob_times = {}
+
+    def get_start_blobs(self):
+        '''
+        Called by protocol
+        Return the stored START blobs
+        '''
+        return self.start_blobs
+
     def set_server_status(self, status):
         '''
         Called by protocol
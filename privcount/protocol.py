@@ -1,13 +1,14 @@
 # See LICENSE for licensing information
 
-import logging, json, math, subprocess, sys, os
+import logging, json, math, subprocess, sys, os, hashlib, struct, zlib
 
 from time import time
 from os import urandom, path
+from collections import deque
 from base64 import b64encode, b64decode
 from binascii import hexlify, unhexlify
 
-from twisted.internet import task
+from twisted.internet import task, reactor, defer
 from twisted.protocols.basic import LineOnlyReceiver
 
 from cryptography.hazmat.primitives.hashes import SHA256
@@ -15,7 +16,7 @@ from cryptography.hazmat.primitives.hashes import SHA256
 from privcount.connection import transport_info, transport_remote_info, transport_local_info
 from privcount.counter import get_events_for_counters, get_valid_events
 from privcount.crypto import CryptoHash, get_hmac, verify_hmac, b64_padded_length, json_serialise
-from privcount.log import log_error, errorCallback, stop_reactor, summarise_string, summarise_list
+from privcount.log import log_error, errorCallback, stop_reactor, summarise_string, summarise_list, is_debug_enabled, SampledDebugLog
 
 PRIVCOUNT_SHORT_VERSION_STRING = '3.1.0'
 
@@ -58,6 +59,274 @@ def privcount_git_revision():
 
     return PRIVCOUNT_GIT_CACHE
 
+# START configs can contain huge match lists. When both ends support it,
+# START configs are sent as framed, compressed binary, encoded as base64.
+# Large strings in the config are sent as separate blobs, identified by their
+# content hash, and clients that already have a blob don't receive it again.
+START_ENCODING_BINARY = 'PCSTART1'
+# Strings at least this long are sent as blobs
+START_BLOB_MIN_LENGTH = 64*1024
+# Blobs are replaced by { START_BLOB_KEY : hash } in the config
+START_BLOB_KEY = 'privcount_blob'
+# Each frame has a type byte and a payload length
+START_FRAME_HEADER = struct.Struct('<BI')
+# The compressed JSON config, with blob references
+START_FRAME_CONFIG = 1
+# A blob's binary SHA256 hash, followed by its compressed content
+START_FRAME_BLOB = 2
+START_BLOB_HASH_BYTES = 32
+# Blobs that haven't been used in a START config for this long are forgotten
+# by servers and clients. Rounds that don't use a blob keep it cached, so
+# alternating configs don't resend (or recompress) their lists every time.
+START_BLOB_CACHE_TIME = 7*24*60*60
+
+# The compressed blobs from recently encoded START configs, so that we only
+# compress each list once:
+# { id(blob_string) : (blob_string, hash, frame, last_used_time) }
+_start_blob_frames = {}
+
+def start_blob_hash(blob_bytes):
+    '''
+    Return the hex SHA256 hash of blob_bytes.
+    '''
+    return hashlib.sha256(blob_bytes).hexdigest()
+
+def start_config_extract_blobs(obj, blobs):
+    '''
+    Return a copy of obj with large strings replaced by blob references.
+    Add each large string to the blobs list.
+    '''
+    if isinstance(obj, dict):
+        return dict((key, start_config_extract_blobs(value, blobs))
+                    for (key, value) in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        return [start_config_extract_blobs(value, blobs) for value in obj]
+    elif (isinstance(obj, basestring) and
+          len(obj) >= START_BLOB_MIN_LENGTH):
+        blobs.append(obj)
+        return { START_BLOB_KEY : len(blobs) - 1 }
+    else:
+        return obj
+
+def start_config_get_blob_frame(blob_string):
+    '''
+    Return a tuple containing the hash and encoded frame for blob_string,
+    using the cached frame if it has already been encoded.
+    '''
+    cached = _start_blob_frames.get(id(blob_string))
+    if cached is not None and cached[0] is blob_string:
+        _start_blob_frames[id(blob_string)] = cached[:3] + (time(),)
+        return cached[1:3]
+    blob_bytes = blob_string
+    if isinstance(blob_bytes, unicode):
+        blob_bytes = blob_bytes.encode('utf-8')
+    blob_hash = start_blob_hash(blob_bytes)
+    payload = unhexlify(blob_hash) + zlib.compress(blob_bytes)
+    frame = START_FRAME_HEADER.pack(START_FRAME_BLOB, len(payload)) + payload
+    # we keep a reference to blob_string, so its id stays unique
+    _start_blob_frames[id(blob_string)] = (blob_string, blob_hash, frame,
+                                           time())
+    return (blob_hash, frame)
+
+def start_config_forget_blob_frames(max_age=START_BLOB_CACHE_TIME):
+    '''
+    Forget cached blob frames that haven't been used for max_age seconds.
+    '''
+    global _start_blob_frames
+    oldest_time = time() - max_age
+    _start_blob_frames = dict((blob_id, cached)
+                              for (blob_id, cached)
+                              in _start_blob_frames.iteritems()
+                              if cached[3] >= oldest_time)
+
+def start_config_encode(config, skip_blob_hashes=None):
+    '''
+    Encode config using START_ENCODING_BINARY, and return the encoded string.
+    Blobs with hashes in skip_blob_hashes are not included in the encoded
+    string.
+    '''
+    blob_strings = []
+    skeleton = start_config_extract_blobs(config, blob_strings)
+    blob_hashes = []
+    frames = []
+    for blob_string in blob_strings:
+        (blob_hash, frame) = start_config_get_blob_frame(blob_string)
+        blob_hashes.append(blob_hash)
+        if skip_blob_hashes is None or blob_hash not in skip_blob_hashes:
+            frames.append(frame)
+    # forget blobs that haven't been used recently
+    start_config_forget_blob_frames()
+    # now replace the blob indexes with their hashes
+    skeleton = start_config_replace_blobs(
+                   skeleton,
+                   lambda index: { START_BLOB_KEY : blob_hashes[index] })
+    payload = zlib.compress(json_serialise(skeleton))
+    frames.insert(0, START_FRAME_HEADER.pack(START_FRAME_CONFIG, len(payload))
+                     + payload)
+    encoded = START_ENCODING_BINARY.encode('ascii') + ''.join(frames)
+    logging.debug("Encoded START config with {} blobs, {} skipped: {} bytes"
+                  .format(len(blob_hashes), len(blob_hashes) - len(frames) + 1,
+                          len(encoded)))
+    return b64encode(encoded)
+
+def start_config_replace_blobs(obj, get_blob):
+    '''
+    Return a copy of obj with each blob reference replaced by
+    get_blob(reference).
+    '''
+    if isinstance(obj, dict):
+        if len(obj) == 1 and START_BLOB_KEY in obj:
+            return get_blob(obj[START_BLOB_KEY])
+        return dict((key, start_config_replace_blobs(value, get_blob))
+                    for (key, value) in obj.iteritems())
+    elif isinstance(obj, list):
+        return [start_config_replace_blobs(value, get_blob) for value in obj]
+    else:
+        return obj
+
+def start_config_decode(encoded, known_blobs=None):
+    '''
+    Decode encoded, a string created by start_config_encode().
+    known_blobs is a dict of { hash : blob } that were skipped by the
+    encoder.
+    Returns a tuple containing the config, and a dict of
+    { hash : blob } containing every blob in the config.
+    Raises an exception if a blob is missing, or a blob's content does not
+    match its hash.
+    '''
+    if known_blobs is None:
+        known_blobs = {}
+    encoded = b64decode(encoded)
+    assert encoded.startswith(START_ENCODING_BINARY)
+    offset = len(START_ENCODING_BINARY)
+    skeleton = None
+    blobs = {}
+    while offset < len(encoded):
+        (frame_type, length) = START_FRAME_HEADER.unpack_from(encoded, offset)
+        offset += START_FRAME_HEADER.size
+        payload = encoded[offset:offset + length]
+        assert len(payload) == length
+        offset += length
+        if frame_type == START_FRAME_CONFIG:
+            assert skeleton is None
+            skeleton = json.loads(zlib.decompress(payload))
+        elif frame_type == START_FRAME_BLOB:
+            blob_hash = hexlify(payload[:START_BLOB_HASH_BYTES])
+            blob = zlib.decompress(payload[START_BLOB_HASH_BYTES:])
+            assert start_blob_hash(blob) == blob_hash
+            # JSON START configs contain unicode strings
+            blobs[blob_hash] = blob.decode('utf-8')
+        else:
+            # ignore unknown frame types, so we can add new ones later
+            logging.info("Ignoring unknown START frame type {}"
+                         .format(frame_type))
+    assert skeleton is not None
+    used_blobs = {}
+
+    def get_blob(blob_hash):
+        '''
+        Return the blob for blob_hash, and remember that it was used.
+        '''
+        blob = blobs.get(blob_hash, known_blobs.get(blob_hash))
+        assert blob is not None, "missing START blob {}".format(blob_hash)
+        used_blobs[blob_hash] = blob
+        return blob
+
+    config = start_config_replace_blobs(skeleton, get_blob)
+    return (config, used_blobs)
+
+class ChunkedLineProducer(object):
+    '''
+    A pull producer that writes a protocol's queued lines to its transport,
+    splitting long lines into CHUNK lines. The transport asks for the next
+    chunk when it has sent the previous one, so it only ever buffers one
+    chunk.
+    '''
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        # a queue of [line, offset] items
+        self.lines = deque()
+        self.start_time = None
+        self.last_progress = 0
+
+    def add_line(self, line):
+        '''
+        Queue line for sending.
+        '''
+        self.lines.append([line, 0])
+
+    def is_finished(self):
+        '''
+        Return True if there are no more lines to send.
+        '''
+        return len(self.lines) == 0
+
+    def resumeProducing(self):
+        '''
+        overrides twisted function
+        Write the next line or chunk to the transport.
+        '''
+        if self.is_finished():
+            return
+        item = self.lines[0]
+        (line, offset) = item
+        chunk_bytes = PrivCountProtocol.CHUNK_BYTES
+        if offset == 0 and len(line) <= chunk_bytes:
+            # short lines are sent as-is
+            LineOnlyReceiver.sendLine(self.protocol, line)
+            self.lines.popleft()
+        else:
+            if offset == 0:
+                self.start_time = time()
+                self.last_progress = 0
+                logging.info("Sending chunked line of {} bytes to {}"
+                             .format(len(line),
+                                     transport_info(self.protocol.transport)))
+            LineOnlyReceiver.sendLine(
+                self.protocol,
+                "{} {} {}".format(PrivCountProtocol.CHUNK_EVENT,
+                                  len(line),
+                                  line[offset:offset + chunk_bytes]))
+            item[1] = offset + chunk_bytes
+            self.last_progress = log_chunk_progress(
+                "Sent", item[1], len(line), self.start_time,
+                self.last_progress, self.protocol.transport)
+            if item[1] >= len(line):
+                self.lines.popleft()
+        if self.is_finished():
+            self.protocol.chunked_send_finished()
+
+    def stopProducing(self):
+        '''
+        overrides twisted function
+        Stop sending lines, because the connection is closing.
+        '''
+        self.lines.clear()
+
+def log_chunk_progress(direction, done_bytes, total_bytes, start_time,
+                       last_progress, transport):
+    '''
+    Log the progress of a chunked line transfer, when it passes each 10%
+    of total_bytes, and when it finishes.
+    Returns the new last progress decile.
+    '''
+    done_bytes = min(done_bytes, total_bytes)
+    progress = (10 * done_bytes) // total_bytes
+    if done_bytes == total_bytes:
+        elapsed = time() - start_time
+        logging.info("{} chunked line of {} bytes {} {} in {:.3f}s"
+                     .format(direction, total_bytes,
+                             "to" if direction == "Sent" else "from",
+                             transport_info(transport), elapsed))
+    elif progress > last_progress:
+        logging.debug("{} {} of {} bytes ({}%) of chunked line {} {}"
+                      .format(direction, done_bytes, total_bytes,
+                              progress * 10,
+                              "to" if direction == "Sent" else "from",
+                              transport_info(transport)))
+    return progress
+
 class PrivCountProtocol(LineOnlyReceiver):
     '''
     The base protocol class for PrivCount. This class logs basic connection
@@ -70,15 +339,18 @@ class PrivCountProtocol(LineOnlyReceiver):
         self.privcount_role = None
         self.clear()
         try:
-            # make sure the maximum line length will accommodate the longest
-            # handshake line, including base64 encoded cookie and HMAC
-            assert self.MAX_LENGTH >= (
-                len(PrivCountProtocol.HANDSHAKE2) +
+            # make sure the unvalidated warning length will accommodate the
+            # longest handshake line, including base64 encoded cookie and
+            # HMAC, and every extension
+            assert self.get_warn_length(False) >= (
                 len(PrivCountProtocol.handshake_prefix_str(
                         PrivCountProtocol.HANDSHAKE2,
                         PrivCountProtocol.ROLE_CLIENT)) +
                 PrivCountProtocol.COOKIE_B64_BYTES +
-                PrivCountProtocol.HMAC_B64_BYTES)
+                PrivCountProtocol.HMAC_B64_BYTES +
+                len(PrivCountProtocol.handshake_extensions_str(
+                        PrivCountProtocol.SUPPORTED_EXTENSIONS)) +
+                2)
         # if any error happens here, die
         except BaseException as e:
             # catch errors and terminate the process
@@ -102,7 +374,24 @@ class PrivCountProtocol(LineOnlyReceiver):
         the handshake process itself transfers very little, so we can get
         away with a small buffer - after the handshake suceeds, we allow lines
         of longer length'''
-        self.MAX_LENGTH = 200
+        self.MAX_LENGTH = 256
+        # the maximum length of an entire line, even if it is chunked
+        self.max_message_length = self.MAX_LENGTH
+
+        # the protocol extensions negotiated during the handshake
+        self.extensions = []
+        self.is_chunked_connection = False
+        # the chunked line we are receiving
+        self.chunk_pieces = []
+        self.chunk_received = 0
+        self.chunk_total = None
+        self.chunk_start_time = None
+        self.chunk_last_progress = 0
+        # the producer for the chunked lines we are sending
+        if getattr(self, 'chunk_producer', None) is not None:
+            self.chunk_producer.stopProducing()
+            self.transport.unregisterProducer()
+        self.chunk_producer = None
 
     def get_warn_length(self, is_line_received):
         '''
@@ -113,12 +402,12 @@ class PrivCountProtocol(LineOnlyReceiver):
             # The handshake sends predictable line lengths, so we can adopt a
             # tight upper bound. We never warn for unvalidated received data:
             # it might be a port scanner
-            return (self.MAX_LENGTH * 4) / 5
+            return (self.max_message_length * 4) / 5
         else:
             # The PrivCount protcol sends lines that are all about the same
             # length, because blinded values are almost always the same length
             # (but the line length also increases for each extra node)
-            return self.MAX_LENGTH / 2
+            return self.max_message_length / 2
 
     def check_line_length(self, line, is_line_received, is_length_exceeded):
         '''
@@ -131,8 +420,10 @@ class PrivCountProtocol(LineOnlyReceiver):
         )
         Terminates the protocol or reactor if the line is over-length.
         '''
-        is_length_exceeded = is_length_exceeded or len(line) > self.MAX_LENGTH
-        is_unsafe_length = is_length_exceeded or len(line) > self.get_warn_length(is_line_received)
+        line_length = len(line)
+        is_length_exceeded = (is_length_exceeded or
+                              line_length > self.max_message_length)
+        is_unsafe_length = is_length_exceeded or line_length > self.get_warn_length(is_line_received)
         # we trust input we send, and input from validated peers
         # don't ever warn about port scanners
         is_something_we_control = not is_line_received or self.is_valid_connection
@@ -140,7 +431,7 @@ class PrivCountProtocol(LineOnlyReceiver):
         if is_unsafe_length and is_something_we_control:
             logging.warning("{} line of length {} exceeded {} of {}, {} {} connection to {}"
                             .format("Received" if is_line_received else "Generated",
-                                    len(line),
+                                    line_length,
                                     "MAX_LENGTH" if is_length_exceeded else "safe length",
                                     self.get_warn_length(is_line_received),
                                     "dropping" if is_length_exceeded and is_line_received else "keeping",
@@ -164,8 +455,63 @@ class PrivCountProtocol(LineOnlyReceiver):
         '''
         overrides twisted function
         '''
-        logging.debug("Received line '{}' from {}"
-                      .format(line, transport_info(self.transport)))
+        if (self.is_chunked_connection and
+            line.startswith(PrivCountProtocol.CHUNK_EVENT + ' ')):
+            self.chunkReceived(line)
+            return
+        self.messageReceived(line)
+
+    def chunkReceived(self, chunk_line):
+        '''
+        Add the data in chunk_line to the current chunked line.
+        When the line is complete, process it as a received line.
+        '''
+        parts = chunk_line.split(' ', 2)
+        try:
+            total_length = int(parts[1])
+        except (IndexError, ValueError):
+            total_length = None
+        data = parts[2] if len(parts) > 2 else ''
+        if self.chunk_total is None and total_length is not None:
+            # the first chunk in a line
+            self.chunk_total = total_length
+            self.chunk_start_time = time()
+            self.chunk_last_progress = 0
+            logging.info("Receiving chunked line of {} bytes from {}"
+                         .format(total_length, transport_info(self.transport)))
+            # check the full length before we buffer anything
+            self.check_line_length('', True,
+                                   total_length > self.max_message_length)
+            if not self.is_valid_connection:
+                return
+        if (total_length is None or total_length != self.chunk_total or
+            self.chunk_received + len(data) > self.chunk_total or
+            len(data) == 0):
+            logging.warning("Received invalid chunk of length {} for line of length {}, expected line of length {}, dropping connection to {}"
+                            .format(len(data), total_length, self.chunk_total,
+                                    transport_info(self.transport)))
+            self.protocol_failed()
+            return
+        self.chunk_pieces.append(data)
+        self.chunk_received += len(data)
+        self.chunk_last_progress = log_chunk_progress(
+            "Received", self.chunk_received, self.chunk_total,
+            self.chunk_start_time, self.chunk_last_progress, self.transport)
+        if self.chunk_received == self.chunk_total:
+            line = ''.join(self.chunk_pieces)
+            self.chunk_pieces = []
+            self.chunk_received = 0
+            self.chunk_total = None
+            self.messageReceived(line)
+
+    def messageReceived(self, line):
+        '''
+        Process line, which was received as a single line, or a sequence of
+        chunks.
+        '''
+        if is_debug_enabled():
+            logging.debug("Received line '{}' from {}"
+                          .format(line, transport_info(self.transport)))
         self.check_line_length(line, True, False)
         parts = [part.strip() for part in line.split(' ', 1)]
         if len(parts) > 0:
@@ -177,11 +523,31 @@ class PrivCountProtocol(LineOnlyReceiver):
         '''
         overrides twisted function
         '''
-        logging.debug("Sending line '{}' to {}"
-                      .format(line, transport_info(self.transport)))
+        if is_debug_enabled():
+            logging.debug("Sending line '{}' to {}"
+                          .format(line, transport_info(self.transport)))
         self.check_line_length(line, False, False)
+        # send long lines in chunks, and keep the rest in order with them
+        if (self.is_chunked_connection and
+            (len(line) > PrivCountProtocol.CHUNK_BYTES or
+             self.chunk_producer is not None)):
+            if self.chunk_producer is None:
+                self.chunk_producer = ChunkedLineProducer(self)
+                self.chunk_producer.add_line(line)
+                self.transport.registerProducer(self.chunk_producer, False)
+            else:
+                self.chunk_producer.add_line(line)
+            return
         return LineOnlyReceiver.sendLine(self, line)
 
+    def chunked_send_finished(self):
+        '''
+        Called by ChunkedLineProducer when it has sent all its lines
+        '''
+        if self.chunk_producer is not None:
+            self.chunk_producer = None
+            self.transport.unregisterProducer()
+
     def lineLengthExceeded(self, line):
         '''
         overrides twisted function
@@ -257,9 +623,9 @@ class PrivCountProtocol(LineOnlyReceiver):
     HANDSHAKE_PREFIX_PARTS = 4
     # ServerCookie
     HANDSHAKE1_PARTS = HANDSHAKE_PREFIX_PARTS + 1
-    # ClientCookie HMAC
+    # ClientCookie HMAC [Extension ...]
     HANDSHAKE2_PARTS = HANDSHAKE_PREFIX_PARTS + 2
-    # HMAC
+    # HMAC [Extension ...]
     HANDSHAKE3_PARTS = HANDSHAKE_PREFIX_PARTS + 1
     # SUCCESS
     HANDSHAKE4_PARTS = HANDSHAKE_PREFIX_PARTS + 1
@@ -293,6 +659,24 @@ class PrivCountProtocol(LineOnlyReceiver):
     # The message is used for HANDSHAKE 2-4 failure
     HANDSHAKE_FAIL = 'FAIL'
 
+    # Protocol extensions are negotiated during the handshake:
+    # the client offers the extensions it supports in HANDSHAKE2, and the
+    # server accepts some of them in HANDSHAKE3. Both lists are part of the
+    # HMAC prefix. Servers accept handshakes without extensions, so older
+    # clients still work. Older servers reject extension offers, so clients
+    # only offer extensions that are enabled in their config.
+    # Send lines longer than CHUNK_BYTES as a sequence of lines:
+    # CHUNK TotalLength Data
+    EXTENSION_CHUNKED = 'CHUNKED'
+    SUPPORTED_EXTENSIONS = [EXTENSION_CHUNKED]
+    CHUNK_EVENT = 'CHUNK'
+    CHUNK_BYTES = 1024*1024
+    # The maximum length of a line from a validated peer, including chunked
+    # lines
+    # PrivCount 2.0.0 reached 55 MB with all counters, a large traffic
+    # model, large domain sets, 20 DCs, and 10 SKs
+    VALIDATED_MAX_LENGTH = 200*1024*1024
+
     # The number of bytes in a cookie and a hash
     COOKIE_BYTES = CryptoHash.digest_size
     COOKIE_B64_BYTES = b64_padded_length(COOKIE_BYTES)
@@ -327,6 +711,22 @@ class PrivCountProtocol(LineOnlyReceiver):
                                     sender_role,
                                     PrivCountProtocol.HANDSHAKE_TYPE)
 
+    @staticmethod
+    def handshake_extensions_str(extensions):
+        '''
+        Return extensions as a string suitable for appending to a handshake,
+        with a space before each extension.
+        '''
+        return ''.join(' ' + extension for extension in extensions)
+
+    @staticmethod
+    def handshake_extensions_get(handshake, handshake_parts):
+        '''
+        Return the list of extensions after the first handshake_parts parts
+        of handshake.
+        '''
+        return handshake.strip().split()[handshake_parts:]
+
     @staticmethod
     def handshake_prefix_verify(handshake, handshake_stage, sender_role):
         '''
@@ -554,23 +954,37 @@ class PrivCountProtocol(LineOnlyReceiver):
         '''
         Return a string for client handshake stage 2:
         HANDSHAKE2 VERSION CLIENT TYPE ClientCookie
-        HMAC(Key, HandshakePrefix2 | ServerCookie | ClientCookie)
+        HMAC(Key, HandshakePrefix2 | Extensions | ServerCookie | ClientCookie)
+        Extensions
         '''
         assert self.privcount_role == PrivCountProtocol.ROLE_CLIENT
         prefix = self.handshake_prefix_str(PrivCountProtocol.HANDSHAKE2,
                                            self.privcount_role)
-        h2 = "{} {} {}".format(prefix,
-                               b64encode(self.client_cookie),
-                               self.handshake_hmac_get(self.handshake_secret(),
-                                                       prefix,
-                                                       self.server_cookie,
-                                                       self.client_cookie))
+        extensions = self.handshake_extensions_str(
+                                  self.handshake_offered_extensions())
+        h2 = "{} {} {}{}".format(prefix,
+                                 b64encode(self.client_cookie),
+                                 self.handshake_hmac_get(
+                                     self.handshake_secret(),
+                                     prefix + extensions,
+                                     self.server_cookie,
+                                     self.client_cookie),
+                                 extensions)
         assert self.handshake2_verify(h2,
                                       self.handshake_secret(),
                                       self.server_cookie)
         logging.debug("Sent handshake: {}".format(h2))
         return h2
 
+    def handshake_offered_extensions(self):
+        '''
+        Return the list of extensions the client offers in HANDSHAKE2.
+        '''
+        assert self.privcount_role == PrivCountProtocol.ROLE_CLIENT
+        if self.factory.get_chunked_lines():
+            return [PrivCountProtocol.EXTENSION_CHUNKED]
+        return []
+
     @staticmethod
     def handshake2_verify(handshake, handshake_key, server_cookie):
         '''
@@ -588,8 +1002,8 @@ class PrivCountProtocol(LineOnlyReceiver):
                                      PrivCountProtocol.ROLE_CLIENT):
             return False
         parts = handshake.strip().split()
-        if len(parts) != PrivCountProtocol.HANDSHAKE2_PARTS:
-            logging.warning("Invalid handshake: wrong number of parts {} expected {}"
+        if len(parts) < PrivCountProtocol.HANDSHAKE2_PARTS:
+            logging.warning("Invalid handshake: wrong number of parts {} expected >= {}"
                             .format(len(parts),
                                     PrivCountProtocol.HANDSHAKE2_PARTS))
             return False
@@ -613,6 +1027,8 @@ class PrivCountProtocol(LineOnlyReceiver):
         prefix = PrivCountProtocol.handshake_prefix_str(
                                        PrivCountProtocol.HANDSHAKE2,
                                        PrivCountProtocol.ROLE_CLIENT)
+        prefix += PrivCountProtocol.handshake_extensions_str(
+                                       parts[PrivCountProtocol.HANDSHAKE2_PARTS:])
         if not PrivCountProtocol.handshake_hmac_verify(hmac,
                                                        handshake_key,
                                                        prefix,
@@ -625,16 +1041,19 @@ class PrivCountProtocol(LineOnlyReceiver):
         '''
         Return a string for server handshake stage 3:
         HANDSHAKE3 VERSION SERVER TYPE
-        HMAC(Key, HandshakePrefix3 | ServerCookie | ClientCookie)
+        HMAC(Key, HandshakePrefix3 | Extensions | ServerCookie | ClientCookie)
+        Extensions
         '''
         assert self.privcount_role == PrivCountProtocol.ROLE_SERVER
         prefix = self.handshake_prefix_str(PrivCountProtocol.HANDSHAKE3,
                                            self.privcount_role)
-        h3 = "{} {}".format(prefix,
-                            self.handshake_hmac_get(self.handshake_secret(),
-                                                    prefix,
-                                                    self.server_cookie,
-                                                    self.client_cookie))
+        extensions = self.handshake_extensions_str(self.extensions)
+        h3 = "{} {}{}".format(prefix,
+                              self.handshake_hmac_get(self.handshake_secret(),
+                                                      prefix + extensions,
+                                                      self.server_cookie,
+                                                      self.client_cookie),
+                              extensions)
         assert self.handshake3_verify(h3,
                                       self.handshake_secret(),
                                       self.server_cookie,
@@ -657,8 +1076,8 @@ class PrivCountProtocol(LineOnlyReceiver):
                                      PrivCountProtocol.ROLE_SERVER):
             return False
         parts = handshake.strip().split()
-        if len(parts) != PrivCountProtocol.HANDSHAKE3_PARTS:
-            logging.warning("Invalid handshake: wrong number of parts {} expected {}"
+        if len(parts) < PrivCountProtocol.HANDSHAKE3_PARTS:
+            logging.warning("Invalid handshake: wrong number of parts {} expected >= {}"
                             .format(len(parts),
                                     PrivCountProtocol.HANDSHAKE3_PARTS))
             return False
@@ -666,6 +1085,8 @@ class PrivCountProtocol(LineOnlyReceiver):
         prefix = PrivCountProtocol.handshake_prefix_str(
                                        PrivCountProtocol.HANDSHAKE3,
                                        PrivCountProtocol.ROLE_SERVER)
+        prefix += PrivCountProtocol.handshake_extensions_str(
+                                       parts[PrivCountProtocol.HANDSHAKE3_PARTS:])
         if not PrivCountProtocol.handshake_hmac_verify(hmac,
                                                        handshake_key,
                                                        prefix,
@@ -791,9 +1212,17 @@ class PrivCountProtocol(LineOnlyReceiver):
                       .format(transport_info(self.transport)))
         self.is_valid_connection = True
         # now that we have authenticated, allow longer lines
-        # PrivCount 2.0.0 reached 55 MB with all counters, a large traffic
-        # model, large domain sets, 20 DCs, and 10 SKs
-        self.MAX_LENGTH = 200*1024*1024
+        self.max_message_length = PrivCountProtocol.VALIDATED_MAX_LENGTH
+        if PrivCountProtocol.EXTENSION_CHUNKED in self.extensions:
+            # long lines are chunked, so individual lines are short
+            self.is_chunked_connection = True
+            self.MAX_LENGTH = (PrivCountProtocol.CHUNK_BYTES +
+                               len(PrivCountProtocol.CHUNK_EVENT) +
+                               len(str(self.max_message_length)) + 2)
+        else:
+            self.MAX_LENGTH = self.max_message_length
+        logging.debug("Using extensions {} with {}"
+                      .format(self.extensions, transport_info(self.transport)))
 
     def handshake_failed(self):
         '''
@@ -899,6 +1328,10 @@ class PrivCountServerProtocol(PrivCountProtocol):
         PrivCountProtocol.clear(self)
         self.last_sent_time = 0.0
         self.client_uid = None
+        # the START encodings supported by the client, and the hashes of the
+        # START blobs it already has
+        self.client_start_encodings = []
+        self.client_start_blob_hashes = set()
 
     def connectionMade(self): # overrides twisted function
         PrivCountProtocol.connectionMade(self)
@@ -926,6 +1359,13 @@ class PrivCountServerProtocol(PrivCountProtocol):
                 self.handshake_secret(),
                 self.server_cookie)
             if self.client_cookie:
+                # accept the extensions we support
+                offered = self.handshake_extensions_get(
+                                       event_line,
+                                       PrivCountProtocol.HANDSHAKE2_PARTS)
+                self.extensions = [extension for extension
+                                   in PrivCountProtocol.SUPPORTED_EXTENSIONS
+                                   if extension in offered]
                 self.sendLine(self.handshake3_str())
             else:
                 self.client_cookie = None
@@ -957,6 +1397,11 @@ class PrivCountServerProtocol(PrivCountProtocol):
 
         if event_type == "STATUS" and len(parts) == 2:
             client_status = json.loads(parts[1])
+            # older clients only support JSON START configs
+            self.client_start_encodings = client_status.pop(
+                                              'start_encodings', [])
+            self.client_start_blob_hashes = set(client_status.pop(
+                                              'start_blob_hashes', []))
 
             client_status['alive'] = time()
             local = transport_local_info(self.transport)
@@ -996,7 +1441,14 @@ class PrivCountServerProtocol(PrivCountProtocol):
 
     def send_start_event(self, config):
         assert config is not None
-        self.sendLine("START {}".format(json_serialise(config)))
+        if START_ENCODING_BINARY in self.client_start_encodings:
+            self.sendLine("START {} {}".format(
+                              START_ENCODING_BINARY,
+                              start_config_encode(
+                                  config,
+                                  skip_blob_hashes=self.client_start_blob_hashes)))
+        else:
+            self.sendLine("START {}".format(json_serialise(config)))
 
     def handle_start_event(self, event_type, event_payload):
         parts = event_payload.split(' ', 1)
@@ -1070,10 +1522,15 @@ class PrivCountClientProtocol(PrivCountProtocol):
                                        PrivCountProtocol.HANDSHAKE2))
                 self.handshake_failed()
         elif event_type == PrivCountProtocol.HANDSHAKE3:
-            if self.handshake3_verify(event_line,
-                                      self.handshake_secret(),
-                                      self.server_cookie,
-                                      self.client_cookie):
+            accepted = self.handshake_extensions_get(
+                                       event_line,
+                                       PrivCountProtocol.HANDSHAKE3_PARTS)
+            if (self.handshake3_verify(event_line,
+                                       self.handshake_secret(),
+                                       self.server_cookie,
+                                       self.client_cookie) and
+                set(accepted).issubset(self.handshake_offered_extensions())):
+                self.extensions = accepted
                 self.sendLine(self.handshake4_str())
                 self.handshake_succeeded()
             else:
@@ -1092,27 +1549,71 @@ class PrivCountClientProtocol(PrivCountProtocol):
             self.factory.set_server_status(server_status)
 
             status = self.factory.get_status()
+            # tell the server which START encodings and blobs we have
+            status['start_encodings'] = [START_ENCODING_BINARY]
+            status['start_blob_hashes'] = self.factory.get_start_blobs().keys()
             self.sendLine("STATUS {} {}".format(time(), json_serialise(status)))
             return True
         return False
 
     def handle_start_event(self, event_type, event_payload):
-        start_config = json.loads(event_payload)
+        if event_payload.startswith(START_ENCODING_BINARY + ' '):
+            try:
+                (start_config, start_blobs) = start_config_decode(
+                    event_payload[len(START_ENCODING_BINARY) + 1:],
+                    known_blobs=self.factory.get_start_blobs())
+            except BaseException as e:
+                # if we lost a blob, the server will send it next time
+                logging.warning("Failed to decode START config: {}"
+                                .format(e))
+                self.factory.clear_start_blobs()
+                self.sendLine("START FAIL")
+                return True
+            # keep recently used blobs, even if this config doesn't use them
+            self.factory.update_start_blobs(start_blobs,
+                                            START_BLOB_CACHE_TIME)
+        else:
+            start_config = json.loads(event_payload)
         result_data = self.factory.do_start(start_config)
+        if isinstance(result_data, defer.Deferred):
+            # the node is still starting, send the result when it's done
+            result_data.addCallback(self.send_start_result)
+            result_data.addErrback(errorCallback)
+        else:
+            self.send_start_result(result_data)
+        return True
+
+    def send_start_result(self, result_data):
+        '''
+        Send result_data from do_start() to the server.
+        If result_data is None, tell the server that the start failed.
+        '''
         if result_data is not None:
             self.sendLine("START SUCCESS {}".format(json_serialise(result_data)))
         else:
             self.sendLine("START FAIL")
-        return True
 
     def handle_stop_event(self, event_type, event_payload):
         stop_config = json.loads(event_payload)
         result_data = self.factory.do_stop(stop_config)
+        if isinstance(result_data, defer.Deferred):
+            # the node is still counting events, send the result when it's
+            # done
+            result_data.addCallback(self.send_stop_result)
+            result_data.addErrback(errorCallback)
+        else:
+            self.send_stop_result(result_data)
+        return True
+
+    def send_stop_result(self, result_data):
+        '''
+        Send result_data from do_stop() to the server.
+        If result_data is None, tell the server that the stop failed.
+        '''
         if result_data is not None:
             self.sendLine("STOP SUCCESS {}".format(json_serialise(result_data)))
         else:
             self.sendLine("STOP FAIL")
-        return True
 
     def handle_checkin_event(self, event_type, event_payload):
         if event_type == "CHECKIN":
@@ -1584,13 +2085,14 @@ class TorControlProtocol(object):
         )
         Terminates the reactor if the line is over-length.
         '''
-        is_length_exceeded = is_length_exceeded or len(line) > self.MAX_LENGTH
-        is_unsafe_length = is_length_exceeded or len(line) > self.get_warn_length(is_line_received)
+        line_length = len(line)
+        is_length_exceeded = is_length_exceeded or line_length > self.MAX_LENGTH
+        is_unsafe_length = is_length_exceeded or line_length > self.get_warn_length(is_line_received)
         # if we are over the safe length, warn
         if is_unsafe_length:
             logging.warning("{} line of length {} exceeded {} of {}, {} connection to {}"
                             .format("Received" if is_line_received else "Generated",
-                                    len(line),
+                                    line_length,
                                     "MAX_LENGTH" if is_length_exceeded else "safe length",
                                     self.get_warn_length(is_line_received),
                                     "dropping" if is_length_exceeded and is_line_received else "keeping",
@@ -1601,12 +2103,29 @@ class TorControlProtocol(object):
 
 class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
 
+    # The number of received events that can wait to be processed
+    # Reading pauses when the queue is half full, so events are never dropped
+    DEFAULT_EVENT_QUEUE_LENGTH = 10000
+    # The maximum number of events processed before yielding to the reactor
+    DEFAULT_EVENT_BATCH_SIZE = 100
+
     def __init__(self, factory):
         # we want ancestors to be able to use this in clear()
         self.consensus_refresher = None
+        self.event_queue = deque()
+        self.event_queue_call = None
+        self.is_reading_paused = False
+        self.stop_collection_deferred = None
         TorControlProtocol.__init__(self, factory)
         # we only want to clear this at the end of a round
         self.collection_events = None
+        self.event_debug_log = SampledDebugLog()
+        self.event_queue_length = TorControlClientProtocol.DEFAULT_EVENT_QUEUE_LENGTH
+        self.event_batch_size = TorControlClientProtocol.DEFAULT_EVENT_BATCH_SIZE
+        # event queue statistics, for the lifetime of this protocol
+        self.event_queue_max_depth = 0
+        self.event_last_batch_size = 0
+        self.event_pause_count = 0
         self.clear()
 
     def clear(self):
@@ -1625,6 +2144,16 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
             self.consensus_refresher.stop()
             self.consensus_refresher = None
         self.is_processing_ns = False
+        # Discard any unprocessed events when we're disconnected
+        self.event_queue.clear()
+        if (self.event_queue_call is not None and
+            self.event_queue_call.active()):
+            self.event_queue_call.cancel()
+        self.event_queue_call = None
+        self.is_reading_paused = False
+        # The discarded events will never be counted
+        if self.stop_collection_deferred is not None:
+            self._finishStopCollection(False)
 
     def connectionMade(self):
         '''
@@ -1681,25 +2210,67 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
                               "(none)" if event_list is None else
                               " ".join(event_list)))
         self.traffic_model = traffic_model
+        self.event_debug_log = SampledDebugLog(
+            self.getConfiguredValue('get_debug_event_log_interval',
+                                    'debug event log interval',
+                                    default=1))
+        self.event_queue_length = self.getConfiguredValue(
+                            'get_event_queue_length',
+                            'event queue length',
+                            default=TorControlClientProtocol.DEFAULT_EVENT_QUEUE_LENGTH)
+        self.event_batch_size = self.getConfiguredValue(
+                            'get_event_batch_size',
+                            'event batch size',
+                            default=TorControlClientProtocol.DEFAULT_EVENT_BATCH_SIZE)
         self.enableEvents()
 
-    def stopCollection(self, clear_events=True):
-        '''
-        Disable all events. Remain connected to the control port, but wait for
-        the next collection to start. If clear_events is True, forget the last
-        set of events we used.
-        '''
-        logging.info("Stopping collection, {} events received."
-                     .format("some" if self.has_received_events else "no"))
-        self.has_received_events = False
-        if clear_events:
-            self.collection_events = None
-        self.disableEvents()
-        # set to None after disable events, so we know to send a command
-        # to Tor to delete the model
-        self.traffic_model = None
-        # let the user know that we're waiting
-        logging.info("Waiting for next PrivCount collection to start")
+    def stopCollection(self, clear_events=True, discard_events=False):
+        '''
+        Stop queueing events, and process the events we have already
+        received in batches, so they are counted. Then disable all events.
+        Remain connected to the control port, but wait for the next
+        collection to start. If clear_events is True, forget the last set
+        of events we used. If discard_events is True, discard the events we
+        have already received, rather than processing them.
+        Returns a deferred that fires with True when events are disabled,
+        or with False if an event was rejected or the connection was lost.
+        '''
+        logging.info("Stopping collection, {} events received, {} events queued."
+                     .format("some" if self.has_received_events else "no",
+                             len(self.event_queue)))
+        if self.stop_collection_deferred is not None:
+            logging.warning("stopCollection called while already stopping collection")
+            return self.stop_collection_deferred
+        self.stop_collection_deferred = defer.Deferred()
+        # set the result deferred aside, so a synchronous stop still
+        # returns it
+        stop_deferred = self.stop_collection_deferred
+        self.stop_clear_events = clear_events
+        if discard_events:
+            self.event_queue.clear()
+        # processEventQueue() finishes stopping when the queue is empty
+        self.processEventQueue()
+        return stop_deferred
+
+    def _finishStopCollection(self, is_drained):
+        '''
+        If is_drained is True, disable all events, and forget the last set
+        of events if stopCollection() was asked to clear them.
+        Then fire the stopCollection() deferred with is_drained.
+        '''
+        stop_deferred = self.stop_collection_deferred
+        self.stop_collection_deferred = None
+        if is_drained:
+            self.has_received_events = False
+            if self.stop_clear_events:
+                self.collection_events = None
+            self.disableEvents()
+            # set to None after disable events, so we know to send a command
+            # to Tor to delete the model
+            self.traffic_model = None
+            # let the user know that we're waiting
+            logging.info("Waiting for next PrivCount collection to start")
+        stop_deferred.callback(is_drained)
 
     def enableEvents(self):
         '''
@@ -1804,8 +2375,9 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
         '''
         overrides twisted function
         '''
-        logging.debug("Sending line '{}' to {}"
-                      .format(line, transport_info(self.transport)))
+        if is_debug_enabled():
+            logging.debug("Sending line '{}' to {}"
+                          .format(line, transport_info(self.transport)))
         self.check_line_length(line, False, False)
         # make sure we don't issue a SETCONF when we're not supposed to
         if line.startswith("SETCONF"):
@@ -1852,8 +2424,10 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
         When events are received, process them.
         Overrides twisted function.
         '''
-        logging.debug("Received line '{}' from {}"
-                      .format(line, transport_info(self.transport)))
+        # events are logged using the sampled event debug log
+        if is_debug_enabled() and not line.startswith("650 PRIVCOUNT_"):
+            logging.debug("Received line '{}' from {}"
+                          .format(line, transport_info(self.transport)))
         self.check_line_length(line, True, False)
         line = line.strip()
 
@@ -2133,7 +2707,7 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
             assert len(parts) > 1
             # log the event
             self.has_received_events = True
-            logging.debug("receiving event '{}'".format(line))
+            self.event_debug_log.log("receiving event '{}'", line)
             # skip unwanted events
             if not parts[1] in self.active_events:
                 if not parts[1] in get_valid_events():
@@ -2143,25 +2717,129 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
             # skip empty events
             elif len(parts) <= 2:
                 logging.warning("Event with no data {}".format(line))
-            # send the event, including the event type
-            elif not self.factory.handle_event(parts[1:]):
-                logging.warning("Rejected event {}".format(line))
-                self.quit()
-                return
+            # queue the event, including the event type
+            else:
+                self.queueEvent(parts[1:])
         elif self.is_processing_ns:
             # ignore unexpected lines
             pass
         else:
             self.handleUnexpectedLine(line)
 
+    def queueEvent(self, event):
+        '''
+        Queue event for processing by the factory, and make sure the queue
+        will be processed after we yield to the reactor.
+        If the collection is stopping, ignore event, and return False.
+        Otherwise, return True.
+        Stops reading from the control port when the queue is half full,
+        and starts again when processEventQueue() has drained the queue to
+        a quarter full. Events are never dropped, because that would make
+        the round's counts incomplete: events that were read before reading
+        paused are always queued, even if the queue is over
+        event_queue_length.
+        event is a list of tokens from the event line, split on spaces.
+        '''
+        # the collection has stopped, and we are processing the events we
+        # received before it stopped
+        if self.stop_collection_deferred is not None:
+            return False
+        self.event_queue.append(event)
+        queue_depth = len(self.event_queue)
+        self.event_queue_max_depth = max(self.event_queue_max_depth,
+                                         queue_depth)
+        if (not self.is_reading_paused and
+            queue_depth >= self.event_queue_length/2 and
+            self.transport is not None):
+            self.transport.pauseProducing()
+            self.is_reading_paused = True
+            self.event_pause_count += 1
+        self.scheduleEventQueue()
+        return True
+
+    def scheduleEventQueue(self):
+        '''
+        If there is no call to processEventQueue() scheduled, schedule one
+        for the next reactor iteration.
+        '''
+        if self.event_queue_call is None:
+            self.event_queue_call = reactor.callLater(0,
+                                                      self.processEventQueue)
+
+    def processEventQueue(self, batch_size=None):
+        '''
+        Hand up to batch_size queued events to the factory. If batch_size is
+        None, use the configured event batch size.
+        If there are more events in the queue, schedule another call, so
+        that the reactor can do other work between batches.
+        If the factory rejects an event, discard the queue, quit, and return
+        False. Otherwise, return True.
+        If the collection is stopping, and the queue is empty, finish
+        stopping the collection.
+        This function is called using callLater, so any exceptions will be
+        logged by twisted.
+        '''
+        # we might have been called directly, rather than by the reactor
+        if (self.event_queue_call is not None and
+            self.event_queue_call.active()):
+            self.event_queue_call.cancel()
+        self.event_queue_call = None
+        if batch_size is None:
+            batch_size = self.event_batch_size
+        # schedule the next batch first, so an exception does not stall the
+        # queue
+        if len(self.event_queue) > batch_size:
+            self.scheduleEventQueue()
+        processed_count = 0
+        while processed_count < batch_size and len(self.event_queue) > 0:
+            event = self.event_queue.popleft()
+            processed_count += 1
+            if not self.factory.handle_event(event):
+                logging.warning("Rejected event {}".format(" ".join(event)))
+                self.event_queue.clear()
+                self.quit()
+                return False
+        if processed_count > 0:
+            self.event_last_batch_size = processed_count
+        if (self.is_reading_paused and
+            len(self.event_queue) <= self.event_queue_length/4 and
+            self.transport is not None):
+            self.transport.resumeProducing()
+            self.is_reading_paused = False
+        if (self.stop_collection_deferred is not None and
+            len(self.event_queue) == 0):
+            self._finishStopCollection(True)
+        return True
+
+    def logEventQueueStatus(self):
+        '''
+        Log the event queue statistics for this protocol.
+        These statistics depend on the relay's client activity, so they are
+        only logged locally.
+        '''
+        queue_message = ("Event queue depth: {} max: {} length: {} last batch: {} batch size: {} paused: {}"
+                         .format(len(self.event_queue),
+                                 self.event_queue_max_depth,
+                                 self.event_queue_length,
+                                 self.event_last_batch_size,
+                                 self.event_batch_size,
+                                 self.event_pause_count))
+        if self.event_queue_max_depth > self.event_queue_length:
+            # events weren't dropped, but the queue used more RAM than
+            # expected
+            logging.warning(queue_message)
+        else:
+            logging.info(queue_message)
+
     def handleUnexpectedLine(self, line):
         '''
         Log any unexpected responses at an appropriate level.
         Quit on error responses.
         '''
         if line == "250 OK":
-            logging.debug("Connection with {}: ok response: '{}'"
-                          .format(transport_info(self.transport), line))
+            if is_debug_enabled():
+                logging.debug("Connection with {}: ok response: '{}'"
+                              .format(transport_info(self.transport), line))
         elif line.startswith("650 PRIVCOUNT_"):
             logging.warning("Connection with {}: unexpected event: '{}'"
                             .format(transport_info(self.transport), line))
@@ -2210,7 +2888,9 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
                                  error if error is not None else '(no error)'))
         if self.isConnected():
             # keep events for a reconnect
-            self.stopCollection(clear_events=False)
+            # we're closing the connection, so we can't wait for any queued
+            # events to be processed
+            self.stopCollection(clear_events=False, discard_events=True)
             self.sendLine("QUIT")
             # Avoid a spurious reentrant warning from connectionLost
             self.state = "disconnected"
@@ -2335,8 +3015,9 @@ class TorControlServerProtocol(LineOnlyReceiver, TorControlProtocol):
         '''
         overrides twisted function
         '''
-        logging.debug("Sending line '{}' to {}"
-                      .format(line, transport_info(self.transport)))
+        if is_debug_enabled():
+            logging.debug("Sending line '{}' to {}"
+                          .format(line, transport_info(self.transport)))
         self.check_line_length(line, False, False)
         return LineOnlyReceiver.sendLine(self, line)
 
@@ -2344,8 +3025,9 @@ class TorControlServerProtocol(LineOnlyReceiver, TorControlProtocol):
         '''
         overrides twisted function
         '''
-        logging.debug("Received line '{}' from {}"
-                      .format(line, transport_info(self.transport)))
+        if is_debug_enabled():
+            logging.debug("Received line '{}' from {}"
+                          .format(line, transport_info(self.transport)))
         self.check_line_length(line, True, False)
         line = line.strip()
         parts = line.split(' ')
@@ -12,17 +12,27 @@ import yaml
 
 from copy import deepcopy
 
-from twisted.internet import reactor, ssl
+from twisted.internet import reactor, ssl, threads, defer
 from twisted.internet.protocol import ReconnectingClientFactory
 
 from privcount.config import normalise_path, choose_secret_handshake_path
 from privcount.connection import validate_connection_config
 from privcount.counter import SecureCounters, counter_modulus, add_counter_limits_to_config, combine_counters, count_bins
-from privcount.crypto import get_public_digest, generate_keypair, get_serialized_public_key, load_private_key_file, decrypt
-from privcount.log import log_error
+from privcount.crypto import get_public_digest, generate_keypair, get_serialized_public_key, load_private_key_file, decrypt, SUPPORTED_ENVELOPES
+from privcount.log import log_error, summarise_string
 from privcount.protocol import PrivCountClientProtocol, get_privcount_version
 from privcount.node import PrivCountClient
 
+def decrypt_share_counts(keystore, private_key, share):
+    '''
+    Decrypt the secret in share using private_key, and return its flat list
+    of blinding factors for keystore, or None if it does not match keystore's
+    counters.
+    Runs in a worker thread, so it does not modify keystore or share.
+    '''
+    secret = decrypt(private_key, share['secret'])
+    return keystore.blinding_share_counts(secret)
+
 class ShareKeeper(ReconnectingClientFactory, PrivCountClient):
     '''
     receive key share data from the DC message receiver
@@ -33,6 +43,8 @@ class ShareKeeper(ReconnectingClientFactory, PrivCountClient):
     def __init__(self, config_filepath):
         PrivCountClient.__init__(self, config_filepath)
         self.keystore = None
+        # the deferred for the shares we are importing, if any
+        self.start_deferred = None
 
     def buildProtocol(self, addr):
         '''
@@ -87,6 +99,7 @@ class ShareKeeper(ReconnectingClientFactory, PrivCountClient):
             'name' : self.config['name'],
             'state' : 'active' if self.keystore is not None else 'idle',
             'public_key' : get_serialized_public_key(self.config['key']),
+            'encryption_envelopes' : SUPPORTED_ENVELOPES,
             'privcount_version' : get_privcount_version(),
                }
 
@@ -112,8 +125,15 @@ class ShareKeeper(ReconnectingClientFactory, PrivCountClient):
         to start a new collection phase
         return None if failure, otherwise the protocol will encode the result
         in json and send it back to TS
+        if the shares are valid, returns a deferred that fires with the
+        result, after the shares have been imported
         '''
         logging.info("got command to start new collection phase")
+        if self.start_deferred is not None:
+            # the tally server re-sends START if we check in while we are
+            # importing shares: the original connection sends the result
+            logging.info("ignoring duplicate start command while blinding shares are being imported")
+            return None
         # keep the start config to send to the TS at the end of the collection
         # deepcopy so we can delete the (encrypted) secrets from the shares
         self.start_config = deepcopy(config)
@@ -141,34 +161,96 @@ class ShareKeeper(ReconnectingClientFactory, PrivCountClient):
         else:
             config['counters'] = combined_counters
 
-        self.keystore = SecureCounters(config['counters'], counter_modulus(),
-                                       require_generate_noise=False)
+        keystore = SecureCounters(config['counters'], counter_modulus(),
+                                  require_generate_noise=False)
         share_list = config['shares']
 
+        # Decrypting and decoding shares is slow, so we do it in the reactor
+        # thread pool, and keep responding to the tally server.
+        # (Most of the decryption happens in OpenSSL, which releases the GIL.)
         private_key = load_private_key_file(self.config['key'])
-        for share in share_list:
-            encrypted_secret = share['secret']
-            secret = decrypt(private_key, encrypted_secret)
-            # TODO: secure delete
-            share['secret'] = secret
-            blinding_result = self.keystore.import_blinding_share(share)
-            if not blinding_result:
+        share_deferreds = [threads.deferToThread(decrypt_share_counts,
+                                                 keystore, private_key, share)
+                           for share in share_list]
+        # TODO: secure delete the private key and decrypted shares
+        del private_key
+        start_deferred = defer.gatherResults(share_deferreds,
+                                             consumeErrors=True)
+        # a STOP or a duplicate START can arrive before the import finishes
+        self.start_deferred = start_deferred
+        start_deferred.addCallback(self._import_share_counts, keystore,
+                                   share_list, config, start_deferred)
+        start_deferred.addErrback(self._import_share_failed)
+        start_deferred.addBoth(self._finish_start, start_deferred)
+        # the protocol sends our result when the shares have been imported
+        return start_deferred
+
+    def _finish_start(self, result, start_deferred):
+        '''
+        Called when the import in start_deferred has finished or failed.
+        Returns result.
+        '''
+        if self.start_deferred is start_deferred:
+            self.start_deferred = None
+        return result
+
+    def _import_share_counts(self, blinding_counts_list, keystore, share_list,
+                             config, start_deferred):
+        '''
+        Called when the blinding factors in every share in share_list have
+        been decrypted into blinding_counts_list.
+        Unblinds keystore using the sum of the factors from all the shares.
+        Returns a deferred that fires with the start result.
+        '''
+        if self.start_deferred is not start_deferred:
+            logging.info("discarding blinding shares decrypted after the collection phase stopped")
+            return None
+        for (blinding_counts, share) in zip(blinding_counts_list, share_list):
+            if blinding_counts is None:
                 # the structure of the imported share did not match the
                 # configured counters
                 # this is likely a configuration error or a programming bug,
                 # but there is also no way to detect the TS modifying the data
-                logging.warning("failed to import blinding share {} config {}"
-                                .format(share, config))
-                # TODO: secure delete
-                del private_key
+                logging.warning("failed to import blinding share from {} config {}"
+                                .format(share.get('dc_name'),
+                                        summarise_string(str(config))))
                 return None
-
+        import_deferred = threads.deferToThread(
+                                  keystore.import_blinding_share_counts,
+                                  blinding_counts_list)
+        import_deferred.addCallback(self._set_keystore, keystore, share_list,
+                                    config, start_deferred)
+        return import_deferred
+
+    def _set_keystore(self, _, keystore, share_list, config, start_deferred):
+        '''
+        Called when keystore has imported all the shares in share_list.
+        Returns the start result, or None if the collection phase stopped
+        during the import.
+        '''
+        if self.start_deferred is not start_deferred:
+            logging.info("discarding blinding shares imported after the collection phase stopped")
+            return None
+        self.keystore = keystore
         logging.info("successfully started and imported {} blinding shares for {} counters ({} bins)"
                      .format(len(share_list), len(config['counters']), count_bins(config['counters'])))
-        # TODO: secure delete
-        del private_key
         return {}
 
+    def _import_share_failed(self, failure):
+        '''
+        Called when decrypting or importing a share fails, or the import is
+        cancelled by do_stop().
+        Returns None, so the start fails.
+        '''
+        if failure.check(defer.FirstError):
+            failure = failure.value.subFailure
+        if failure.check(defer.CancelledError):
+            logging.info("stopped importing blinding shares, because the collection phase stopped")
+        else:
+            logging.warning("failed to decrypt or import blinding shares: {}"
+                            .format(failure.getErrorMessage()))
+        return None
+
     def do_stop(self, config):
         '''
         called by protocol
@@ -180,6 +262,14 @@ class ShareKeeper(ReconnectingClientFactory, PrivCountClient):
         '''
         logging.info("got command to stop collection phase")
 
+        if self.start_deferred is not None:
+            # don't install the keystore after the round has stopped
+            # (the share decryption and import threads keep running, but
+            # their results are discarded)
+            start_deferred = self.start_deferred
+            self.start_deferred = None
+            start_deferred.cancel()
+
         response_counts = None
         # send our counts
         if self.keystore is not None:
@@ -231,6 +321,11 @@ class ShareKeeper(ReconnectingClientFactory, PrivCountClient):
             sk_conf.setdefault('always_delay', False)
             assert isinstance(sk_conf['always_delay'], bool)
 
+            # Share keepers don't offer protocol extensions by default,
+            # because older tally servers reject them
+            sk_conf.setdefault('chunked_lines', False)
+            assert isinstance(sk_conf['chunked_lines'], bool)
+
             sk_conf['sigma_decrease_tolerance'] = \
                 self.get_valid_sigma_decrease_tolerance(sk_conf)
 
@@ -11,6 +11,44 @@ import logging
 from privcount.config import validate_ip_address
 from privcount.log import summarise_string
 
+class TaggedEventFields(dict):
+    '''
+    A dictionary of Key: Value pairs from an event with tagged fields, where
+    Key and Value are both strings.
+
+    The is_type_valid functions remember the typed value of each valid field,
+    so the get_type_value functions don't have to check and convert the
+    field again. Setting or removing a field forgets its typed values.
+
+    Use parse_tagged_event() to create these dictionaries.
+    '''
+
+    __slots__ = ('list_values', 'int_values', 'float_values',
+                 'ip_address_values')
+
+    def forget_typed_values(self, field_name):
+        '''
+        Forget the typed values for field_name.
+        '''
+        for typed_values in (getattr(self, 'list_values', None),
+                             getattr(self, 'int_values', None),
+                             getattr(self, 'float_values', None),
+                             getattr(self, 'ip_address_values', None)):
+            if typed_values is not None:
+                typed_values.pop(field_name, None)
+
+    def __setitem__(self, field_name, value):
+        self.forget_typed_values(field_name)
+        dict.__setitem__(self, field_name, value)
+
+    def __delitem__(self, field_name):
+        self.forget_typed_values(field_name)
+        dict.__delitem__(self, field_name)
+
+    def pop(self, field_name, *args):
+        self.forget_typed_values(field_name)
+        return dict.pop(self, field_name, *args)
+
 def parse_tagged_event(event_field_list):
     '''
     Parse event_field_list from an event with tagged fields.
@@ -19,16 +57,21 @@ def parse_tagged_event(event_field_list):
 
     The list must not include the event code (650) or event type (PRIVCOUNT_*).
 
-    Returns a dictionary of Key: Value pairs, where Key and Value are both
-    strings. (To retrieve typed values, use the is_type_valid and
-    get_type_value functions.)
+    Returns a TaggedEventFields dictionary of Key: Value pairs, where Key and
+    Value are both strings. (To retrieve typed values, use the is_type_valid
+    and get_type_value functions.)
     Key must be at least one character, and '=' must be present, or the event
     is malformed.
     If there is no Value after the '=', result[Key] is a zero-length string.
     If any field is not in the correct format, returns an empty dictionary.
 
     '''
-    result = dict()
+    result = TaggedEventFields()
+    # This is faster than an __init__ method
+    result.list_values = {}
+    result.int_values = {}
+    result.float_values = {}
+    result.ip_address_values = {}
     for field in event_field_list:
         # validate the field
         # tolerate multiple spaces between fields
@@ -62,7 +105,8 @@ def parse_tagged_event(event_field_list):
             logging.warning("Ignoring tagged event with duplicate key: '{}'"
                             .format(field))
             return dict()
-        result[key] = value
+        # there are no typed values to forget
+        dict.__setitem__(result, key, value)
     return result
 
 def is_field_valid(field_name, fields, event_desc,
@@ -101,10 +145,10 @@ def is_string_valid(field_name, fields, event_desc,
         return True
     field_value = fields[field_name]
     field_len = len(field_value)
-    field_value_summary = summarise_string(field_value)
     if min_len is not None and field_len < min_len:
         logging.warning("Ignored {} length {}: '{}', must be at least {} characters {}"
-                        .format(field_name, field_len, field_value_summary,
+                        .format(field_name, field_len,
+                                summarise_string(field_value),
                                 min_len, event_desc))
         logging.debug("Ignored {} length {} (full string): '{}', must be at least {} characters {}"
                       .format(field_name, field_len, field_value,
@@ -113,7 +157,8 @@ def is_string_valid(field_name, fields, event_desc,
         return False
     if max_len is not None and field_len > max_len:
         logging.warning("Ignored {} length {}: '{}', must be at most {} characters {}"
-                        .format(field_name, field_len, field_value_summary,
+                        .format(field_name, field_len,
+                                summarise_string(field_value),
                                 max_len, event_desc))
         logging.debug("Ignored {} length {} (full string): '{}', must be at most {} characters {}"
                       .format(field_name, field_len, field_value,
@@ -144,16 +189,16 @@ def is_list_valid(field_name, fields, event_desc,
         # valid optional field, keep on processing
         return True
     field_value = fields[field_name]
-    field_value_summary = summarise_string(field_value)
     # Assume a zero-length value is a list with no items
     if len(field_value) > 0:
-        list_count = field_value.count(',') + 1
+        list_value = field_value.split(',')
     else:
-        list_count = 0
+        list_value = []
+    list_count = len(list_value)
     if min_count is not None and list_count < min_count:
         logging.warning("Ignored {} '{}', must have at least {} items {}"
-                        .format(field_name, field_value_summary, min_count,
-                                event_desc))
+                        .format(field_name, summarise_string(field_value),
+                                min_count, event_desc))
         logging.debug("Ignored {} (full list) '{}', must have at least {} items {}"
                       .format(field_name, field_value, min_count,
                               event_desc))
@@ -161,13 +206,17 @@ def is_list_valid(field_name, fields, event_desc,
         return False
     if max_count is not None and list_count > max_count:
         logging.warning("Ignored {} '{}', must have at most {} items {}"
-                        .format(field_name, field_value_summary, max_count,
-                                event_desc))
+                        .format(field_name, summarise_string(field_value),
+                                max_count, event_desc))
         logging.debug("Ignored {} (full list) '{}', must have at most {} items {}"
                       .format(field_name, field_value, max_count,
                               event_desc))
         # we can't process it
         return False
+    # remember the list, so get_list_value() doesn't split it again
+    list_values = getattr(fields, 'list_values', None)
+    if list_values is not None:
+        list_values[field_name] = list_value
     # it is valid and we want to keep on processing
     return True
 
@@ -195,6 +244,10 @@ def is_int_valid(field_name, fields, event_desc,
                         .format(field_name, fields[field_name], e,
                                 event_desc))
         return False
+    # remember the integer, so get_int_value() doesn't check it again
+    int_values = getattr(fields, 'int_values', None)
+    if int_values is not None:
+        int_values[field_name] = field_value
     if min_value is not None and field_value < min_value:
         logging.warning("Ignored {} '{}', must be at least {} {}"
                         .format(field_name, field_value, min_value,
@@ -249,6 +302,10 @@ def is_float_valid(field_name, fields, event_desc,
                         .format(field_name, fields[field_name], e,
                                 event_desc))
         return False
+    # remember the float, so get_float_value() doesn't check it again
+    float_values = getattr(fields, 'float_values', None)
+    if float_values is not None:
+        float_values[field_name] = field_value
     if min_value is not None and field_value < min_value:
         logging.warning("Ignored {} '{}', must be at least {} {}"
                         .format(field_name, field_value, min_value,
@@ -284,9 +341,92 @@ def is_ip_address_valid(field_name, fields, event_desc,
         logging.warning("Ignored {} '{}', must be an IP address {}"
                         .format(field_name, fields[field_name], event_desc))
         return False
+    # remember the address, so get_ip_address_object() doesn't check it again
+    ip_address_values = getattr(fields, 'ip_address_values', None)
+    if ip_address_values is not None:
+        ip_address_values[field_name] = field_value
     # it is valid and we want to keep on processing
     return True
 
+# Field types for make_field_spec()
+STRING_FIELD = 'string'
+LIST_FIELD = 'list'
+INT_FIELD = 'int'
+FLAG_FIELD = 'flag'
+FLOAT_FIELD = 'float'
+IP_ADDRESS_FIELD = 'ip_address'
+
+def make_field_spec(field_name, field_type,
+                    is_mandatory=False,
+                    min_value=None, max_value=None):
+    '''
+    Return a field specification for are_fields_valid().
+    field_type is one of the *_FIELD types in this module.
+    For strings, min_value and max_value are the minimum and maximum length.
+    For lists, they are the minimum and maximum item count.
+    Flags and IP addresses do not have a range.
+    '''
+    assert field_type in FIELD_TYPE_VALIDATORS
+    if field_type == FLAG_FIELD or field_type == IP_ADDRESS_FIELD:
+        assert min_value is None
+        assert max_value is None
+    return (field_name, field_type, is_mandatory, min_value, max_value)
+
+def _is_flag_spec_valid(field_name, fields, event_desc,
+                        is_mandatory, min_value, max_value):
+    '''
+    Call is_flag_valid(), ignoring min_value and max_value.
+    '''
+    return is_flag_valid(field_name, fields, event_desc,
+                         is_mandatory=is_mandatory)
+
+def _is_ip_address_spec_valid(field_name, fields, event_desc,
+                              is_mandatory, min_value, max_value):
+    '''
+    Call is_ip_address_valid(), ignoring min_value and max_value.
+    '''
+    return is_ip_address_valid(field_name, fields, event_desc,
+                               is_mandatory=is_mandatory)
+
+# Each function takes field_name, fields, event_desc, is_mandatory,
+# min_value, and max_value
+FIELD_TYPE_VALIDATORS = {
+    STRING_FIELD : is_string_valid,
+    LIST_FIELD : is_list_valid,
+    INT_FIELD : is_int_valid,
+    FLAG_FIELD : _is_flag_spec_valid,
+    FLOAT_FIELD : is_float_valid,
+    IP_ADDRESS_FIELD : _is_ip_address_spec_valid,
+    }
+
+def are_fields_valid(fields, field_specs, event_desc):
+    '''
+    Check each field in fields against its specification in field_specs,
+    a sequence of field specifications created by make_field_spec().
+    Fields are checked in order, using the is_type_valid function for their
+    type. Missing optional fields are skipped without any further checks.
+
+    If any check fails, return False (the event is ignored), and log a
+    warning for the first invalid field using event_desc.
+    Otherwise, return True (the event should be processed).
+    '''
+    for (field_name, field_type, is_mandatory,
+         min_value, max_value) in field_specs:
+        if field_name not in fields:
+            if is_mandatory:
+                logging.warning("Rejected missing {} {}"
+                                .format(field_name, event_desc))
+                return False
+            # valid optional field, keep on processing
+            continue
+        if not FIELD_TYPE_VALIDATORS[field_type](field_name, fields,
+                                                 event_desc,
+                                                 is_mandatory,
+                                                 min_value, max_value):
+            return False
+    # if everything passed, we're ok
+    return True
+
 def get_string_value(field_name, fields, event_desc,
                      is_mandatory=False,
                      default=None):
@@ -324,6 +464,13 @@ def get_list_value(field_name, fields, event_desc,
         assert not is_mandatory
         return default
 
+    list_values = getattr(fields, 'list_values', None)
+    if list_values is not None:
+        field_value = list_values.get(field_name)
+        if field_value is not None:
+            # callers can modify the list, so give them a copy
+            return list(field_value)
+
     # This should have been checked earlier
     # There are no non-count list checks, but we do this for consistency
     assert is_list_valid(field_name, fields, event_desc)
@@ -351,6 +498,12 @@ def get_int_value(field_name, fields, event_desc,
         assert not is_mandatory
         return default
 
+    int_values = getattr(fields, 'int_values', None)
+    if int_values is not None:
+        field_value = int_values.get(field_name)
+        if field_value is not None:
+            return field_value
+
     # This should have been checked earlier
     # We're just using this for its integer format check
     assert is_int_valid(field_name, fields, event_desc)
@@ -375,6 +528,15 @@ def get_flag_value(field_name, fields, event_desc,
         assert not is_mandatory
         return default
 
+    int_values = getattr(fields, 'int_values', None)
+    if int_values is not None:
+        field_value = int_values.get(field_name)
+        if field_value is not None:
+            # the integer format has been checked, but the range might not
+            # have been
+            assert field_value == 0 or field_value == 1
+            return bool(field_value)
+
     # This should have been checked earlier
     # We're just using this for its integer format and bool range check
     assert is_flag_valid(field_name, fields, event_desc)
@@ -397,6 +559,12 @@ def get_float_value(field_name, fields, event_desc,
         assert not is_mandatory
         return default
 
+    float_values = getattr(fields, 'float_values', None)
+    if float_values is not None:
+        field_value = float_values.get(field_name)
+        if field_value is not None:
+            return field_value
+
     # This should have been checked earlier
     # We're just using this for its float format check
     assert is_float_valid(field_name, fields, event_desc)
@@ -418,6 +586,12 @@ def get_ip_address_object(field_name, fields, event_desc,
         assert not is_mandatory
         return default
 
+    ip_address_values = getattr(fields, 'ip_address_values', None)
+    if ip_address_values is not None:
+        field_value = ip_address_values.get(field_name)
+        if field_value is not None:
+            return field_value
+
     # This should have been checked earlier
     # We're just using this for its IP address format check
     assert is_ip_address_valid(field_name, fields, event_desc)
@@ -8,6 +8,7 @@ See LICENSE for licensing information
 import os
 import json
 import logging
+import multiprocessing
 import cPickle as pickle
 import re
 import yaml
@@ -24,7 +25,7 @@ from privcount.config import normalise_path, choose_secret_handshake_path, _extr
 from privcount.counter import SecureCounters, counter_modulus, min_blinded_counter_value, max_blinded_counter_value, min_tally_counter_value, max_tally_counter_value, add_counter_limits_to_config, check_noise_weight_config, check_counters_config, CollectionDelay, float_accuracy, count_bins, are_events_expected, _common_keys
 from privcount.crypto import generate_keypair, generate_cert
 from privcount.log import log_error, format_elapsed_time_since, format_elapsed_time_wait, format_delay_time_until, format_interval_time_between, format_last_event_time_since, errorCallback, summarise_string, summarise_list
-from privcount.match import exact_match_prepare_collection, suffix_match_prepare_collection, ipasn_prefix_match_prepare_string, load_match_list, load_as_prefix_map, exact_match, suffix_match, suffix_match_validate_item, exact_match_validate_item
+from privcount.match import exact_match_prepare_collection, suffix_match_prepare_collection, suffix_trie_prepare_collections, suffix_trie_load, exact_match_compile, suffix_match_compile, ipasn_prefix_match_prepare_string, load_match_list, load_as_prefix_map, MatchFileCache, exact_match, suffix_match, suffix_match_validate_item, exact_match_validate_item, choose_match_list_format, MATCH_LIST_FORMAT_RAW, MATCH_LIST_FORMAT_TABLE
 from privcount.node import PrivCountNode, PrivCountServer, continue_collecting, log_tally_server_status, EXPECTED_EVENT_INTERVAL_MAX, EXPECTED_CONTROL_ESTABLISH_MAX
 from privcount.protocol import PrivCountServerProtocol, get_privcount_version
 from privcount.statistics_noise import get_noise_allocation, get_sanity_check_counter, DEFAULT_DUMMY_COUNTER_NAME
@@ -48,6 +49,8 @@ class TallyServer(ServerFactory, PrivCountServer):
         self.idle_time = time()
         self.num_completed_collection_phases = 0
         self.refresh_task = None
+        # compiled match lists, keyed by their processed match list
+        self.compiled_match_lists = {}
 
     def buildProtocol(self, addr):
         '''
@@ -154,6 +157,37 @@ class TallyServer(ServerFactory, PrivCountServer):
         if self.collection_phase is not None:
             self.collection_phase.log_status()
 
+    # Match files are cached between config refreshes
+    match_file_cache = MatchFileCache()
+
+    # The worker processes used to check match files
+    match_pool = None
+    match_pool_worker_count = 0
+
+    @staticmethod
+    def get_match_pool(worker_count):
+        '''
+        Return a multiprocessing.Pool with worker_count processes, or None
+        if worker_count is 0.
+        The pool is created during the first config load, before the
+        reactor runs, so the worker processes do not inherit the reactor's
+        threads or connections. Later changes to worker_count are ignored
+        until the tally server restarts.
+        '''
+        if worker_count != TallyServer.match_pool_worker_count:
+            if reactor.running:
+                logging.warning("Ignoring match_worker_count change from {} to {}: restart the tally server to change it"
+                                .format(TallyServer.match_pool_worker_count,
+                                        worker_count))
+            else:
+                if TallyServer.match_pool is not None:
+                    TallyServer.match_pool.terminate()
+                    TallyServer.match_pool = None
+                if worker_count > 0:
+                    TallyServer.match_pool = multiprocessing.Pool(worker_count)
+                TallyServer.match_pool_worker_count = worker_count
+        return TallyServer.match_pool
+
     @staticmethod
     def load_match_file(config,
                         file_path,
@@ -164,7 +198,8 @@ class TallyServer(ServerFactory, PrivCountServer):
                         check_country=False,
                         check_as=False,
                         check_reason=False,
-                        check_onion=False):
+                        check_onion=False,
+                        worker_count=0):
         '''
         Load a match file from file_path.
 
@@ -185,6 +220,9 @@ class TallyServer(ServerFactory, PrivCountServer):
         potentially valid onion address, after stripping non-onion address
         components from URLs or domains, and lowercasing the resulting string.
 
+        If worker_count is positive, check the file using that many worker
+        processes, from get_match_pool().
+
         If config is None, or the file is not in old_match_files, or the
         contents do not match old_match_lists, then mark the list as changed.
 
@@ -192,12 +230,16 @@ class TallyServer(ServerFactory, PrivCountServer):
         indicating whether the list changed since the last time it was loaded.
         '''
         assert file_path is not None
-        (file_path, match_list) = load_match_list(file_path,
-                                                  check_domain=check_domain,
-                                                  check_country=check_country,
-                                                  check_as=check_as,
-                                                  check_reason=check_reason,
-                                                  check_onion=check_onion)
+        # unchanged files are not loaded or checked again
+        (file_path,
+         match_list) = TallyServer.match_file_cache.load(load_match_list,
+                                                         file_path,
+                                                         check_domain=check_domain,
+                                                         check_country=check_country,
+                                                         check_as=check_as,
+                                                         check_reason=check_reason,
+                                                         check_onion=check_onion,
+                                                         pool=TallyServer.get_match_pool(worker_count))
 
         # lists must have at least one entry
         assert len(match_list) > 0
@@ -209,7 +251,9 @@ class TallyServer(ServerFactory, PrivCountServer):
             old_match_files is None or
             file_path not in old_match_files or
             old_match_lists is None or
-            match_list != old_match_lists[old_match_files.index(file_path)]):
+            # cached lists are only compared if they have changed
+            (match_list is not old_match_lists[old_match_files.index(file_path)] and
+             match_list != old_match_lists[old_match_files.index(file_path)])):
             has_list_changed = True
             logging.info("Changed list: '{}'".format(file_path))
 
@@ -292,7 +336,9 @@ class TallyServer(ServerFactory, PrivCountServer):
 
         # import this list of address / prefix / AS number lines
         # This takes under a second for the coalesced IPv4 prefixes
-        (file_path, map_list) = load_as_prefix_map(file_path)
+        (file_path, map_list) = TallyServer.match_file_cache.load(
+                                                         load_as_prefix_map,
+                                                         file_path)
 
         # maps must not be empty
         assert len(map_list) > 0
@@ -368,14 +414,15 @@ class TallyServer(ServerFactory, PrivCountServer):
                           suffixes_key=None,
                           suffix_separator=None,
                           validate=True,
-                          reject_overlapping_lists=False):
+                          reject_overlapping_lists=False,
+                          worker_count=0):
         '''
         Load raw list data from each file in new_config[files_key] into
         new_config[lists_key], using old_config to check if the files need
         to be re-processed. Update the paths in new_config[files_key] to
         absolute paths.
 
-        Pass check_* directly to load_match_file().
+        Pass check_* and worker_count directly to load_match_file().
 
         Once the files have been processed, update the bins for counters in
         counters_key that return true for counter_filter(counter_name).
@@ -430,7 +477,8 @@ class TallyServer(ServerFactory, PrivCountServer):
                                          check_country=check_country,
                                          check_as=check_as,
                                          check_reason=check_reason,
-                                         check_onion=check_onion)
+                                         check_onion=check_onion,
+                                         worker_count=worker_count)
                 new_config[files_key][i] = file_path
                 if has_list_changed:
                     has_any_previous_list_changed = True
@@ -450,13 +498,14 @@ class TallyServer(ServerFactory, PrivCountServer):
                           prepare_exact=True,
                           existing_exacts=new_processed_config[exacts_key],
                           match_onion_md5=check_onion)
-                  if suffixes_key is not None:
-                      TallyServer.process_match_list(
-                          new_config[lists_key][i],
-                          prepare_suffix=True,
-                          suffix_separator=suffix_separator,
-                          existing_suffixes=new_processed_config[suffixes_key],
-                          collection_tag=i)
+              # the suffix trie is built from all the lists at once, and
+              # each item is validated below
+              if suffixes_key is not None:
+                  (new_processed_config[suffixes_key],
+                   _) = suffix_trie_prepare_collections(
+                          new_config[lists_key],
+                          separator=suffix_separator,
+                          validate=False)
             # modify the bins
             TallyServer.modify_counter_list_bins(
                len(new_config[files_key]),
@@ -732,6 +781,11 @@ class TallyServer(ServerFactory, PrivCountServer):
             ts_conf.setdefault('reject_overlapping_lists', True)
             assert isinstance(ts_conf['reject_overlapping_lists'], bool)
 
+            # How many processes do we use to check each match file?
+            ts_conf.setdefault('match_worker_count', 0)
+            ts_conf['match_worker_count'] = int(ts_conf['match_worker_count'])
+            assert ts_conf['match_worker_count'] >= 0
+
             # CountLists
             # These config options should be kept synchronised with the
             # corresponding plot lookups
@@ -749,7 +803,8 @@ class TallyServer(ServerFactory, PrivCountServer):
                 exacts_key='domain_exacts',
                 suffixes_key='domain_suffixes',
                 suffix_separator=".",
-                reject_overlapping_lists=ts_conf['reject_overlapping_lists'])
+                reject_overlapping_lists=ts_conf['reject_overlapping_lists'],
+                worker_count=ts_conf['match_worker_count'])
 
             # optional lists of country codes from the MaxMind GeoIP database
             TallyServer.load_match_config(
@@ -762,7 +817,8 @@ class TallyServer(ServerFactory, PrivCountServer):
                 counter_filter=(lambda counter_name: "CountryMatch" in counter_name and
                                                      counter_name.endswith("CountList")),
                 exacts_key='country_exacts',
-                reject_overlapping_lists=ts_conf['reject_overlapping_lists'])
+                reject_overlapping_lists=ts_conf['reject_overlapping_lists'],
+                worker_count=ts_conf['match_worker_count'])
 
             # as_data is used as the processed config by the prefix maps and the AS lists
             old_as_data = self.config.get('as_data', {}) if self.config is not None else {}
@@ -797,7 +853,8 @@ class TallyServer(ServerFactory, PrivCountServer):
                 old_processed_config=old_as_data,
                 new_processed_config=ts_conf['as_data'],
                 exacts_key='lists',
-                reject_overlapping_lists=ts_conf['reject_overlapping_lists'])
+                reject_overlapping_lists=ts_conf['reject_overlapping_lists'],
+                worker_count=ts_conf['match_worker_count'])
 
             # do some additional checks on the AS lists
             # you must have both prefix mappings and AS lists, or neither
@@ -815,7 +872,8 @@ class TallyServer(ServerFactory, PrivCountServer):
                                                      "Store" in counter_name and
                                                      counter_name.endswith("ReasonCountList")),
                 exacts_key='hsdir_store_exacts',
-                reject_overlapping_lists=ts_conf['reject_overlapping_lists'])
+                reject_overlapping_lists=ts_conf['reject_overlapping_lists'],
+                worker_count=ts_conf['match_worker_count'])
 
             # optional lists of HSDir Fetch reasons
             TallyServer.load_match_config(
@@ -829,7 +887,8 @@ class TallyServer(ServerFactory, PrivCountServer):
                                                      "Fetch" in counter_name and
                                                      counter_name.endswith("ReasonCountList")),
                 exacts_key='hsdir_fetch_exacts',
-                reject_overlapping_lists=ts_conf['reject_overlapping_lists'])
+                reject_overlapping_lists=ts_conf['reject_overlapping_lists'],
+                worker_count=ts_conf['match_worker_count'])
 
             # optional lists of Circuit Failure reasons
             TallyServer.load_match_config(
@@ -841,7 +900,8 @@ class TallyServer(ServerFactory, PrivCountServer):
                 # Circuit Failure reason counters match *FailureCircuitReasonCountList
                 counter_filter=(lambda counter_name: counter_name.endswith("FailureCircuitReasonCountList")),
                 exacts_key='circuit_failure_exacts',
-                reject_overlapping_lists=ts_conf['reject_overlapping_lists'])
+                reject_overlapping_lists=ts_conf['reject_overlapping_lists'],
+                worker_count=ts_conf['match_worker_count'])
 
             # optional lists of onion addresses for HSDir Store and Fetch events
             TallyServer.load_match_config(
@@ -855,7 +915,8 @@ class TallyServer(ServerFactory, PrivCountServer):
                                                      ("Store" in counter_name or "Fetch" in counter_name) and
                                                      counter_name.endswith("OnionAddressCountList")),
                 exacts_key='onion_address_exacts',
-                reject_overlapping_lists=ts_conf['reject_overlapping_lists'])
+                reject_overlapping_lists=ts_conf['reject_overlapping_lists'],
+                worker_count=ts_conf['match_worker_count'])
 
 
             # an optional noise allocation results file
@@ -1001,6 +1062,8 @@ class TallyServer(ServerFactory, PrivCountServer):
             # unconditionally replace the config, even if it hasn't changed
             # this avoids bugs in the change logic above
             self.config = ts_conf
+            # forget any match files that are no longer in the config
+            TallyServer.match_file_cache.forget_unused()
 
         except AssertionError:
             logging.warning("problem reading config file: invalid data")
@@ -1258,6 +1321,7 @@ class TallyServer(ServerFactory, PrivCountServer):
             'delay_reason' : delay_reason,
             'privcount_version' : get_privcount_version(),
         }
+        status.update(TallyServer.match_file_cache.get_status())
 
         # we can't know the expected end time until we have started
         if self.collection_phase is not None:
@@ -1507,8 +1571,12 @@ class TallyServer(ServerFactory, PrivCountServer):
         clock_padding = self.get_clock_padding(dc_uids + sk_uids)
 
         sk_public_keys = {}
+        sk_encryption_envelopes = {}
         for uid in sk_uids:
             sk_public_keys[uid] = self.clients[uid]['public_key']
+            # older share keepers don't advertise any envelopes
+            sk_encryption_envelopes[uid] = self.clients[uid].get(
+                                              'encryption_envelopes', [])
 
         traffic_model_conf = None
         if 'traffic_model' in self.config:
@@ -1518,10 +1586,55 @@ class TallyServer(ServerFactory, PrivCountServer):
         # so we'll wait and pass the client context to collection_phase just
         # before stopping it
 
-        # frozensets don't serialise into JSON
-        # make a shallow copy of the as_data, so we can modify lists
-        as_data = self.config['as_data'].copy()
-        as_data['lists'] = [list(c) for c in as_data['lists']]
+        dc_match_list_formats = {}
+        for uid in dc_uids:
+            # older data collectors don't advertise any match list formats
+            dc_match_list_formats[uid] = choose_match_list_format(
+                self.clients[uid].get('match_list_formats', []))
+
+        # frozensets don't serialise into JSON, so we send compiled match
+        # lists, which data collectors can load without processing them
+        # Each list is only compiled when its contents change
+        compiled_match_lists = {}
+        def compile_match_list(match_obj, compile_func):
+            if match_obj not in self.compiled_match_lists:
+                self.compiled_match_lists[match_obj] = compile_func(match_obj)
+            compiled_match_lists[match_obj] = self.compiled_match_lists[match_obj]
+            return compiled_match_lists[match_obj]
+        def compile_exact_lists(exact_objs):
+            return [compile_match_list(c, exact_match_compile)
+                    for c in exact_objs]
+        # older data collectors expect JSON lists
+        def list_exact_lists(exact_objs):
+            return [list(c) for c in exact_objs]
+        def get_count_lists(prepare_exact_lists):
+            # make a shallow copy of the as_data, so we can modify lists
+            as_data = self.config['as_data'].copy()
+            as_data['lists'] = prepare_exact_lists(as_data['lists'])
+            return {
+                'domain_lists' : prepare_exact_lists(self.config['domain_exacts']),
+                'country_lists' : prepare_exact_lists(self.config['country_exacts']),
+                'as_data' : as_data,
+                'hsdir_store_lists' : prepare_exact_lists(self.config['hsdir_store_exacts']),
+                'hsdir_fetch_lists' : prepare_exact_lists(self.config['hsdir_fetch_exacts']),
+                'circuit_failure_lists' : prepare_exact_lists(self.config['circuit_failure_exacts']),
+                'onion_address_lists' : prepare_exact_lists(self.config['onion_address_exacts']),
+                }
+
+        # only prepare the formats that the data collectors need
+        domain_suffix_trie = suffix_trie_load(self.config['domain_suffixes'],
+                                              separator=".")
+        count_lists = {}
+        if MATCH_LIST_FORMAT_TABLE in dc_match_list_formats.values():
+            count_lists[MATCH_LIST_FORMAT_TABLE] = get_count_lists(compile_exact_lists)
+            count_lists[MATCH_LIST_FORMAT_TABLE]['domain_suffix_table'] = compile_match_list(
+                                                                            domain_suffix_trie,
+                                                                            suffix_match_compile)
+        if MATCH_LIST_FORMAT_RAW in dc_match_list_formats.values():
+            count_lists[MATCH_LIST_FORMAT_RAW] = get_count_lists(list_exact_lists)
+            # older data collectors expect a nested dict
+            count_lists[MATCH_LIST_FORMAT_RAW]['domain_suffixes'] = domain_suffix_trie.to_suffix_obj()
+
         self.collection_phase = CollectionPhase(self.config['collect_period'],
                                                 self.config['counters'],
                                                 traffic_model_conf,
@@ -1530,20 +1643,17 @@ class TallyServer(ServerFactory, PrivCountServer):
                                                 self.config['dc_threshold'],
                                                 sk_uids,
                                                 sk_public_keys,
+                                                sk_encryption_envelopes,
                                                 dc_uids,
+                                                dc_match_list_formats,
                                                 counter_modulus(),
                                                 clock_padding,
                                                 self.config['max_cell_events_per_circuit'],
                                                 self.config['circuit_sample_rate'],
-                                                [list(c) for c in self.config['domain_exacts']],
-                                                self.config['domain_suffixes'],
-                                                [list(c) for c in self.config['country_exacts']],
-                                                as_data,
-                                                [list(c) for c in self.config['hsdir_store_exacts']],
-                                                [list(c) for c in self.config['hsdir_fetch_exacts']],
-                                                [list(c) for c in self.config['circuit_failure_exacts']],
-                                                [list(c) for c in self.config['onion_address_exacts']],
+                                                count_lists,
                                                 self.config)
+        # forget lists that are no longer in use
+        self.compiled_match_lists = compiled_match_lists
         self.collection_phase.start()
 
     def stop_collection_phase(self):
@@ -1639,12 +1749,10 @@ class CollectionPhase(object):
 
     def __init__(self, period, counters_config, traffic_model_config, noise_config,
                  noise_weight_config, dc_threshold_config, sk_uids,
-                 sk_public_keys, dc_uids, modulus, clock_padding,
+                 sk_public_keys, sk_encryption_envelopes, dc_uids,
+                 dc_match_list_formats, modulus, clock_padding,
                  max_cell_events_per_circuit, circuit_sample_rate,
-                 domain_lists, domain_suffixes, country_lists, as_data,
-                 hsdir_store_lists, hsdir_fetch_lists, circuit_failure_lists,
-                 onion_address_lists,
-                 tally_server_config):
+                 count_lists, tally_server_config):
         # the counter bins and configs
         self.counters_config = counters_config
         self.traffic_model_config = traffic_model_config
@@ -1655,7 +1763,9 @@ class CollectionPhase(object):
         # the participants
         self.sk_uids = sk_uids
         self.sk_public_keys = sk_public_keys
+        self.sk_encryption_envelopes = sk_encryption_envelopes
         self.dc_uids = dc_uids
+        self.dc_match_list_formats = dc_match_list_formats
 
         # the parameters
         self.period = period
@@ -1664,15 +1774,8 @@ class CollectionPhase(object):
         self.max_cell_events_per_circuit = max_cell_events_per_circuit
         self.circuit_sample_rate = circuit_sample_rate
 
-        # the count lists
-        self.domain_lists = domain_lists
-        self.domain_suffixes = domain_suffixes
-        self.country_lists = country_lists
-        self.as_data = as_data
-        self.hsdir_store_lists = hsdir_store_lists
-        self.hsdir_fetch_lists = hsdir_fetch_lists
-        self.circuit_failure_lists = circuit_failure_lists
-        self.onion_address_lists = onion_address_lists
+        # the count lists in each match list format
+        self.count_lists = count_lists
 
         # make a deep copy, so we can delete unnecesary keys
         self.tally_server_config = deepcopy(tally_server_config)
@@ -1902,6 +2005,9 @@ class CollectionPhase(object):
             config['sharekeepers'] = {}
             for sk_uid in self.sk_public_keys:
                 config['sharekeepers'][sk_uid] = b64encode(self.sk_public_keys[sk_uid])
+            # the encryption envelopes each share keeper supports
+            # older data collectors ignore this, and use the original envelope
+            config['sharekeeper_envelopes'] = self.sk_encryption_envelopes
 
             # the counter configs
             config['counters'] = self.counters_config
@@ -1917,15 +2023,8 @@ class CollectionPhase(object):
             config['max_cell_events_per_circuit'] = self.max_cell_events_per_circuit
             config['circuit_sample_rate'] = self.circuit_sample_rate
 
-            # the count lists
-            config['domain_lists'] = self.domain_lists
-            config['domain_suffixes'] = self.domain_suffixes
-            config['country_lists'] = self.country_lists
-            config['as_data'] = self.as_data
-            config['hsdir_store_lists'] = self.hsdir_store_lists
-            config['hsdir_fetch_lists'] = self.hsdir_fetch_lists
-            config['circuit_failure_lists'] = self.circuit_failure_lists
-            config['onion_address_lists'] = self.onion_address_lists
+            # the count lists, in a format the data collector can load
+            config.update(self.count_lists[self.dc_match_list_formats[client_uid]])
 
             logging.info("sending start comand with {} counters ({} bins) and requesting {} shares to data collector {}"
                          .format(len(config['counters']),
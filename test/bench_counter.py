@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+'''
+python bench_counter.py [counters_path [increment_count]]
+
+Benchmark SecureCounters.increment() using the counters in counters_path
+(default: counters.bins.yaml in this directory).
+Each increment uses a random counter, and a random value from one of its
+bins (or just outside its bins).
+Report increments per second. (This is the best of several repetitions.)
+
+Then repeat the benchmark on synthetic histogram and match list counters
+with 10, 100, and 1000 bins.
+Then report how long it takes to tally the blinded counts for counters_path
+from 10, 100, and 1000 clients (data collectors and share keepers).
+
+Typical results:
+
+Before the compiled CounterBinIndex (a linear scan using is_in_bin()):
+$ test/bench_counter.py test/counters.bins.yaml 100000
+loaded 5314 counters with 11456 bins from test/counters.bins.yaml
+234280 increments per second (best of 5 repetitions of 100000 increments)
+158781 increments per second on synthetic counters with 10 bins
+21817 increments per second on synthetic counters with 100 bins
+1923 increments per second on synthetic counters with 1000 bins
+
+After:
+$ test/bench_counter.py test/counters.bins.yaml 100000
+loaded 5314 counters with 11456 bins from test/counters.bins.yaml
+266128 increments per second (best of 5 repetitions of 100000 increments)
+602715 increments per second on synthetic counters with 10 bins
+564483 increments per second on synthetic counters with 100 bins
+507895 increments per second on synthetic counters with 1000 bins
+
+Before batched tallying (tallying and reducing one client at a time):
+0.18s to tally 11456 bins from 10 clients (best of 3 repetitions)
+1.02s to tally 11456 bins from 100 clients (best of 3 repetitions)
+10.31s to tally 11456 bins from 1000 clients (best of 3 repetitions)
+
+After:
+0.14s to tally 11456 bins from 10 clients (best of 3 repetitions)
+0.62s to tally 11456 bins from 100 clients (best of 3 repetitions)
+6.01s to tally 11456 bins from 1000 clients (best of 3 repetitions)
+'''
+
+import logging
+import os
+import random
+import sys
+import timeit
+import yaml
+
+from privcount.counter import SecureCounters, counter_modulus, count_bins
+SINGLE_BIN = SecureCounters.SINGLE_BIN
+
+# try to make sure that other processes don't warp the results too much
+DEFAULT_REPETITIONS = 5
+DEFAULT_INCREMENT_COUNT = 100000
+SYNTHETIC_BIN_COUNTS = [10, 100, 1000]
+TALLY_CLIENT_COUNTS = [10, 100, 1000]
+TALLY_REPETITIONS = 3
+DISTINCT_CLIENT_COUNTS = 10
+DEFAULT_COUNTERS_PATH = os.path.join(os.path.dirname(__file__),
+                                     'counters.bins.yaml')
+
+def load_counters(counters_path):
+    '''
+    Load the counters in counters_path, and give them a zero sigma.
+    '''
+    with open(counters_path, 'r') as fin:
+        counters = yaml.load(fin)['counters']
+    for key in counters:
+        counters[key]['sigma'] = 0.0
+    return counters
+
+def random_bin_value(bins):
+    '''
+    Return a random value from a random bin in bins, or a value just outside
+    the bins.
+    '''
+    (bin_min, bin_max) = random.choice(bins)[0:2]
+    bin_min = float(bin_min)
+    bin_max = float(bin_max)
+    if bin_min == float('-inf'):
+        bin_min = -2.0**32
+    if bin_max == float('inf'):
+        bin_max = 2.0**32
+    # mostly hit the bins, but sometimes land just outside them
+    return random.uniform(bin_min - 1.0, bin_max)
+
+def make_increments(counters, increment_count):
+    '''
+    Return a list of increment_count (counter_name, bin) tuples for counters.
+    '''
+    names = sorted(counters.keys())
+    increments = []
+    for _ in xrange(increment_count):
+        name = random.choice(names)
+        bins = counters[name]['bins']
+        if len(bins) == 1:
+            increments.append((name, SINGLE_BIN))
+        else:
+            increments.append((name, random_bin_value(bins)))
+    return increments
+
+def make_synthetic_counters(bin_count):
+    '''
+    Return a histogram counter and a match list counter, each with bin_count
+    bins. Real histograms and match list counters can have many more bins
+    than the counters in the test config.
+    '''
+    histogram_bins = [[0.0, 1.0]]
+    for i in xrange(bin_count - 2):
+        histogram_bins.append([float(2**i), float(2**(i + 1))])
+    histogram_bins.append([float(2**(bin_count - 2)), float('inf')])
+    list_bins = [[float(i), float(i + 1)] for i in xrange(bin_count - 1)]
+    list_bins.append([float(bin_count - 1), float('inf')])
+    return {
+        'BenchHistogram': { 'bins': histogram_bins, 'sigma': 0.0 },
+        'BenchCountList': { 'bins': list_bins, 'sigma': 0.0 },
+        }
+
+def time_increments(counters, increment_count):
+    '''
+    Time increment_count random increments on counters.
+    Returns the best number of increments per second.
+    '''
+    secure_counters = SecureCounters(counters, counter_modulus(),
+                                     require_generate_noise=False)
+    increments = make_increments(counters, increment_count)
+    reps = timeit.repeat(lambda: run_increments(secure_counters, increments),
+                         number=1, repeat=DEFAULT_REPETITIONS)
+    return increment_count/min(reps)
+
+def make_client_counts(counters, client_count):
+    '''
+    Return a list of client_count random blinded counts for counters, in the
+    counters format.
+    To save RAM, each item in the list refers to one of a few random counts.
+    '''
+    modulus = counter_modulus()
+    sample_counts = []
+    for _ in xrange(min(client_count, DISTINCT_CLIENT_COUNTS)):
+        secure_counters = SecureCounters(counters, modulus,
+                                         require_generate_noise=False)
+        random_counts = [random.randrange(modulus)
+                         for _ in xrange(count_bins(counters))]
+        secure_counters._tally_counts(random_counts)
+        sample_counts.append(secure_counters.detach_counts())
+    return [sample_counts[i % len(sample_counts)]
+            for i in xrange(client_count)]
+
+def time_tally(counters, client_count):
+    '''
+    Time tallying the counts from client_count clients for counters.
+    Returns the best time in seconds.
+    '''
+    client_counts = make_client_counts(counters, client_count)
+    def run_tally():
+        tally_counters = SecureCounters(counters, counter_modulus(),
+                                        require_generate_noise=False)
+        assert tally_counters.tally_counters(client_counts)
+    reps = timeit.repeat(run_tally, number=1, repeat=TALLY_REPETITIONS)
+    return min(reps)
+
+def run_increments(secure_counters, increments):
+    '''
+    Increment secure_counters using each item in increments.
+    '''
+    for (name, bin) in increments:
+        secure_counters.increment(name, bin=bin, inc=1)
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    counters_path = DEFAULT_COUNTERS_PATH
+    increment_count = DEFAULT_INCREMENT_COUNT
+    if len(sys.argv) > 1:
+        counters_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        increment_count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        print ("Usage: {} [counters_path [increment_count]]"
+               .format(sys.argv[0]))
+        return -1
+
+    counters = load_counters(counters_path)
+    print ("loaded {} counters with {} bins from {}"
+           .format(len(counters), count_bins(counters), counters_path))
+    print ("{:.0f} increments per second (best of {} repetitions of {} increments)"
+           .format(time_increments(counters, increment_count),
+                   DEFAULT_REPETITIONS, increment_count))
+
+    for bin_count in SYNTHETIC_BIN_COUNTS:
+        counters = make_synthetic_counters(bin_count)
+        print ("{:.0f} increments per second on synthetic counters with {} bins"
+               .format(time_increments(counters, increment_count),
+                       bin_count))
+
+    counters = load_counters(counters_path)
+    for client_count in TALLY_CLIENT_COUNTS:
+        print ("{:.2f}s to tally {} bins from {} clients (best of {} repetitions)"
+               .format(time_tally(counters, client_count),
+                       count_bins(counters), client_count,
+                       TALLY_REPETITIONS))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+'''
+python bench_event_log.py [events_path [repetition_count]]
+
+Benchmark the data collector's Tor control event path, using the events in
+events_path (default: events.txt in this directory), and all the counters in
+counters.bins.yaml.
+Events that are rejected by the aggregator are skipped.
+Each event line is delivered to TorControlClientProtocol.lineReceived(),
+which queues it. Then the queued events are passed to
+Aggregator.handle_event() in batches.
+Report events per second at INFO and DEBUG log levels, and at DEBUG with a
+debug_event_log_interval of 100. Log messages are written to the null device.
+(Each result is the best of several repetitions.)
+
+Typical results:
+
+Before lazy and sampled debug event logging (and before unknown counter
+warnings stopped creating a set of valid counter names):
+$ test/bench_event_log.py test/events.txt 20
+loaded 195 accepted events from test/events.txt
+214 events per second at INFO (best of 5 repetitions of 20 replays)
+239 events per second at DEBUG (best of 5 repetitions of 20 replays)
+
+After:
+$ test/bench_event_log.py test/events.txt 20
+loaded 195 accepted events from test/events.txt
+5858 events per second at INFO (best of 5 repetitions of 20 replays)
+5349 events per second at DEBUG (best of 5 repetitions of 20 replays)
+5549 events per second at DEBUG logging 1 in 100 events (best of 5 repetitions of 20 replays)
+'''
+
+import logging
+import os
+import sys
+import timeit
+import yaml
+
+from twisted.test.proto_helpers import StringTransport
+
+from privcount.counter import counter_modulus, get_valid_events
+from privcount.data_collector import Aggregator
+from privcount.log import SampledDebugLog
+from privcount.protocol import TorControlClientProtocol
+
+DEFAULT_REPETITIONS = 5
+DEFAULT_REPLAY_COUNT = 20
+SAMPLED_LOG_INTERVAL = 100
+TEST_DIR = os.path.dirname(__file__)
+DEFAULT_EVENTS_PATH = os.path.join(TEST_DIR, 'events.txt')
+COUNTERS_PATH = os.path.join(TEST_DIR, 'counters.bins.yaml')
+
+def load_counters(counters_path):
+    '''
+    Load the counters in counters_path, and give them a zero sigma.
+    '''
+    with open(counters_path, 'r') as fin:
+        counters = yaml.load(fin)['counters']
+    for key in counters:
+        counters[key]['sigma'] = 0.0
+    return counters
+
+def load_event_lines(events_path):
+    '''
+    Load the events in events_path, and return them as control port lines.
+    '''
+    event_lines = []
+    with open(events_path, 'r') as fin:
+        for line in fin:
+            line = line.strip()
+            if len(line) > 0:
+                event_lines.append("650 {}".format(line))
+    return event_lines
+
+def filter_accepted_events(counters, event_lines):
+    '''
+    Return the lines in event_lines that are accepted by an aggregator for
+    counters. (The protocol quits when an event is rejected.)
+    '''
+    aggregator = Aggregator(counters, None, [], 1.0, counter_modulus(),
+                            None, 600, False, -1, 1.0,
+                            [], {}, [], {}, [], [], [], [])
+    return [line for line in event_lines
+            if aggregator.handle_event(line.split(" ")[1:])]
+
+def make_protocol(counters, debug_event_log_interval):
+    '''
+    Return a TorControlClientProtocol that is processing events for
+    counters, with an aggregator as its factory.
+    '''
+    aggregator = Aggregator(counters, None, [], 1.0, counter_modulus(),
+                            None, 600, False, -1, 1.0,
+                            [], {}, [], {}, [], [], [], [],
+                            debug_event_log_interval=debug_event_log_interval)
+    protocol = TorControlClientProtocol(aggregator)
+    protocol.makeConnection(StringTransport())
+    # skip authentication and discovery
+    protocol.state = 'processing'
+    protocol.active_events = get_valid_events()
+    protocol.event_debug_log = SampledDebugLog(debug_event_log_interval)
+    return protocol
+
+def time_events(counters, event_lines, replay_count, log_level,
+                debug_event_log_interval=1):
+    '''
+    Time replay_count replays of event_lines at log_level.
+    Returns the best number of events per second.
+    '''
+    logging.root.setLevel(log_level)
+    protocol = make_protocol(counters, debug_event_log_interval)
+    def run_events():
+        for _ in xrange(replay_count):
+            for line in event_lines:
+                protocol.lineReceived(line)
+            # the reactor isn't running, so process the queue ourselves
+            while len(protocol.event_queue) > 0:
+                protocol.processEventQueue()
+    reps = timeit.repeat(run_events, number=1, repeat=DEFAULT_REPETITIONS)
+    return len(event_lines)*replay_count/min(reps)
+
+def main():
+    events_path = DEFAULT_EVENTS_PATH
+    replay_count = DEFAULT_REPLAY_COUNT
+    if len(sys.argv) > 1:
+        events_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        replay_count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        print ("Usage: {} [events_path [repetition_count]]"
+               .format(sys.argv[0]))
+        return -1
+
+    # log to the null device, so we measure the cost of creating log
+    # messages, rather than the cost of displaying them
+    logging.basicConfig(stream=open(os.devnull, 'w'))
+    counters = load_counters(COUNTERS_PATH)
+    event_lines = filter_accepted_events(counters,
+                                         load_event_lines(events_path))
+    print ("loaded {} accepted events from {}"
+           .format(len(event_lines), events_path))
+    for (level_name, log_level) in [('INFO', logging.INFO),
+                                    ('DEBUG', logging.DEBUG)]:
+        print ("{:.0f} events per second at {} (best of {} repetitions of {} replays)"
+               .format(time_events(counters, event_lines, replay_count,
+                                   log_level),
+                       level_name, DEFAULT_REPETITIONS, replay_count))
+    print ("{:.0f} events per second at DEBUG logging 1 in {} events (best of {} repetitions of {} replays)"
+           .format(time_events(counters, event_lines, replay_count,
+                               logging.DEBUG,
+                               debug_event_log_interval=SAMPLED_LOG_INTERVAL),
+                   SAMPLED_LOG_INTERVAL, DEFAULT_REPETITIONS, replay_count))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -516,6 +516,26 @@ if [ "$PRIVCOUNT_UNIT_TESTS" -eq 1 ]; then
   python "$TEST_DIR/test_counter.py"
   "$I" ""
 
+  "$I" "Testing aggregator:"
+  python "$TEST_DIR/test_aggregator.py"
+  "$I" ""
+
+  "$I" "Testing match lists:"
+  python "$TEST_DIR/test_match.py"
+  "$I" ""
+
+  "$I" "Testing protocols:"
+  python "$TEST_DIR/test_protocol.py"
+  "$I" ""
+
+  "$I" "Testing match benchmarks:"
+  # Use tiny lists, we only want to know that the benchmarks run
+  privcount bench match --sizes 100 --lookups 100 --repeat 1 \
+      --output /dev/null
+  privcount bench round --bins 100 --output /dev/null
+  privcount bench share --bins 100 --output /dev/null
+  "$I" ""
+
   "$I" "Testing traffic model:"
   python "$TEST_DIR/test_traffic_model.py"
   "$I" ""
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+# test that the data collector's aggregator increments the expected counters
+
+# this test will exit successfully if each counter has the expected count
+
+import logging
+
+from privcount.counter import counter_modulus, get_valid_counters, get_counters_for_events, register_dynamic_counter, CIRCUIT_EVENT, CONNECTION_EVENT
+from privcount.data_collector import Aggregator, AggregatorWorkerPool
+
+# DEBUG logs every check: use it on failure
+# INFO logs each check once
+logging.basicConfig(level=logging.INFO)
+logging.root.name = ''
+
+def create_aggregator(counter_names):
+    '''
+    Return an Aggregator that collects counter_names, with no noise or
+    blinding.
+    '''
+    counters = {}
+    for counter_name in counter_names:
+        counters[counter_name] = { 'bins' : [[0.0, float('inf')]],
+                                   'sigma' : 0.0 }
+    return Aggregator(counters, None, [], 1.0, counter_modulus(),
+                      None, 600, False, -1, 1.0,
+                      [], {}, [], {}, [], [], [], [])
+
+def get_counts(aggregator):
+    '''
+    Return a dict of the single-bin counts in aggregator.
+    '''
+    aggregator.secure_counters.generate_noise(1.0)
+    counters = aggregator.secure_counters.detach_counts()
+    return dict((counter_name, counters[counter_name]['bins'][0][2])
+                for counter_name in counters)
+
+logging.info("Checking circuit close status counters:")
+# every variant of the circuit close status counters
+expected_counts = {
+    'OriginCircuitCount' : 3,
+    'OriginFailureCircuitCount' : 2,
+    'OriginSuccessCircuitCount' : 1,
+    'OriginActiveCircuitCount' : 2,
+    'OriginInactiveCircuitCount' : 1,
+    'OriginActiveFailureCircuitCount' : 1,
+    'OriginActiveSuccessCircuitCount' : 1,
+    'OriginInactiveFailureCircuitCount' : 1,
+    'OriginInactiveSuccessCircuitCount' : 0,
+    # Exit circuits are always active, so they only have status variants
+    'ExitCircuitCount' : 1,
+    'ExitFailureCircuitCount' : 0,
+    'ExitSuccessCircuitCount' : 1,
+    }
+aggregator = create_aggregator(expected_counts.keys())
+# (counter_prefix, is_active, is_failure)
+for (counter_prefix, is_active, is_failure) in [('Origin', True, True),
+                                                 ('Origin', True, False),
+                                                 ('Origin', False, True),
+                                                 ('Exit', True, False)]:
+    aggregator._increment_circuit_close_status_counters(counter_prefix,
+                                                        'Count',
+                                                        is_active,
+                                                        is_failure)
+counts = get_counts(aggregator)
+for counter_name in sorted(expected_counts):
+    logging.debug("{}: expected {} got {}"
+                  .format(counter_name, expected_counts[counter_name],
+                          counts[counter_name]))
+    assert counts[counter_name] == expected_counts[counter_name]
+logging.info("Success!")
+
+logging.info("Checking every circuit and connection counter has a handler branch:")
+class WarningCounter(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, level=logging.WARNING)
+        self.count = 0
+    def emit(self, record):
+        self.count += 1
+warning_counter = WarningCounter()
+logging.root.addHandler(warning_counter)
+aggregator = create_aggregator(get_counters_for_events(get_valid_counters(),
+                                                       { CIRCUIT_EVENT,
+                                                         CONNECTION_EVENT }))
+logging.root.removeHandler(warning_counter)
+# unplanned counters are logged as warnings
+assert warning_counter.count == 0
+assert (aggregator.needs_circuit_close_suffixes ==
+        set(Aggregator.CIRCUIT_CLOSE_SUFFIXES))
+assert aggregator.needs_client_ip_info
+assert aggregator.needs_exit_circuit_stream_info
+assert aggregator.needs_connection_close
+assert aggregator.needs_connection_close_country_match
+assert aggregator.needs_connection_close_as_match
+logging.info("Success!")
+
+logging.info("Checking each connection match list is only used by its counters:")
+aggregator = create_aggregator(['EntryConnectionCountryMatchLifeTime',
+                                'NonEntryRelayOnAddressConnectionASMatchCountList'])
+assert not aggregator.needs_connection_close
+assert aggregator.needs_connection_close_country_match
+assert aggregator.needs_connection_close_as_match
+aggregator = create_aggregator(['EntryConnectionCount'])
+assert aggregator.needs_connection_close
+assert not aggregator.needs_connection_close_country_match
+assert not aggregator.needs_connection_close_as_match
+logging.info("Success!")
+
+logging.info("Checking counters with no handler branch run every branch:")
+register_dynamic_counter('EntryConnectionUnplannedCount', { CONNECTION_EVENT })
+warning_counter.count = 0
+logging.root.addHandler(warning_counter)
+aggregator = create_aggregator(['EntryConnectionUnplannedCount'])
+logging.root.removeHandler(warning_counter)
+assert warning_counter.count == 1
+assert aggregator.needs_connection_close
+assert aggregator.needs_connection_close_country_match
+assert aggregator.needs_connection_close_as_match
+logging.info("Success!")
+
+logging.info("Checking aggregator worker processes are reused for each round:")
+worker_pool = AggregatorWorkerPool(2)
+counter_names = ['EntryConnectionCount']
+aggregator = create_aggregator(counter_names)
+shard_args = (aggregator.collection_counters, None, [], 1.0,
+              counter_modulus(), None, 600, False, -1, 1.0,
+              [], {}, [], {}, [], [], [], [])
+event = ['PRIVCOUNT_CONNECTION_CLOSE', 'RemoteIsClientFlag=1',
+         'EventTimestamp=1000.0', 'CreatedTimestamp=900.0',
+         'ChannelId=1', 'RemoteIPAddress=192.0.2.1',
+         'PeerIPAddressConsensusRelayCount=0',
+         'RemoteIPAddressConnectionCount=1']
+for round_event_count in [1, 0, 3]:
+    aggregator = create_aggregator(counter_names)
+    round_id = worker_pool.start_round(shard_args, {})
+    for event_queue in worker_pool.get_event_queues():
+        event_queue.put([event]*round_event_count)
+        event_queue.put(None)
+    shard_results = worker_pool.get_round_counts(round_id, 30.0)
+    assert shard_results is not None
+    assert len(shard_results) == worker_pool.get_worker_count()
+    for (shard_counts, rejected_count) in shard_results:
+        assert rejected_count == 0
+        aggregator.secure_counters.add_counts(shard_counts)
+    counts = get_counts(aggregator)
+    assert (counts['EntryConnectionCount'] ==
+            round_event_count*worker_pool.get_worker_count())
+worker_pool.terminate()
+assert not worker_pool.is_running()
+logging.info("Success!")
@@ -3,12 +3,14 @@
 
 # this test will fail if any counter inconsistencies are detected
 
+import json
 import sys
 
+from copy import deepcopy
 from math import sqrt
 from random import SystemRandom
 
-from privcount.counter import SecureCounters, adjust_count_signed, counter_modulus, add_counter_limits_to_config, get_events_for_known_counters
+from privcount.counter import SecureCounters, adjust_count_signed, adjust_counts_signed, counter_modulus, add_counter_limits_to_config, get_events_for_known_counters, pack_counts, unpack_counts, sample_list
 SINGLE_BIN = SecureCounters.SINGLE_BIN
 
 import logging
@@ -66,6 +68,11 @@ def check_adjust_count_signed(modulus):
     assert adjust_count_signed((modulus + 1L)//2L - 1L, modulus) == (modulus + 1L)//2L - 1L
     assert adjust_count_signed((modulus + 1L)//2L, modulus) == (modulus + 1L)//2L - modulus
     assert adjust_count_signed(modulus - 1L, modulus) == -1L
+    # the list version must give the same results
+    count_list = [0L, 1L, (modulus + 1L)//2L - 1L, (modulus + 1L)//2L,
+                  modulus - 1L]
+    assert (adjust_counts_signed(count_list, modulus) ==
+            [adjust_count_signed(count, modulus) for count in count_list])
 
 def try_adjust_count_signed(modulus):
     '''
@@ -104,15 +111,16 @@ def check_blinding_values(secure_counters, modulus):
     else:
        logging.debug("skip blinding collision check: collisions too likely")
 
-def create_counters(counters, modulus):
+def create_counters(counters, modulus, use_seeds=False):
     '''
     create the counters for a data collector, who will generate the shares and
     noise
     uses modulus to generate the appropriate blinding factors
+    if use_seeds is True, the shares are seeds that expand to blinding factors
     returns a tuple containing a list of DCs and a list of SKs
     '''
     sc_dc = SecureCounters(counters, modulus, require_generate_noise=False)
-    sc_dc.generate_blinding_shares(['sk1', 'sk2'])
+    sc_dc.generate_blinding_shares(['sk1', 'sk2'], use_seeds=use_seeds)
     sc_dc.generate_noise(1.0)
     check_blinding_values(sc_dc, modulus)
     # get the shares used to init the secure counters on the share keepers
@@ -120,10 +128,10 @@ def create_counters(counters, modulus):
 
     # create share keeper versions of the counters
     sc_sk1 = SecureCounters(counters, modulus, require_generate_noise=False)
-    sc_sk1.import_blinding_share(shares['sk1'])
+    assert sc_sk1.import_blinding_share(shares['sk1'])
     check_blinding_values(sc_sk1, modulus)
     sc_sk2 = SecureCounters(counters, modulus, require_generate_noise=False)
-    sc_sk2.import_blinding_share(shares['sk2'])
+    assert sc_sk2.import_blinding_share(shares['sk2'])
     check_blinding_values(sc_sk2, modulus)
     return ([sc_dc], [sc_sk1, sc_sk2])
 
@@ -309,18 +317,21 @@ def check_counters(tallies, N, multi_bin=True):
     assert tallies['ZeroCount']['bins'][0][2] == 0
     logging.debug("all counts are correct!")
 
-def run_counters(counters, modulus, N, X=None, multi_bin=True):
+def run_counters(counters, modulus, N, X=None, multi_bin=True,
+                 use_seeds=False):
     '''
     Validate that a counter run with counters, modulus, N, X, and multi_bin works,
     and produces consistent results
     If X is None, use the 2-argument form of increment, otherwise, use the
     3-argument form
+    If use_seeds is True, use seed blinding shares
     '''
-    logging.debug("modulus: {} N: {} X: {} multi_bin: {}".format(
+    logging.debug("modulus: {} N: {} X: {} multi_bin: {} use_seeds: {}".format(
                       modulus, N,
                       X if X is not None else "None",
-                      multi_bin))
-    (dc_list, sk_list) = create_counters(counters, modulus)
+                      multi_bin, use_seeds))
+    (dc_list, sk_list) = create_counters(counters, modulus,
+                                         use_seeds=use_seeds)
     if X is None:
         # use the 2-argument form
         amount = increment_counters(dc_list, N, multi_bin)
@@ -332,7 +343,8 @@ def run_counters(counters, modulus, N, X=None, multi_bin=True):
     tallies = sum_counters(counters, modulus, dc_list, sk_list)
     check_counters(tallies, amount, multi_bin)
 
-def try_counters(counters, modulus, N, X=None, multi_bin=True):
+def try_counters(counters, modulus, N, X=None, multi_bin=True,
+                 use_seeds=False):
     '''
     Validate that a counter run with counters, modulus, N, X, and multi_bin works,
     and produces consistent results
@@ -348,8 +360,9 @@ def try_counters(counters, modulus, N, X=None, multi_bin=True):
     X_random = None
     if X is not None:
         X_random = SystemRandom().randrange(0, min(modulus_random, X))
-    run_counters(counters, modulus_random, N_random, X_random, multi_bin)
-    run_counters(counters, modulus, N, X, multi_bin)
+    run_counters(counters, modulus_random, N_random, X_random, multi_bin,
+                 use_seeds)
+    run_counters(counters, modulus, N, X, multi_bin, use_seeds)
 
 # Check the counter table is valid, and perform internal checks
 assert len(get_events_for_known_counters()) > 0
@@ -392,6 +405,67 @@ logging.info("Multiple increments, 2-argument form of increment:")
 N = 500L
 try_counters(counters, counter_modulus(), N)
 
+# Check that seed blinding shares unblind the counters, including with
+# a random modulus that needs rejection sampling
+logging.info("Multiple increments, seed blinding shares:")
+try_counters(counters, counter_modulus(), N, use_seeds=True)
+# seeds don't unblind counters with different bins
+sc_dc = SecureCounters(counters, counter_modulus(),
+                       require_generate_noise=False)
+sc_dc.generate_blinding_shares(['sk1'], use_seeds=True)
+seed_share = sc_dc.detach_blinding_shares()['sk1']
+assert len(json.dumps(seed_share)) < 200
+other_counters = deepcopy(counters)
+other_counters['ByteHistogram']['bins'].pop()
+sc_sk = SecureCounters(other_counters, counter_modulus(),
+                       require_generate_noise=False)
+assert not sc_sk.import_blinding_share(seed_share)
+
+# Check that compact blinding shares round-trip, including with a random
+# modulus that doesn't fill the last byte
+logging.info("Compact blinding shares:")
+for modulus in [counter_modulus(),
+                SystemRandom().randrange(modulus_min, counter_modulus())]:
+    values = sample_list(modulus, 100)
+    assert unpack_counts(pack_counts(values, modulus), modulus) == values
+assert unpack_counts('\0', counter_modulus()) is None
+sc_dc = SecureCounters(counters, counter_modulus(),
+                       require_generate_noise=False)
+sc_dc.generate_blinding_shares(['sk1'], compact=True)
+compact_share = sc_dc.detach_blinding_shares()['sk1']
+# compact shares don't unblind counters with different bins
+sc_sk = SecureCounters(other_counters, counter_modulus(),
+                       require_generate_noise=False)
+assert not sc_sk.import_blinding_share(compact_share)
+
+# Check that importing the sum of the shares unblinds the counters, like
+# importing each share
+logging.info("Multiple increments, share keeper imports summed shares:")
+dc_list = []
+shares_list = []
+for (use_seeds, compact) in [(False, False), (True, False), (False, True)]:
+    sc_dc = SecureCounters(counters, counter_modulus(),
+                           require_generate_noise=False)
+    sc_dc.generate_blinding_shares(['sk1', 'sk2'], use_seeds=use_seeds,
+                                   compact=compact)
+    dc_list.append(sc_dc)
+    shares_list.append(sc_dc.detach_blinding_shares())
+# sk1 sums the shares from both DCs, sk2 imports them one at a time
+sc_sk1 = SecureCounters(counters, counter_modulus(),
+                        require_generate_noise=False)
+sc_sk1.import_blinding_share_counts([])
+sc_sk1.import_blinding_share_counts([
+        sc_sk1.blinding_share_counts(shares['sk1']['secret'])
+        for shares in shares_list])
+sc_sk2 = SecureCounters(counters, counter_modulus(),
+                        require_generate_noise=False)
+for shares in shares_list:
+    assert sc_sk2.import_blinding_share(shares['sk2'])
+amount = increment_counters(dc_list, N)
+tallies = sum_counters(counters, counter_modulus(), dc_list,
+                       [sc_sk1, sc_sk2])
+check_counters(tallies, amount)
+
 # Check that secure counters increment correctly for a single increment
 # using a small value of num_increment
 logging.info("Single increment, 3-argument form of increment:")
@@ -61,6 +61,9 @@ for code in "$TEST_DIR"/../privcount/{counter,data_collector}.py; do
                   -e '^state$' -e '^version$' -e '^Example' -e '^BadExit$' \
                   -e '^Exit$' -e '^Guard$' -e '^sigma$' -e '^sharekeepers$' \
                   -e '^traffic$' -e "^Web$" -e '^lists$' \
+                  -e '^events$' -e '^process$' \
+                  -e '^Interactive$' \
+                  -e '^domain$' -e '^map$' \
         > "$OUT_PATH.names.unsorted"
     # Add the traffic model bins to the data_collector file only
     if [ `basename "$code"` = 'data_collector.py' ]; then
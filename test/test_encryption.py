@@ -14,7 +14,7 @@ from os import urandom, environ, path, getcwd
 from random import SystemRandom
 
 from privcount.counter import counter_modulus
-from privcount.crypto import load_public_key_file, load_private_key_file, encrypt_pk, decrypt_pk, generate_symmetric_key, encrypt_symmetric, decrypt_symmetric, encode_data, decode_data, encrypt, decrypt
+from privcount.crypto import load_public_key_file, load_private_key_file, encrypt_pk, decrypt_pk, generate_symmetric_key, encrypt_symmetric, decrypt_symmetric, encode_data, decode_data, encrypt, decrypt, encrypt_stream, decrypt_stream, choose_envelope, json_serialise, json_serialise_pieces, ENVELOPE_FERNET, ENVELOPE_STREAM, STREAM_KEY_BYTES, STREAM_CHUNK_BYTES
 
 import logging
 # DEBUG logs every check: use it on failure
@@ -93,6 +93,38 @@ def check_symmetric_encdec(secret_key, plaintext):
     check_equality(plaintext, resulttext)
     logging.debug("Decrypted data was identical to the original data!")
 
+def check_stream_encdec(secret_key, plaintext, chunk_bytes):
+    """
+    Check that plaintext survives stream encryption and descryption intact,
+    and that modified, reordered, and truncated chunks fail to decrypt
+    """
+    logging.debug("Plaintext is {} bytes".format(len(plaintext)))
+    logging.debug("Encrypting with a stream secret key:")
+    ciphertext = encrypt_stream(secret_key, plaintext, chunk_bytes)
+    logging.debug("Ciphertext is {} chunks".format(len(ciphertext)))
+    logging.debug("Decrypting ciphertext with a stream secret key:")
+    resulttext = decrypt_stream(secret_key, ciphertext)
+    check_equality(plaintext, resulttext)
+    logging.debug("Decrypted data was identical to the original data!")
+    bad_ciphertexts = []
+    # modify the first byte
+    first_chunk = b64decode(ciphertext[0])
+    first_chunk = chr(ord(first_chunk[0]) ^ 1) + first_chunk[1:]
+    bad_ciphertexts.append([b64encode(first_chunk)] + ciphertext[1:])
+    if len(ciphertext) > 1:
+        bad_ciphertexts.append(ciphertext[:-1])
+        bad_ciphertexts.append(list(reversed(ciphertext)))
+    bad_ciphertexts.append([])
+    for bad_ciphertext in bad_ciphertexts:
+        try:
+            decrypt_stream(secret_key, bad_ciphertext)
+            assert False
+        except AssertionError:
+            raise
+        except Exception:
+            pass
+    logging.debug("Modified ciphertexts failed to decrypt!")
+
 def check_data_encdec(data_structure):
     """
     Check that data_structure survives encoding and decoding intact
@@ -110,12 +142,13 @@ def check_encdec(pub_key, priv_key, data_structure):
     """
     Check that data_structure survives encryption and descryption intact
     """
-    logging.debug("Encrypting data structure:")
-    ciphertext = encrypt(pub_key, data_structure)
-    logging.debug("Decrypting data structure:")
-    result_structure = decrypt(priv_key, ciphertext)
-    check_equality(data_structure, result_structure)
-    logging.debug("Decrypted data was identical to the original data!")
+    for envelope in [ENVELOPE_FERNET, ENVELOPE_STREAM]:
+        logging.debug("Encrypting data structure using {}:".format(envelope))
+        ciphertext = encrypt(pub_key, data_structure, envelope)
+        logging.debug("Decrypting data structure:")
+        result_structure = decrypt(priv_key, ciphertext)
+        check_equality(data_structure, result_structure)
+        logging.debug("Decrypted data was identical to the original data!")
 
 def check(pub_key, priv_key, data_structure):
     """
@@ -123,6 +156,8 @@ def check(pub_key, priv_key, data_structure):
     and decryption, and retains the same type and value.
     """
     check_data_encdec(data_structure)
+    assert (''.join(json_serialise_pieces(data_structure)) ==
+            json_serialise(data_structure))
     check_encdec(pub_key, priv_key, data_structure)
 
 logging.info("Loading public key {}:".format(PUBLIC_KEY_PATH))
@@ -157,6 +192,35 @@ check_symmetric_encdec(secret_key, plaintext[:(10*1024)])
 check_symmetric_encdec(secret_key, plaintext[:(100*1024)])
 check_symmetric_encdec(secret_key, plaintext)
 
+logging.info("Generating secret key for stream encryption:")
+secret_key = urandom(STREAM_KEY_BYTES)
+
+check_stream_encdec(secret_key, "", STREAM_CHUNK_BYTES)
+check_stream_encdec(secret_key, plaintext[:100], STREAM_CHUNK_BYTES)
+check_stream_encdec(secret_key, plaintext[:100], 10)
+check_stream_encdec(secret_key, plaintext[:100], 30)
+check_stream_encdec(secret_key, plaintext[:(100*1024)], STREAM_CHUNK_BYTES)
+check_stream_encdec(secret_key, plaintext, STREAM_CHUNK_BYTES)
+# plaintext can also be split into pieces, which don't match the chunks
+pieces = [plaintext[:10], plaintext[10:10], plaintext[10:200],
+          plaintext[200:1000]]
+assert (decrypt_stream(secret_key, encrypt_stream(secret_key, pieces, 64)) ==
+        ''.join(pieces))
+
+logging.info("Checking envelope negotiation:")
+# old peers don't advertise any envelopes
+assert choose_envelope([]) == ENVELOPE_FERNET
+assert choose_envelope(['PCUNKNOWN']) == ENVELOPE_FERNET
+assert choose_envelope([ENVELOPE_STREAM]) == ENVELOPE_STREAM
+# old peers only understand envelopes without an envelope key
+assert 'envelope' not in encrypt(pub_key, [], ENVELOPE_FERNET)
+# the stream envelope doesn't base64-encode the data twice
+fernet_length = len(encode_data(encrypt(pub_key, plaintext,
+                                        ENVELOPE_FERNET)))
+stream_length = len(encode_data(encrypt(pub_key, plaintext,
+                                        ENVELOPE_STREAM)))
+assert stream_length < fernet_length*0.8
+
 logging.info("Checking data structure encoding and encryption:")
 rand_int_int = int(SystemRandom().getrandbits(RAND_INT_BITS))
 rand_int_long = SystemRandom().getrandbits(RAND_INT_BITS)
@@ -192,6 +256,11 @@ logging.info("Checking nested containers:")
 nested_container = [rand_dict, rand_list]
 
 check(pub_key, priv_key, nested_container)
+check(pub_key, priv_key, [])
+check(pub_key, priv_key, {})
+# json converts integer keys to strings
+assert (''.join(json_serialise_pieces({ 1 : [] })) ==
+        json_serialise({ 1 : [] }))
 
 logging.info("Checking containers with multiple references to sub-containers:")
 multi_ref_scalar = [rand_int_int, rand_int_int]
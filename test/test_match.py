@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+# check that privcount's domain suffix trie and compiled match lists give
+# the same results as the nested suffix dict and exact match sets, using the
+# domain lists in this directory
+
+# this test will exit successfully, unless a trie or compiled list result
+# differs from the original, or a trie or compiled list does not survive
+# encoding and loading
+
+import ipaddress
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+
+from privcount.match import load_match_list, suffix_match, suffix_match_prepare_collection, suffix_trie_prepare_collections, suffix_trie_encode, suffix_trie_load, exact_match, exact_match_prepare_collection, exact_match_compile, exact_match_load, suffix_match_compile, suffix_match_load, MatchFileCache, read_match_file_chunks, ExactMatchIndex, load_as_prefix_map, ipasn_prefix_match_prepare_string, ipasn_prefix_match_prepare_pyasn, ipasn_prefix_match, choose_match_list_format, MATCH_LIST_FORMAT_RAW, MATCH_LIST_FORMAT_TABLE
+
+TEST_DIR = os.path.dirname(__file__)
+
+# the lists in config.yaml, in the same order, and an overlapping list
+# (we don't use the tld lists, because they replace most other suffixes)
+DOMAIN_LISTS = [
+    'domain-top-1k.txt',
+    'domain-torproject.txt',
+    'domain-local.txt',
+    'domain-example.txt',
+    'domain-arpa.txt',
+    'domain-onion.txt',
+    'domain-i2p.txt',
+    'domain-google.txt',
+]
+
+# onion address lists with plain addresses and MD5 hashes
+ONION_LISTS = [
+    'onion-torproject.txt',
+    'onion-md5-mixed-unique.txt',
+    'onion-md5-example.txt',
+]
+
+# the onion addresses hashed in the MD5 lists
+ONION_MD5_ADDRESSES = [
+    'aaaaaaaaaaaaaaaa',
+    'abcdefghijklmnop',
+]
+
+# IP to AS maps, and the number of bits in their addresses
+IPASN_MAPS = [
+    ('as-ipv4-test.ipasn', 32),
+    ('as-ipv6-test.ipasn', 128),
+]
+
+# the number of random lookups that probably don't match
+N_TRIALS = 10000
+
+def load_domain_lists():
+    '''
+    Load DOMAIN_LISTS, and return a list of domain lists
+    '''
+    domain_lists = []
+    for file_name in DOMAIN_LISTS:
+        (_, domain_list) = load_match_list(os.path.join(TEST_DIR, file_name),
+                                           check_domain=True)
+        domain_lists.append(domain_list)
+    return domain_lists
+
+def prepare_suffix_dict(domain_lists, separator="."):
+    '''
+    Prepare a nested suffix dict the way the tally server used to:
+    one list at a time, with earlier lists taking precedence
+    '''
+    suffix_obj = None
+    for i in range(len(domain_lists)):
+        (suffix_obj, _) = suffix_match_prepare_collection(
+                                                domain_lists[i],
+                                                separator=separator,
+                                                existing_suffixes=suffix_obj,
+                                                collection_tag=i)
+    return suffix_obj
+
+def get_search_strings(domain_lists):
+    '''
+    Return the domains in domain_lists, their subdomains and parents,
+    and some random strings that probably don't match
+    '''
+    search_strings = set()
+    for domain_list in domain_lists:
+        for domain in domain_list:
+            search_strings.add(domain)
+            search_strings.add("www." + domain)
+            search_strings.add("x" + domain)
+            search_strings.add(domain.partition(".")[2])
+            search_strings.add(domain.upper())
+    all_domains = sorted(search_strings)
+    for _ in xrange(N_TRIALS):
+        char_list = list(random.choice(all_domains))
+        random.shuffle(char_list)
+        search_strings.add("".join(char_list))
+    return sorted(search_strings)
+
+def check_exact(exact_objs, compiled_objs, search_strings):
+    '''
+    Check that compiled_objs match search_strings the same way as
+    exact_objs
+    '''
+    mismatch_count = 0
+    for search_string in search_strings:
+        for i in xrange(len(exact_objs)):
+            exact_result = exact_match(exact_objs[i], search_string)
+            compiled_result = exact_match(compiled_objs[i], search_string)
+            if exact_result != compiled_result:
+                print "Mismatch: '{}' list {} set: {} compiled: {}".format(
+                    search_string, i, exact_result, compiled_result)
+                mismatch_count += 1
+    assert mismatch_count == 0
+
+def check_index(exact_objs, exact_index, search_strings,
+                match_onion_md5=False):
+    '''
+    Check that exact_index finds the first list in exact_objs that matches
+    each of search_strings
+    '''
+    mismatch_count = 0
+    for search_string in search_strings:
+        exact_result = None
+        for i in xrange(len(exact_objs)):
+            if exact_match(exact_objs[i], search_string,
+                           match_onion_md5=match_onion_md5):
+                exact_result = i
+                break
+        index_result = exact_index.find(search_string,
+                                        match_onion_md5=match_onion_md5)
+        if exact_result != index_result:
+            print "Mismatch: '{}' lists: {} index: {}".format(
+                search_string, exact_result, index_result)
+            mismatch_count += 1
+    assert mismatch_count == 0
+
+def check_trie(suffix_dict, suffix_trie, search_strings, separator="."):
+    '''
+    Check that suffix_trie matches search_strings the same way as
+    suffix_dict
+    '''
+    mismatch_count = 0
+    for search_string in search_strings:
+        dict_result = suffix_match(suffix_dict, search_string,
+                                   separator=separator)
+        trie_result = suffix_match(suffix_trie, search_string,
+                                   separator=separator)
+        if dict_result != trie_result:
+            print "Mismatch: '{}' dict: {} trie: {}".format(search_string,
+                                                           dict_result,
+                                                           trie_result)
+            mismatch_count += 1
+    assert mismatch_count == 0
+
+domain_lists = load_domain_lists()
+search_strings = get_search_strings(domain_lists)
+
+suffix_dict = prepare_suffix_dict(domain_lists)
+(suffix_trie, _) = suffix_trie_prepare_collections(domain_lists,
+                                                   separator=".")
+print "Checking {} domains in {} lists ({}):".format(
+    sum([len(domain_list) for domain_list in domain_lists]),
+    len(domain_lists), suffix_trie)
+check_trie(suffix_dict, suffix_trie, search_strings)
+print "{} lookups match the suffix dict".format(len(search_strings))
+print ""
+
+print "Checking encoded trie:"
+loaded_trie = suffix_trie_load(suffix_trie_encode(suffix_trie),
+                               separator=".")
+assert loaded_trie == suffix_trie
+check_trie(suffix_dict, loaded_trie, search_strings)
+print "{} lookups match the suffix dict".format(len(search_strings))
+print ""
+
+print "Checking trie from suffix dict:"
+dict_trie = suffix_trie_load(suffix_dict, separator=".")
+check_trie(suffix_dict, dict_trie, search_strings)
+print "{} lookups match the suffix dict".format(len(search_strings))
+print ""
+
+print "Checking suffix dict from trie:"
+trie_dict = suffix_trie.to_suffix_obj()
+check_trie(trie_dict, suffix_trie, search_strings)
+# the tags can be in a different order, but each suffix has the same tag
+dict_trie = suffix_trie_load(trie_dict, separator=".")
+assert dict_trie.edge_labels == suffix_trie.edge_labels
+assert ([dict_trie.tags[-target - 1] if target < 0 else target
+         for target in dict_trie.edge_targets] ==
+        [suffix_trie.tags[-target - 1] if target < 0 else target
+         for target in suffix_trie.edge_targets])
+print "{} lookups match the trie".format(len(search_strings))
+print ""
+
+print "Checking parallel list loading:"
+pool = multiprocessing.Pool(2)
+for file_name in DOMAIN_LISTS:
+    file_path = os.path.join(TEST_DIR, file_name)
+    (_, serial_list) = load_match_list(file_path, check_domain=True)
+    (_, parallel_list) = load_match_list(file_path, check_domain=True,
+                                         pool=pool)
+    assert parallel_list == serial_list
+    chunk_list = []
+    for chunk in read_match_file_chunks(file_path, chunk_size=7):
+        assert len(chunk) <= 7
+        chunk_list.extend(chunk)
+    assert len(chunk_list) == len(serial_list)
+pool.close()
+pool.join()
+print "Parallel lists match the serial lists"
+print ""
+
+print "Checking IP to AS maps:"
+for (file_name, ip_bits) in IPASN_MAPS:
+    (_, map_list) = load_as_prefix_map(os.path.join(TEST_DIR, file_name))
+    map_string = "\n".join(map_list)
+    prefix_map = ipasn_prefix_match_prepare_string(map_string, cache_size=10)
+    pyasn_map = ipasn_prefix_match_prepare_pyasn(map_string)
+    # the first, last, and adjacent addresses of each prefix
+    search_ips = []
+    for line in map_list:
+        network = ipaddress.ip_network(unicode(line.split()[0]))
+        search_ips.extend([network.network_address,
+                           network.broadcast_address,
+                           network.network_address - 1,
+                           network.broadcast_address + 1])
+    for _ in xrange(N_TRIALS):
+        search_ips.append(ipaddress.ip_address(random.getrandbits(ip_bits)))
+    # search each address twice, so some results are cached
+    for search_ip in search_ips + list(reversed(search_ips)):
+        pyasn_result = ipasn_prefix_match(pyasn_map, search_ip)
+        assert ipasn_prefix_match(prefix_map, search_ip) == pyasn_result
+        assert ipasn_prefix_match(prefix_map, str(search_ip)) == pyasn_result
+    # cleared caches don't keep any addresses, and give the same results
+    prefix_map.clear_cache()
+    assert len(prefix_map.cache_current) == 0
+    assert len(prefix_map.cache_previous) == 0
+    for search_ip in search_ips[:10]:
+        assert (ipasn_prefix_match(prefix_map, search_ip) ==
+                ipasn_prefix_match(pyasn_map, search_ip))
+    print "{} lookups in {} match pyasn".format(2*len(search_ips), file_name)
+print ""
+
+print "Checking character suffixes:"
+char_lists = [["abc", "bc", "xyz"], ["c", "zz"]]
+char_dict = prepare_suffix_dict(char_lists, separator="")
+(char_trie, _) = suffix_trie_prepare_collections(char_lists, separator="")
+char_search_strings = ["", "c", "bc", "abc", "zabc", "z", "zz", "yzz", "xyz",
+                       "y"]
+check_trie(char_dict, char_trie, char_search_strings, separator="")
+check_trie(char_dict, suffix_match_load(suffix_match_compile(char_trie)),
+           char_search_strings, separator="")
+print "Character suffixes match the suffix dict"
+print ""
+
+# compiled lists are sent to data collectors in JSON messages
+cache_dir = tempfile.mkdtemp()
+try:
+    print "Checking compiled suffixes:"
+    compiled_suffixes = json.loads(json.dumps(suffix_match_compile(suffix_trie)))
+    for load_cache_dir in [None, cache_dir, cache_dir]:
+        check_trie(suffix_dict,
+                   suffix_match_load(compiled_suffixes, separator=".",
+                                     cache_dir=load_cache_dir),
+                   search_strings)
+    print "{} lookups match the suffix dict".format(len(search_strings))
+    print ""
+
+    print "Checking compiled exact lists:"
+    exact_objs = []
+    for domain_list in domain_lists:
+        exact_match_prepare_collection(domain_list, existing_exacts=exact_objs)
+    # AS lists contain integers
+    exact_objs.append(exact_match_prepare_collection([1, 23, 456789]))
+    exact_objs.append(exact_match_prepare_collection([]))
+    compiled_exacts = json.loads(json.dumps([exact_match_compile(exact_obj)
+                                             for exact_obj in exact_objs]))
+    int_search_strings = search_strings + [0, 1, 23, 456789, 456789L, -1,
+                                           None]
+    for load_cache_dir in [None, cache_dir, cache_dir]:
+        loaded_exacts = []
+        for compiled_exact in compiled_exacts:
+            exact_obj = exact_match_load(compiled_exact,
+                                         existing_exacts=loaded_exacts,
+                                         cache_dir=load_cache_dir)
+            # without a cache, tables are loaded into faster sets
+            assert isinstance(exact_obj, frozenset) == (load_cache_dir is None)
+        check_exact(exact_objs, loaded_exacts, int_search_strings)
+        assert ([frozenset(loaded_exact) for loaded_exact in loaded_exacts] ==
+                exact_objs)
+    print "{} lookups match the exact sets".format(len(int_search_strings))
+    print ""
+
+    print "Checking match list formats:"
+    # older data collectors don't advertise any formats, and get raw lists
+    assert choose_match_list_format([]) == MATCH_LIST_FORMAT_RAW
+    assert choose_match_list_format(['PCUNKNOWN1']) == MATCH_LIST_FORMAT_RAW
+    assert (choose_match_list_format(['PCUNKNOWN1', MATCH_LIST_FORMAT_TABLE])
+            == MATCH_LIST_FORMAT_TABLE)
+    # raw lists still load, and give the same results
+    raw_exacts = json.loads(json.dumps([list(exact_obj)
+                                        for exact_obj in exact_objs]))
+    loaded_exacts = []
+    for raw_exact in raw_exacts:
+        exact_match_load(raw_exact, existing_exacts=loaded_exacts)
+    check_exact(exact_objs, loaded_exacts, int_search_strings)
+    raw_suffixes = json.loads(json.dumps(suffix_trie.to_suffix_obj()))
+    check_trie(suffix_dict, suffix_match_load(raw_suffixes, separator="."),
+               search_strings)
+    print "Raw match lists match the compiled lists"
+    print ""
+
+    print "Checking exact match indexes:"
+    # (bloom_filter, item_map)
+    index_types = [(False, True), (True, False), (False, False)]
+    for (bloom_filter, item_map) in index_types:
+        for index_objs in [exact_objs, loaded_exacts]:
+            check_index(index_objs,
+                        ExactMatchIndex(index_objs, bloom_filter=bloom_filter,
+                                        item_map=item_map),
+                        int_search_strings)
+    print "{} lookups match the exact sets".format(len(int_search_strings))
+    print ""
+
+    print "Checking onion MD5 indexes:"
+    onion_objs = []
+    onion_search_strings = list(ONION_MD5_ADDRESSES)
+    for file_name in ONION_LISTS:
+        (_, onion_list) = load_match_list(os.path.join(TEST_DIR, file_name),
+                                          check_onion=True)
+        exact_match_prepare_collection(onion_list, existing_exacts=onion_objs,
+                                       match_onion_md5=True)
+        onion_search_strings.extend(onion_list)
+    onion_search_strings.extend([onion.upper()
+                                 for onion in onion_search_strings])
+    onion_search_strings.extend(['bbbbbbbbbbbbbbbb', 'zzzzzzzzzzzzzzzz'])
+    for (bloom_filter, item_map) in index_types:
+        onion_index = ExactMatchIndex(onion_objs, bloom_filter=bloom_filter,
+                                      match_onion_md5=True, item_map=item_map)
+        assert onion_index.has_onion_md5
+        check_index(onion_objs, onion_index, onion_search_strings,
+                    match_onion_md5=True)
+    print "{} lookups match the onion sets".format(len(onion_search_strings))
+    print ""
+
+    print "Checking match file cache:"
+    match_file_cache = MatchFileCache()
+    cache_file = os.path.join(cache_dir, 'domain-cache.txt')
+    shutil.copyfile(os.path.join(TEST_DIR, DOMAIN_LISTS[0]), cache_file)
+    (_, first_list) = match_file_cache.load(load_match_list, cache_file,
+                                            check_domain=True)
+    assert first_list == domain_lists[0]
+    # unchanged files return the cached list
+    (_, cached_list) = match_file_cache.load(load_match_list, cache_file,
+                                             check_domain=True)
+    assert cached_list is first_list
+    # touched files with the same contents return the cached list
+    os.utime(cache_file, (0, 0))
+    (_, cached_list) = match_file_cache.load(load_match_list, cache_file,
+                                             check_domain=True)
+    assert cached_list is first_list
+    # different arguments are cached separately
+    (_, unchecked_list) = match_file_cache.load(load_match_list, cache_file)
+    assert unchecked_list is not first_list
+    assert match_file_cache.get_status()['match_file_cache_misses'] == 2
+    # changed files are loaded again
+    with open(cache_file, 'a') as fout:
+        fout.write('cache.example.com\n')
+    (_, changed_list) = match_file_cache.load(load_match_list, cache_file,
+                                              check_domain=True)
+    assert changed_list == domain_lists[0] + ['cache.example.com']
+    # unused files are forgotten
+    match_file_cache.forget_unused()
+    (_, _) = match_file_cache.load(load_match_list, cache_file,
+                                   check_domain=True)
+    match_file_cache.forget_unused()
+    assert match_file_cache.get_status()['match_file_cache_files'] == 1
+    print "Cached match files are only loaded when their contents change"
+    print ""
+
+finally:
+    shutil.rmtree(cache_dir)
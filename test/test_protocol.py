@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+# check that privcount's protocols process events and handle commands
+# correctly, using in-memory transports and a fake clock
+
+# this test will exit successfully, unless a protocol does not behave as
+# expected
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from twisted.internet.task import Clock
+from twisted.test import iosim
+from twisted.test.proto_helpers import StringTransport
+
+import privcount.protocol
+
+from privcount.node import PrivCountClient
+from privcount.protocol import PrivCountProtocol, PrivCountServerProtocol, PrivCountClientProtocol, TorControlClientProtocol, start_config_encode, start_config_decode, start_config_forget_blob_frames, START_BLOB_MIN_LENGTH
+
+# DEBUG logs every check: use it on failure
+# INFO logs each check once
+logging.basicConfig(level=logging.INFO)
+logging.root.name = ''
+
+# control the reactor used by the protocols
+clock = Clock()
+privcount.protocol.reactor = clock
+
+class EventCountingFactory(object):
+    '''
+    A data collector factory that counts the events it is given.
+    '''
+
+    def __init__(self):
+        self.event_count = 0
+
+    def handle_event(self, event):
+        self.event_count += 1
+        return True
+
+    def get_use_setconf(self):
+        return False
+
+def create_collecting_protocol(event_name):
+    '''
+    Return a TorControlClientProtocol and its factory, which are processing
+    events of type event_name.
+    '''
+    factory = EventCountingFactory()
+    protocol = TorControlClientProtocol(factory)
+    protocol.transport = StringTransport()
+    protocol.state = 'processing'
+    protocol.collection_events = set([event_name])
+    protocol.active_events = protocol.collection_events
+    return (protocol, factory)
+
+logging.info("Checking stopping a collection counts queued events in batches:")
+(protocol, factory) = create_collecting_protocol('PRIVCOUNT_TEST')
+queued_count = protocol.event_batch_size*3 + 1
+for _ in xrange(queued_count):
+    assert protocol.queueEvent(['PRIVCOUNT_TEST', 'Test=1'])
+results = []
+protocol.stopCollection().addCallback(results.append)
+# one batch is processed immediately, the rest are processed later
+assert factory.event_count == protocol.event_batch_size
+assert len(results) == 0
+assert protocol.collection_events is not None
+# events received after the collection stops are not queued
+assert not protocol.queueEvent(['PRIVCOUNT_TEST', 'Test=1'])
+# the next batch is scheduled
+assert len(clock.getDelayedCalls()) == 1
+clock.advance(0)
+assert factory.event_count == queued_count
+assert results == [True]
+assert protocol.collection_events is None
+logging.info("Success!")
+
+logging.info("Checking a full event queue pauses reading instead of dropping events:")
+(protocol, factory) = create_collecting_protocol('PRIVCOUNT_TEST')
+protocol.event_queue_length = 10
+for _ in xrange(protocol.event_queue_length*2):
+    assert protocol.queueEvent(['PRIVCOUNT_TEST', 'Test=1'])
+assert protocol.is_reading_paused
+assert protocol.transport.producerState == 'paused'
+clock.advance(0)
+assert factory.event_count == protocol.event_queue_length*2
+assert not protocol.is_reading_paused
+assert protocol.transport.producerState == 'producing'
+logging.info("Success!")
+
+logging.info("Checking stopping a collection with an empty queue is immediate:")
+(protocol, factory) = create_collecting_protocol('PRIVCOUNT_TEST')
+results = []
+protocol.stopCollection(clear_events=False).addCallback(results.append)
+assert results == [True]
+assert protocol.collection_events is not None
+logging.info("Success!")
+
+logging.info("Checking stopping a collection can discard queued events:")
+(protocol, factory) = create_collecting_protocol('PRIVCOUNT_TEST')
+protocol.queueEvent(['PRIVCOUNT_TEST', 'Test=1'])
+results = []
+protocol.stopCollection(discard_events=True).addCallback(results.append)
+assert results == [True]
+assert factory.event_count == 0
+logging.info("Success!")
+
+logging.info("Checking a lost connection finishes stopping a collection:")
+(protocol, factory) = create_collecting_protocol('PRIVCOUNT_TEST')
+for _ in xrange(protocol.event_batch_size + 1):
+    protocol.queueEvent(['PRIVCOUNT_TEST', 'Test=1'])
+results = []
+protocol.stopCollection().addCallback(results.append)
+assert len(results) == 0
+protocol.clear()
+assert results == [False]
+assert factory.event_count == protocol.event_batch_size
+logging.info("Success!")
+
+logging.info("Checking binary START configs:")
+big_list = u'\n'.join(u'{}.example.com'.format(i) for i in xrange(10000))
+assert len(big_list) >= START_BLOB_MIN_LENGTH
+start_config = json.loads(json.dumps({
+        'domain_list' : big_list,
+        'counters' : { 'ZeroCount' : { 'bins' : [[0.0, u'inf']] } },
+        'nested' : [big_list, u'small'],
+        }))
+encoded = start_config_encode(start_config)
+(decoded, start_blobs) = start_config_decode(encoded)
+assert decoded == start_config
+assert len(start_blobs) == 1
+# clients that have the blob don't receive it again
+skipped = start_config_encode(start_config,
+                              skip_blob_hashes=set(start_blobs.keys()))
+assert len(skipped) < len(encoded)
+(decoded, _) = start_config_decode(skipped, known_blobs=start_blobs)
+assert decoded == start_config
+# and clients that don't have the blob fail
+try:
+    start_config_decode(skipped)
+    assert False
+except AssertionError as e:
+    assert 'missing START blob' in str(e)
+logging.info("START config: {} bytes JSON, {} bytes binary, {} bytes skipped"
+             .format(len(json.dumps(start_config)), len(encoded), len(skipped)))
+logging.info("Success!")
+
+logging.info("Checking START blobs are cached between configs:")
+# a config without blobs doesn't make the server forget the blob
+blob_frame_count = len(privcount.protocol._start_blob_frames)
+assert blob_frame_count > 0
+start_config_encode({ 'counters' : {} })
+assert len(privcount.protocol._start_blob_frames) == blob_frame_count
+start_config_forget_blob_frames(max_age=-1)
+assert len(privcount.protocol._start_blob_frames) == 0
+# or the client
+client = PrivCountClient('config.yaml')
+client.update_start_blobs(start_blobs, 60)
+client.update_start_blobs({}, 60)
+assert client.get_start_blobs() == start_blobs
+# blobs that haven't been used recently are forgotten
+client.update_start_blobs({}, -1)
+assert client.get_start_blobs() == {}
+client.update_start_blobs(start_blobs, 60)
+client.clear_start_blobs()
+assert client.get_start_blobs() == {}
+logging.info("Success!")
+
+class StartServerFactory(object):
+    '''
+    A tally server factory that sends one START config to its client.
+    '''
+
+    def __init__(self, secret_handshake_path, start_config):
+        self.secret_handshake_path = secret_handshake_path
+        self.start_config = start_config
+        self.start_result = None
+
+    def get_secret_handshake_path(self):
+        return self.secret_handshake_path
+
+    def get_status(self):
+        return {}
+
+    def set_client_status(self, uid, status):
+        pass
+
+    def get_stop_config(self, uid):
+        return None
+
+    def get_start_config(self, uid):
+        (config, self.start_config) = (self.start_config, None)
+        return config
+
+    def set_start_result(self, uid, result_data):
+        self.start_result = result_data
+
+    def get_checkin_period(self):
+        return 60
+
+class StartClientFactory(PrivCountClient):
+    '''
+    A client factory that remembers the START config it receives.
+    '''
+
+    def __init__(self, secret_handshake_path, chunked_lines):
+        PrivCountClient.__init__(self, 'config.yaml')
+        self.config = { 'secret_handshake' : secret_handshake_path,
+                        'chunked_lines' : chunked_lines }
+        self.start_config = None
+
+    def get_status(self):
+        return { 'name' : 'test-client' }
+
+    def set_server_status(self, status):
+        pass
+
+    def do_start(self, config):
+        self.start_config = config
+        return {}
+
+    def do_checkin(self):
+        pass
+
+    def resetDelay(self):
+        pass
+
+    def stopTrying(self):
+        pass
+
+def connect_protocols(server_factory, client_factory):
+    '''
+    Return a connected PrivCount server and client protocol, and an iosim
+    pump that moves data between them. The connection has finished its
+    handshake.
+    '''
+    (client, server, pump) = iosim.connectedServerAndClient(
+        lambda: PrivCountServerProtocol(server_factory),
+        lambda: PrivCountClientProtocol(client_factory),
+        greet=False)
+    while not server.is_valid_connection:
+        assert pump.pump()
+    return (client, server, pump)
+
+secret_dir = tempfile.mkdtemp()
+chunk_bytes = PrivCountProtocol.CHUNK_BYTES
+try:
+    secret_handshake_path = os.path.join(secret_dir, 'secret_handshake.yaml')
+    PrivCountProtocol.handshake_secret_load(secret_handshake_path,
+                                            create=True)
+    # use small chunks, so the START config is chunked
+    PrivCountProtocol.CHUNK_BYTES = 1024
+    start_config = json.loads(json.dumps({ 'domain_list' : big_list }))
+
+    logging.info("Checking clients don't offer extensions by default:")
+    server_factory = StartServerFactory(secret_handshake_path, start_config)
+    client_factory = StartClientFactory(secret_handshake_path, False)
+    (client, server, pump) = connect_protocols(server_factory, client_factory)
+    assert client.extensions == []
+    assert server.extensions == []
+    assert not server.is_chunked_connection
+    pump.flush()
+    assert client_factory.start_config == start_config
+    assert server_factory.start_result == {}
+    client_factory.get_checkin_task().stop()
+    logging.info("Success!")
+
+    logging.info("Checking CHUNKED extension negotiation and reassembly:")
+    server_factory = StartServerFactory(secret_handshake_path, start_config)
+    client_factory = StartClientFactory(secret_handshake_path, True)
+    (client, server, pump) = connect_protocols(server_factory, client_factory)
+    assert client.extensions == [PrivCountProtocol.EXTENSION_CHUNKED]
+    assert server.extensions == [PrivCountProtocol.EXTENSION_CHUNKED]
+    assert client.is_chunked_connection and server.is_chunked_connection
+    chunk_lengths = []
+    client_chunk_received = client.chunkReceived
+    def count_chunk(chunk_line):
+        chunk_lengths.append(len(chunk_line))
+        client_chunk_received(chunk_line)
+    client.chunkReceived = count_chunk
+    chunked_max_length = client.MAX_LENGTH
+    assert chunked_max_length < PrivCountProtocol.VALIDATED_MAX_LENGTH
+    pump.flush()
+    assert len(chunk_lengths) > 1
+    assert max(chunk_lengths) <= chunked_max_length
+    assert client_factory.start_config == start_config
+    assert server_factory.start_result == {}
+    client_factory.get_checkin_task().stop()
+    logging.info("Received START config in {} chunks".format(len(chunk_lengths)))
+    logging.info("Success!")
+
+    logging.info("Checking the extensions are part of the HMAC prefix:")
+    # the connection has closed, so we need new cookies
+    client.server_cookie = client.handshake_cookie_get()
+    client.client_cookie = client.handshake_cookie_get()
+    handshake2 = client.handshake2_str()
+    assert handshake2.endswith(' ' + PrivCountProtocol.EXTENSION_CHUNKED)
+    # the handshake line is well under the unvalidated warning length
+    assert not client.is_valid_connection
+    assert len(handshake2) < client.get_warn_length(False)
+    assert PrivCountProtocol.handshake2_verify(handshake2,
+                                               client.handshake_secret(),
+                                               client.server_cookie)
+    # removing or adding an extension breaks the HMAC
+    stripped = handshake2[:-len(' ' + PrivCountProtocol.EXTENSION_CHUNKED)]
+    assert not PrivCountProtocol.handshake2_verify(stripped,
+                                                   client.handshake_secret(),
+                                                   client.server_cookie)
+    assert not PrivCountProtocol.handshake2_verify(handshake2 + ' EXTRA',
+                                                   client.handshake_secret(),
+                                                   client.server_cookie)
+    logging.info("Success!")
+
+    logging.info("Checking an over-length chunked line drops the connection:")
+    server_factory = StartServerFactory(secret_handshake_path, None)
+    client_factory = StartClientFactory(secret_handshake_path, True)
+    (client, server, pump) = connect_protocols(server_factory, client_factory)
+    client.transport.write("{} {} {}\r\n".format(
+        PrivCountProtocol.CHUNK_EVENT,
+        PrivCountProtocol.VALIDATED_MAX_LENGTH + 1,
+        'A'*16))
+    pump.pump()
+    assert not server.is_valid_connection
+    assert server.transport.disconnecting
+    assert server.chunk_pieces == []
+    logging.info("Success!")
+
+    logging.info("Checking an invalid chunk drops the connection:")
+    server_factory = StartServerFactory(secret_handshake_path, None)
+    client_factory = StartClientFactory(secret_handshake_path, True)
+    (client, server, pump) = connect_protocols(server_factory, client_factory)
+    # the second chunk claims a different total length
+    client.transport.write("{0} 32 {1}\r\n{0} 48 {1}\r\n".format(
+        PrivCountProtocol.CHUNK_EVENT, 'A'*16))
+    pump.pump()
+    assert not server.is_valid_connection
+    assert server.transport.disconnecting
+    assert server.chunk_pieces == []
+    logging.info("Success!")
+finally:
+    PrivCountProtocol.CHUNK_BYTES = chunk_bytes
+    shutil.rmtree(secret_dir)
@@ -8,9 +8,10 @@
 # this test will exit successfully, unless the counters are more than
 # MAX_DIVERGENCE from the full range or equal bin counts
 
+from math import sqrt
 from random import SystemRandom
 
-from privcount.counter import sample, sample_randint, derive_blinding_factor, counter_modulus
+from privcount.counter import sample, sample_list, sample_randint, derive_blinding_factor, counter_modulus, gauss_list
 
 # Allow this much divergence from the full range and equal bin counts
 MAX_DIVERGENCE = 0.02
@@ -191,3 +192,35 @@ print ""
 
 print "privcount.derive_blinding_factor:"
 run_trial(N_TRIALS, blinding_value, PRIV_COUNTER_MODULUS, BIN_COUNT)
+print ""
+
+print "privcount.sample_list:"
+# check one large list, like a round's blinding factors
+values = sample_list(PRIV_COUNTER_MODULUS, N_TRIALS)
+assert len(values) == N_TRIALS
+bin_list = [0]*BIN_COUNT
+for value in values:
+    assert value >= 0L
+    assert value < PRIV_COUNTER_MODULUS
+    bin_number = bin(value, PRIV_COUNTER_MODULUS, BIN_COUNT)
+    if bin_number is not None:
+        bin_list[bin_number] += 1
+print "Actual - Expected = Difference (% Difference of modulus)"
+print "Min: {}".format(format_difference(min(values), 0, PRIV_COUNTER_MODULUS))
+print "modulus: {}".format(format_difference(max(values), PRIV_COUNTER_MODULUS,
+                                             PRIV_COUNTER_MODULUS))
+print "Bin: {}".format(format_difference_list(bin_list, N_TRIALS / BIN_COUNT,
+                                              N_TRIALS / BIN_COUNT))
+print ""
+
+print "privcount.gauss_list:"
+# the samples should have mean 0 and standard deviation 1
+values = gauss_list(N_TRIALS)
+assert len(values) == N_TRIALS
+mean = sum(values) / N_TRIALS
+stddev = sqrt(sum((value - mean)**2 for value in values) / N_TRIALS)
+print "Mean: {} Standard Deviation: {}".format(mean, stddev)
+assert abs(mean) < MAX_DIVERGENCE
+assert abs(stddev - 1.0) < MAX_DIVERGENCE
+# odd counts work
+assert len(gauss_list(1)) == 1